@@ -1,38 +1,33 @@
 import os
+import time
 import requests
-import base64
-import json
 from datetime import datetime
 from dotenv import load_dotenv
+from http_client import get_client
+from metrics import metrics, timer
+from rate_limiting import request_with_retry, record_stat
+from token_cache import TokenCache, get_token_expiry_timestamp
+from response_cache import response_cache
 
 # Load environment variables
 load_dotenv()
 
-# URLs
-LOGIN_URL = "https://api.weatherxm.com/api/v1/auth/login"
-DEVICES_URL = "https://api.weatherxm.com/api/v1/me/devices"
-BASE_URL = "https://api.weatherxm.com/api/v1/me/devices/{}/history"
+# URLs (WXM_API_BASE_URL can point at a local mock server for benchmarking)
+API_BASE_URL = os.getenv('WXM_API_BASE_URL', "https://api.weatherxm.com/api/v1").rstrip('/')
+LOGIN_URL = f"{API_BASE_URL}/auth/login"
+DEVICES_URL = f"{API_BASE_URL}/me/devices"
+BASE_URL = f"{API_BASE_URL}/me/devices/{{}}/history"
 
-# Global Configuration
-USERNAME = os.getenv('WXM_USERNAME')
-PASSWORD = os.getenv('WXM_PASSWORD')
+# Global Configuration (credentials are read at login, so settings changed in this process apply)
 SAVE_LOCATION = os.getenv('FILE_SAVE_LOCATION', os.getcwd())
 
 # Utility Functions
 def get_token_expiration(token):
     """Extract and format the expiration date from the JWT token."""
-    try:
-        payload_encoded = token.split('.')[1]
-        padding = len(payload_encoded) % 4
-        if padding > 0:
-            payload_encoded += '=' * (4 - padding)
-        payload_decoded = base64.urlsafe_b64decode(payload_encoded).decode('utf-8')
-        payload = json.loads(payload_decoded)
-        exp_timestamp = payload.get('exp')
-        if exp_timestamp:
-            return datetime.fromtimestamp(exp_timestamp).strftime('%m/%d/%Y %I:%M:%S %p')
-    except Exception as e:
-        print(f"Error decoding token: {e}")
+    exp_timestamp = get_token_expiry_timestamp(token)
+    if exp_timestamp:
+        return datetime.fromtimestamp(exp_timestamp).strftime('%m/%d/%Y %I:%M:%S %p')
+    print("Error decoding token: no readable expiration claim.")
     return None
 
 
@@ -60,13 +55,15 @@ def update_env_file(new_api_key, device_id, station_id):
 
 def login_and_get_api_key():
     """Logs in to fetch a new API key."""
-    if not USERNAME or not PASSWORD:
+    username, password = os.getenv('WXM_USERNAME'), os.getenv('WXM_PASSWORD')
+    if not username or not password:
         raise EnvironmentError("Missing WeatherXM username or password. Check your .env file.")
-    payload = {"username": USERNAME, "password": PASSWORD}
+    payload = {"username": username, "password": password}
     headers = {'Content-Type': 'application/json', 'Accept': 'application/json'}
 
     try:
-        response = requests.post(LOGIN_URL, json=payload, headers=headers)
+        with timer('login'):
+            response = get_client().post(LOGIN_URL, json=payload, headers=headers)
         response.raise_for_status()
         data = response.json()
         api_key = data.get('token')
@@ -79,14 +76,30 @@ def login_and_get_api_key():
         return None
 
 
-def fetch_device_id(api_key):
-    """Fetch device information and prompt the user to select a device."""
+# Shared token cache; refreshes ahead of expiry with a single login for all threads
+token_cache = TokenCache(login_and_get_api_key)
+
+
+def get_api_key(seed_token=None):
+    """Returns a valid API key from the token cache, logging in only when needed."""
+    return token_cache.get(seed_token)
+
+
+def list_devices(api_key):
+    """Fetch every device on the account (raises on request errors)."""
     headers = {"Authorization": f"Bearer {api_key}"}
+    with timer('device_lookup') as fields:
+        response = get_client().get(DEVICES_URL, headers=headers)
+        response.raise_for_status()
+        devices = response.json() or []
+        fields['devices'] = len(devices)
+    return devices
 
+
+def fetch_device_id(api_key):
+    """Fetch device information and prompt the user to select a device."""
     try:
-        response = requests.get(DEVICES_URL, headers=headers)
-        response.raise_for_status()
-        devices = response.json()
+        devices = list_devices(api_key)
         if not devices:
             print("No devices found.")
             return None, None
@@ -101,38 +114,82 @@ def fetch_device_id(api_key):
         return None, None
 
 
-def fetch_data_segment(api_key, device_id, from_date, to_date):
-    """Fetch data for a specific time segment."""
-    params = {'fromDate': from_date.isoformat(), 'toDate': to_date.isoformat()}
-    headers = {"Authorization": f"Bearer {api_key}"}
+def fetch_data_segment(api_key, device_id, from_date, to_date, raise_errors=False):
+    """Fetch data for a specific time segment.
+
+    Requests go through the shared rate limiter and are retried with backoff on
+    429/5xx and connection errors. A 401 triggers at most one token refresh.
+    Failures return [] unless raise_errors is set, in which case the error propagates.
+    Responses are served from and stored in the on-disk response cache when it is enabled.
+    """
+    if response_cache is not None:
+        with timer('segment_cache_read') as fields:
+            cached_records = response_cache.get(device_id, from_date, to_date)
+            fields['hit'] = cached_records is not None
+        if cached_records is not None:
+            return cached_records
 
+    params = {'fromDate': from_date.isoformat(), 'toDate': to_date.isoformat()}
+    url = BASE_URL.format(device_id)
+    # Swap in a proactively refreshed token before the old one can fail with 401
+    api_key = get_api_key(api_key) or api_key
+    attempts = 0
+
+    def send():
+        nonlocal attempts
+        attempts += 1
+        return get_client().get(url, headers=headers, params=params)
+
+    # One event per segment: latency including retries and backoff, response size, records and retries
+    started = time.perf_counter()
+    fields = {'device_id': device_id, 'from_date': params['fromDate']}
     try:
-        response = requests.get(BASE_URL.format(device_id), headers=headers, params=params)
+        for auth_attempt in range(2):
+            headers = {"Authorization": f"Bearer {api_key}"}
+            response = request_with_retry(send)
+            fields.update(status=str(response.status_code), bytes=len(response.content))
+            if response.status_code == 401 and auth_attempt == 0:
+                print("Unauthorized. Attempting to refresh API key...")
+                api_key = token_cache.refresh(api_key)
+                if api_key:
+                    continue
+            break
         response.raise_for_status()
         data = response.json()
         if isinstance(data, list):
-            return data
+            records = data
         elif isinstance(data, dict):
-            return data.get("records", [])
+            records = data.get("records", [])
         else:
             print("Unexpected API response format.")
             return []
-    except requests.exceptions.HTTPError as e:
-        if response.status_code == 401:
-            print("Unauthorized. Attempting to refresh API key...")
-            new_api_key = login_and_get_api_key()
-            if new_api_key:
-                return fetch_data_segment(new_api_key, device_id, from_date, to_date)
-        print(f"HTTP error occurred: {e}")
-        return []
     except requests.exceptions.RequestException as e:
-        print(f"Error during data fetch: {e}")
+        fields['error'] = type(e).__name__
+        if isinstance(e, requests.exceptions.HTTPError):
+            print(f"HTTP error occurred for {from_date} to {to_date}: {e}")
+        else:
+            print(f"Error during data fetch for {from_date} to {to_date}: {e}")
+        record_stat('failed_segments')
+        if raise_errors:
+            raise
         return []
+    else:
+        fields['records'] = len(records)
+    finally:
+        fields['retries'] = max(0, attempts - 1)
+        metrics.record('segment_request', time.perf_counter() - started, **fields)
+
+    if response_cache is not None:
+        try:
+            response_cache.put(device_id, from_date, to_date, records)
+        except OSError as e:
+            print(f"Could not cache segment {from_date} to {to_date}: {e}")
+    return records
 
 
 def initialize_api():
     """Initialize API key and device ID."""
-    api_key = os.getenv('WXM_API_KEY') or login_and_get_api_key()
+    api_key = get_api_key(os.getenv('WXM_API_KEY'))
     if not api_key:
         raise RuntimeError("Failed to retrieve API key.")
 
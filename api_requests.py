@@ -1,7 +1,11 @@
 # api_requests.py
+import os
 import requests
+from http_client import get_client
+from rate_limiting import request_with_retry
 
-BASE_URL = "https://api.weatherxm.com/api/v1/me/devices/{}/history"
+API_BASE_URL = os.getenv('WXM_API_BASE_URL', "https://api.weatherxm.com/api/v1").rstrip('/')
+BASE_URL = f"{API_BASE_URL}/me/devices/{{}}/history"
 
 def fetch_data_segment(api_key, device_id, from_date, to_date):
     """Fetches data for a specific time segment."""
@@ -9,7 +13,8 @@ def fetch_data_segment(api_key, device_id, from_date, to_date):
     headers = {"Authorization": f"Bearer {api_key}"}
 
     try:
-        response = requests.get(BASE_URL.format(device_id), headers=headers, params=params)
+        response = request_with_retry(
+            lambda: get_client().get(BASE_URL.format(device_id), headers=headers, params=params))
         response.raise_for_status()
         data = response.json()
 
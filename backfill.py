@@ -0,0 +1,291 @@
+# backfill.py
+import os
+import sys
+import json
+import time
+import argparse
+from datetime import datetime, timezone
+from dotenv import load_dotenv
+import pandas as pd
+from api_manager import initialize_api, get_api_key
+from coverage_index import CoverageIndex
+from data_saving import HistoryWriter
+from fetch_weather_data import (SEGMENT_HOURS, MAX_CONCURRENT_REQUESTS, build_segments, floor_to_hour,
+                                iter_segment_results, write_segment, close_writers, record_coverage, has_hours,
+                                report_fetch_stats, learn_segment_limit)
+from raw_archive import RawArchiveWriter
+
+# Load environment variables
+load_dotenv()
+
+JOBS_DIR = os.path.join(os.getcwd(), "data", "jobs")
+# Completed segments are flushed to the history store and checkpointed this often
+BACKFILL_CHECKPOINT_SEGMENTS = int(os.getenv('BACKFILL_CHECKPOINT_SEGMENTS', '30'))
+# Minimum seconds between progress lines
+BACKFILL_PROGRESS_SECONDS = float(os.getenv('BACKFILL_PROGRESS_SECONDS', '5'))
+
+
+def _parse_date(value):
+    """Parses a YYYY-MM-DD (or ISO) date as UTC."""
+    timestamp = pd.Timestamp(value)
+    return (timestamp.tz_convert('UTC') if timestamp.tzinfo else timestamp.tz_localize('UTC')).to_pydatetime()
+
+
+def job_id_for(device_id, start_date, end_date):
+    return f"{device_id}_{start_date:%Y%m%d}_{end_date:%Y%m%d}"
+
+
+def job_path(job_id, jobs_dir=JOBS_DIR):
+    return os.path.join(jobs_dir, f"{job_id}.json")
+
+
+def save_job(job, jobs_dir=JOBS_DIR):
+    """Atomically writes the job file."""
+    os.makedirs(jobs_dir, exist_ok=True)
+    job['updated_at'] = datetime.now(timezone.utc).isoformat()
+    path = job_path(job['id'], jobs_dir)
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(job, f, indent=1)
+    os.replace(temp_path, path)
+
+
+def load_job(job_id, jobs_dir=JOBS_DIR):
+    """Returns a saved job, or None if there is no job with that ID."""
+    try:
+        with open(job_path(job_id, jobs_dir), 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def list_jobs(jobs_dir=JOBS_DIR):
+    if not os.path.isdir(jobs_dir):
+        return []
+    names = sorted(name[:-len('.json')] for name in os.listdir(jobs_dir) if name.endswith('.json'))
+    return [load_job(name, jobs_dir) for name in names]
+
+
+def create_job(device_id, start_date, end_date, coverage=None, segment_hours=SEGMENT_HOURS, jobs_dir=JOBS_DIR):
+    """Returns the job for device/start/end, creating it if needed.
+
+    A new job plans only the hours the coverage index does not already hold. Running
+    the same backfill again picks up the existing job file, which is what makes it resumable.
+    """
+    job_id = job_id_for(device_id, start_date, end_date)
+    job = load_job(job_id, jobs_dir)
+    if job is not None:
+        return job
+    if coverage is not None and coverage.has_device(device_id):
+        gaps = coverage.missing(device_id, start_date, end_date)
+    else:
+        gaps = [(start_date, end_date)]
+    segments = []
+    for gap_start, gap_end in gaps:
+        segments.extend(build_segments(gap_start, gap_end, segment_hours))
+    job = {
+        'id': job_id,
+        'device_id': device_id,
+        'start': start_date.isoformat(),
+        'end': end_date.isoformat(),
+        'segments': [[start.isoformat(), end.isoformat()] for start, end in segments],
+        'completed': [],
+        'failed': [],
+        'records': 0,
+        'status': 'pending',
+        'created_at': datetime.now(timezone.utc).isoformat(),
+    }
+    save_job(job, jobs_dir)
+    return job
+
+
+def pending_segments(job):
+    """Returns (index, (from, to)) for every segment not checkpointed yet."""
+    completed = set(job['completed'])
+    return [(index, (datetime.fromisoformat(start), datetime.fromisoformat(end)))
+            for index, (start, end) in enumerate(job['segments']) if index not in completed]
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds}s"
+
+
+class Progress:
+    """Prints done/total, throughput and ETA at most every interval seconds."""
+
+    def __init__(self, total, done, interval=BACKFILL_PROGRESS_SECONDS):
+        self.total = total
+        self.done = done
+        self.session_done = 0
+        self.records = 0
+        self.started = time.monotonic()
+        self.interval = interval
+        self.last_report = self.started
+
+    def update(self, segments=1, records=0, force=False):
+        self.done += segments
+        self.session_done += segments
+        self.records += records
+        now = time.monotonic()
+        if force or now - self.last_report >= self.interval:
+            self.last_report = now
+            print(self.describe(now))
+
+    def describe(self, now=None):
+        elapsed = (now or time.monotonic()) - self.started
+        line = f"Backfill: {self.done}/{self.total} segments ({self.done / max(self.total, 1):.1%}), " \
+               f"{self.records} records this run, elapsed {format_duration(elapsed)}"
+        if self.session_done and self.done < self.total:
+            eta = elapsed / self.session_done * (self.total - self.done)
+            line += f", ETA {format_duration(eta)}"
+        return line
+
+
+def checkpoint(job, written, record_count, coverage, jobs_dir=JOBS_DIR, empty=()):
+    """Marks written (and flushed) segments as completed in the job file and the coverage index.
+
+    empty holds the written segments that returned no hours (see record_coverage).
+    """
+    if written:
+        job['completed'] = sorted(set(job['completed']) | set(written))
+        job['failed'] = [index for index in job['failed'] if index not in set(written)]
+        job['records'] += record_count
+        segments = {index: tuple(datetime.fromisoformat(value) for value in job['segments'][index])
+                    for index in written}
+        record_coverage(coverage, job['device_id'],
+                        [segment for index, segment in segments.items() if index not in empty],
+                        [segment for index, segment in segments.items() if index in empty])
+    save_job(job, jobs_dir)
+
+
+def run_job(job, api_key, max_workers=MAX_CONCURRENT_REQUESTS, coverage=None, jobs_dir=JOBS_DIR):
+    """Fetches a job's remaining segments, checkpointing as it goes. Returns the job's final status.
+
+    Ctrl-C stops the run after flushing what was already fetched, so the next run
+    resumes from there instead of starting over.
+    """
+    coverage = coverage or CoverageIndex()
+    device_id = job['device_id']
+    todo = pending_segments(job)
+    total = len(job['segments'])
+    if not todo:
+        job['status'] = 'complete'
+        save_job(job, jobs_dir)
+        print(f"Backfill {job['id']} is already complete.")
+        return job['status']
+    print(f"Backfill {job['id']}: {len(todo)} of {total} segments left "
+          f"({job['segments'][todo[0][0]][0]} to {job['segments'][todo[-1][0]][1]})")
+
+    job['status'] = 'running'
+    save_job(job, jobs_dir)
+    progress = Progress(total, total - len(todo))
+    # Backfills feed the raw archive and the history store; the daily CSV and Excel views are left to regular fetches
+    raw_writer = RawArchiveWriter(device_id)
+    history_writer = HistoryWriter(device_id)
+    written, written_records, failed = [], 0, set(job['failed'])
+    empty = set()
+    interrupted = False
+    results = None
+    try:
+        indices = [index for index, _ in todo]
+        results = iter_segment_results(api_key, device_id, [segment for _, segment in todo], max_workers)
+        for index, (segment, records) in zip(indices, results):
+            if records is None:
+                failed.add(index)
+                progress.update(segments=0)
+                continue
+            count = write_segment(records, raw_writer, [history_writer])
+            written.append(index)
+            if not has_hours(records):
+                empty.add(index)
+            failed.discard(index)
+            written_records += count
+            progress.update(records=count)
+            if len(written) >= BACKFILL_CHECKPOINT_SEGMENTS:
+                history_writer.flush()
+                job['failed'] = sorted(failed)
+                checkpoint(job, written, written_records, coverage, jobs_dir, empty)
+                written, written_records = [], 0
+                empty = set()
+    except KeyboardInterrupt:
+        interrupted = True
+        print("\nInterrupted; saving a checkpoint before exiting...")
+    finally:
+        if results is not None:
+            results.close()
+        close_writers(raw_writer, [history_writer])
+        job['failed'] = sorted(failed)
+        if interrupted:
+            job['status'] = 'interrupted'
+        else:
+            done = len(job['completed']) + len(written)
+            job['status'] = 'complete' if done == total else 'incomplete'
+        checkpoint(job, written, written_records, coverage, jobs_dir, empty)
+
+    print(progress.describe())
+    report_fetch_stats()
+    if job['status'] != 'complete':
+        print(f"Backfill {job['status']}: {total - len(job['completed'])} segment(s) left. "
+              f"Resume with: python backfill.py --resume {job['id']}")
+    else:
+        print(f"Backfill {job['id']} complete: {job['records']} records.")
+    return job['status']
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Resumable multi-day history backfill for one WeatherXM station.")
+    parser.add_argument('--start', help="first day to backfill (YYYY-MM-DD, UTC)")
+    parser.add_argument('--end', help="day to stop at, exclusive (YYYY-MM-DD, UTC; default: now)")
+    parser.add_argument('--device', help="device ID (default: DEVICE_ID from .env)")
+    parser.add_argument('--resume', metavar='JOB_ID', help="resume a saved backfill job")
+    parser.add_argument('--list', action='store_true', help="list saved backfill jobs")
+    parser.add_argument('--workers', type=int, default=MAX_CONCURRENT_REQUESTS, help="requests in flight")
+    args = parser.parse_args(argv)
+
+    if args.list:
+        for job in list_jobs():
+            print(f"{job['id']}: {job['status']}, {len(job['completed'])}/{len(job['segments'])} segments, "
+                  f"{job['records']} records, updated {job.get('updated_at', '')}")
+        return 0
+
+    coverage = CoverageIndex()
+    if args.resume:
+        job = load_job(args.resume)
+        if job is None:
+            print(f"No backfill job named {args.resume} in {JOBS_DIR}")
+            return 1
+        api_key = get_api_key(os.getenv('WXM_API_KEY'))
+        if not api_key:
+            raise RuntimeError("Failed to retrieve API key.")
+    elif args.start:
+        if args.device:
+            api_key, device_id = get_api_key(os.getenv('WXM_API_KEY')), args.device
+            if not api_key:
+                raise RuntimeError("Failed to retrieve API key.")
+        else:
+            api_key, device_id = initialize_api()
+        start_date = _parse_date(args.start)
+        end_date = _parse_date(args.end) if args.end else floor_to_hour(datetime.now(timezone.utc))
+        if start_date >= end_date:
+            print("--start must be before --end.")
+            return 1
+        segment_hours = SEGMENT_HOURS
+        if load_job(job_id_for(device_id, start_date, end_date)) is None:
+            # Size the plan by the largest window the API accepts; this costs a few requests once per device
+            segment_hours = learn_segment_limit(api_key, device_id, start_date, end_date)
+            print(f"Planning {segment_hours}-hour segments for {device_id}")
+        job = create_job(device_id, start_date, end_date, coverage, segment_hours)
+    else:
+        parser.error("one of --start, --resume or --list is required")
+
+    status = run_job(job, api_key, args.workers, coverage)
+    return 130 if status == 'interrupted' else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
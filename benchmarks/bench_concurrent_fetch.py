@@ -0,0 +1,41 @@
+# bench_concurrent_fetch.py
+"""Compares serial and concurrent segment fetching against the local mock API.
+
+Usage: python benchmarks/bench_concurrent_fetch.py [days] [latency_seconds]
+"""
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mock_server import start_mock_server, MOCK_DEVICE
+
+
+def main():
+    days = int(sys.argv[1]) if len(sys.argv) > 1 else 90
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.05
+
+    server, base_url = start_mock_server(latency=latency)
+    # api_manager and rate_limiting read their configuration at import time
+    os.environ['WXM_API_BASE_URL'] = base_url
+    os.environ.setdefault('RATE_LIMIT_PER_SECOND', '1000')
+    os.environ.setdefault('RATE_LIMIT_BURST', '100')
+    from fetch_weather_data import build_segments, fetch_segments
+
+    end_date = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    segments = build_segments(end_date - timedelta(days=days), end_date)
+    print(f"{len(segments)} segments, {latency * 1000:.0f} ms simulated latency per request")
+
+    for workers in (1, 4, 8, 16):
+        started = time.perf_counter()
+        records = fetch_segments("mock-token", MOCK_DEVICE['id'], segments, max_workers=workers)
+        elapsed = time.perf_counter() - started
+        print(f"workers={workers:<3} records={len(records):<5} {elapsed:.2f}s")
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+# bench_flatten.py
+"""Compares ways of turning API records into the same typed frame flatten_to_frame returns.
+
+Every variant produces all 14 fields with the schema's dtypes (tz-aware timestamp,
+float32 measurements, categorical icon), so the timings compare like with like.
+
+Usage: python benchmarks/bench_flatten.py [rows ...]   (default: 100000 1000000)
+"""
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data_saving import flatten_to_frame, parse_iso_timestamps
+from weather_schema import FLAT_COLUMNS, ICON_DTYPE, MEASUREMENT_COLUMNS, MEASUREMENT_DTYPE
+
+# Zone of the generated records (flatten_to_frame returns timestamps in it)
+RECORD_TZ = "America/New_York"
+HOURLY_TEMPLATE = {
+    "precipitation_accumulated": 0, "temperature": -0.19302752293577977, "wind_speed": 1.572798165137617,
+    "wind_direction": 290, "humidity": 66, "uv_index": 0, "pressure": 1006.0980275229361, "illuminance": 0,
+    "wind_gust": 4.59, "precipitation": 0, "feels_like": -2.1059893879410243, "icon": "partly-cloudy-night",
+    "solar_irradiance": 0, "dew_point": -5.782023586395373,
+}
+
+
+def legacy_flatten_data(json_data):
+    """The flatten_data loop as it was before vectorization, extended to every schema field."""
+    flattened = []
+    for record in json_data:
+        if 'hourly' in record:
+            for hourly_entry in record['hourly']:
+                row = {'timestamp': hourly_entry.get('timestamp', None)}
+                for column in MEASUREMENT_COLUMNS:
+                    row[column] = hourly_entry.get(column, None)
+                row['icon'] = hourly_entry.get('icon', '')
+                flattened.append(row)
+    return flattened
+
+
+def to_schema_types(df):
+    """Applies the dtype casts flatten_to_frame's output has."""
+    # Same timestamp parser as flatten_to_frame, so only the way the frame is built differs
+    df['timestamp'] = parse_iso_timestamps(df['timestamp'].tolist()).dt.tz_convert(RECORD_TZ)
+    df[MEASUREMENT_COLUMNS] = df[MEASUREMENT_COLUMNS].apply(pd.to_numeric, errors='coerce').astype(MEASUREMENT_DTYPE)
+    df['icon'] = df['icon'].fillna('').astype(ICON_DTYPE)
+    return df
+
+
+def legacy_to_frame(json_data):
+    """Legacy loop, then a DataFrame and the schema's dtypes."""
+    return to_schema_types(pd.DataFrame(legacy_flatten_data(json_data), columns=FLAT_COLUMNS))
+
+
+def from_records_to_frame(json_data):
+    """One pd.DataFrame.from_records over the hourly entries, then the schema's dtypes."""
+    entries = [entry for record in json_data for entry in record.get('hourly', [])]
+    return to_schema_types(pd.DataFrame.from_records(entries, columns=FLAT_COLUMNS))
+
+
+def make_records(rows):
+    """Builds daily API records holding `rows` hourly entries in total."""
+    tz = timezone(timedelta(hours=-5))
+    start = datetime(2020, 1, 1, tzinfo=tz)
+    records = []
+    for day in range((rows + 23) // 24):
+        date = start + timedelta(days=day)
+        hours = min(24, rows - day * 24)
+        hourly = [dict(HOURLY_TEMPLATE, timestamp=(date + timedelta(hours=h)).isoformat()) for h in range(hours)]
+        records.append({"tz": RECORD_TZ, "date": date.date().isoformat(), "hourly": hourly})
+    return records
+
+
+def best_of(func, data, repeat=3):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(data)
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [100_000, 1_000_000]
+    for rows in sizes:
+        records = make_records(rows)
+        legacy = best_of(legacy_to_frame, records)
+        from_records = best_of(from_records_to_frame, records)
+        vectorized = best_of(flatten_to_frame, records)
+        print(f"{rows:>9} rows  legacy loop + DataFrame {legacy:.3f}s  from_records {from_records:.3f}s  "
+              f"flatten_to_frame {vectorized:.3f}s")
+
+if __name__ == "__main__":
+    main()
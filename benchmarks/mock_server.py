@@ -0,0 +1,182 @@
+# mock_server.py
+"""Local stand-in for the WeatherXM API, used by the benchmarks.
+
+Emulates /auth/login, /me/devices and /me/devices/{id}/history with configurable
+latency, error and throttle rates, and payload size. Run it on its own with:
+python benchmarks/mock_server.py --port 8000 [--latency 0.05] [--error-rate 0.01]
+"""
+import sys
+import json
+import random
+import argparse
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+MOCK_DEVICES = [
+    {"id": "mock-device-1", "name": "Mock Pecan Twister"},
+    {"id": "mock-device-2", "name": "Mock Maple Breeze"},
+    {"id": "mock-device-3", "name": "Mock Cedar Drizzle"},
+]
+MOCK_DEVICE = MOCK_DEVICES[0]
+
+
+def build_hour(timestamp, padding=0):
+    """One hourly entry with every field the real API returns; padding adds a filler field of that many bytes."""
+    hour = timestamp.hour
+    entry = {
+        "timestamp": timestamp.isoformat(),
+        "temperature": 10.0 + hour * 0.25,
+        "precipitation_accumulated": 0.2 * (hour // 6),
+        "wind_speed": 1.5,
+        "humidity": 70,
+        "pressure": 1010.0,
+        "wind_direction": (hour * 15) % 360,
+        "wind_gust": 3.2,
+        "uv_index": max(0, 6 - abs(hour - 12)),
+        "illuminance": max(0, 60000 - abs(hour - 12) * 10000),
+        "solar_irradiance": max(0, 800 - abs(hour - 12) * 130),
+        "dew_point": 4.5,
+        "feels_like": 9.0 + hour * 0.25,
+        "precipitation": 0.2 if hour % 6 == 0 else 0,
+        "icon": "partly-cloudy-night",
+    }
+    if padding:
+        entry["padding"] = "x" * padding
+    return entry
+
+
+def build_history(from_date, to_date, padding=0):
+    """Builds one daily record with hourly entries for every day in the window."""
+    records = []
+    day = from_date.date()
+    while day <= to_date.date():
+        hourly = []
+        for hour in range(24):
+            timestamp = datetime(day.year, day.month, day.day, hour, tzinfo=from_date.tzinfo)
+            if from_date <= timestamp < to_date:
+                hourly.append(build_hour(timestamp, padding))
+        if hourly:
+            records.append({"tz": "UTC", "date": day.isoformat(), "hourly": hourly})
+        day += timedelta(days=1)
+    return records
+
+
+class MockWeatherXMHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    latency = 0.0
+    # Fractions of history requests answered with 500 and with 429 (Retry-After: 0)
+    error_rate = 0.0
+    throttle_rate = 0.0
+    # Extra bytes per hourly entry, to emulate larger payloads
+    padding = 0
+    # Windows longer than this get a 400; responses are cut to the first max_days daily records (0 = no limit)
+    max_window_hours = 0
+    max_days = 0
+    rng = random.Random(0)
+    rng_lock = threading.Lock()
+    stats = {'responses': 0, 'bytes': 0}
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, payload, status=200, headers=None):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        with self.rng_lock:
+            self.stats['responses'] += 1
+            self.stats['bytes'] += len(body)
+            self.stats[f'status_{status}'] = self.stats.get(f'status_{status}', 0) + 1
+
+    def _roll(self):
+        with self.rng_lock:
+            return self.rng.random()
+
+    def do_POST(self):
+        time.sleep(self.latency)
+        if urlparse(self.path).path.endswith('/auth/login'):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            self._send_json({"token": "mock.eyJleHAiOiA0MTAyNDQ0ODAwfQ.mock"})
+        else:
+            self._send_json({"error": "not found"}, status=404)
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        url = urlparse(self.path)
+        if url.path.endswith('/me/devices'):
+            self._send_json(MOCK_DEVICES)
+        elif url.path.endswith('/history'):
+            roll = self._roll()
+            if roll < self.error_rate:
+                self._send_json({"error": "mock server error"}, status=500)
+                return
+            if roll < self.error_rate + self.throttle_rate:
+                self._send_json({"error": "rate limited"}, status=429, headers={'Retry-After': '0'})
+                return
+            params = parse_qs(url.query)
+            from_date = datetime.fromisoformat(params['fromDate'][0])
+            to_date = datetime.fromisoformat(params['toDate'][0])
+            if self.max_window_hours and to_date - from_date > timedelta(hours=self.max_window_hours):
+                self._send_json({"error": "date range too large"}, status=400)
+                return
+            records = build_history(from_date, to_date, self.padding)
+            self._send_json(records[:self.max_days] if self.max_days else records)
+        else:
+            self._send_json({"error": "not found"}, status=404)
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def start_mock_server(latency=0.0, port=0, error_rate=0.0, throttle_rate=0.0, padding=0, seed=0,
+                      max_window_hours=0, max_days=0):
+    """Starts the mock API in a background thread and returns (server, base_url).
+
+    Errors and throttling are drawn from a seeded RNG so runs are repeatable;
+    server.stats counts responses, bytes sent and status codes.
+    """
+    stats = {'responses': 0, 'bytes': 0}
+    handler = type('ConfiguredHandler', (MockWeatherXMHandler,), {
+        'latency': latency, 'error_rate': error_rate, 'throttle_rate': throttle_rate, 'padding': padding,
+        'max_window_hours': max_window_hours, 'max_days': max_days,
+        'rng': random.Random(seed), 'rng_lock': threading.Lock(), 'stats': stats,
+    })
+    server = MockServer(('127.0.0.1', port), handler)
+    server.stats = stats
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/api/v1"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the mock WeatherXM API until interrupted.")
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of history requests that get a 500")
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help="fraction that get a 429")
+    parser.add_argument('--padding', type=int, default=0, help="extra bytes per hourly entry")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-window-hours', type=int, default=0, help="reject longer history windows with a 400")
+    parser.add_argument('--max-days', type=int, default=0, help="truncate responses to this many days")
+    args = parser.parse_args(argv)
+    server, base_url = start_mock_server(args.latency, args.port, args.error_rate, args.throttle_rate,
+                                         args.padding, args.seed, args.max_window_hours, args.max_days)
+    print(f"Mock WeatherXM API at {base_url} (set WXM_API_BASE_URL to use it). Press Ctrl-C to stop.")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
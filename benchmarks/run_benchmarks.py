@@ -0,0 +1,355 @@
+# run_benchmarks.py
+"""Repeatable offline benchmark suite: fetch, flatten, save/load and plotting against the mock API.
+
+Usage: python benchmarks/run_benchmarks.py [--suites fetch,flatten,save_load,plot,rollups,startup] [--quick]
+                                            [--save-baseline] [--tolerance 0.2] [--fail-on-regression]
+
+Every run writes benchmarks/results/latest.json, appends it to history.jsonl and is compared
+with baseline.json (saved with --save-baseline). Metrics are best-of-N wall seconds, lower is better.
+Project modules resolve their data directories from the working directory at import, so the
+suite runs inside a temporary directory and never touches ./data.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import subprocess
+import argparse
+import tempfile
+from datetime import datetime, timedelta, timezone
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from mock_server import start_mock_server, MOCK_DEVICE
+
+# (quick, full) problem sizes
+SIZES = {
+    'fetch_days': (30, 120),
+    'flatten_rows': (100_000, 1_000_000),
+    'store_rows': (50_000, 500_000),
+    'plot_hours': (24 * 365, 24 * 365 * 3),
+    'rollup_days': (31, 92),
+}
+MOCK_LATENCY = 0.02
+MOCK_ERROR_RATE = 0.02
+MOCK_THROTTLE_RATE = 0.02
+SUITES = {}
+
+
+def suite(name):
+    def register(func):
+        SUITES[name] = func
+        return func
+    return register
+
+
+def best_of(func, repeat=3, setup=None):
+    """Runs func `repeat` times and returns (best seconds, last result); setup() runs untimed before each call."""
+    best, result = None, None
+    for _ in range(repeat):
+        args = setup() if setup else ()
+        started = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def configure_environment(workdir, base_url):
+    """Points every module at the mock API and the scratch directory; must run before project imports."""
+    os.chdir(workdir)
+    os.environ.update({
+        'WXM_API_BASE_URL': base_url,
+        'WXM_USERNAME': 'bench@example.com',
+        'WXM_PASSWORD': 'bench',
+        'WXM_API_KEY': '',
+        'DEVICE_ID': MOCK_DEVICE['id'],
+        'STATION_ID': MOCK_DEVICE['name'],
+        'RATE_LIMIT_PER_SECOND': '1000',
+        'RATE_LIMIT_BURST': '100',
+        'BACKOFF_BASE_SECONDS': '0.01',
+        'BACKOFF_MAX_SECONDS': '0.1',
+        'RESPONSE_CACHE_ENABLED': '0',
+        'TEMP_UNIT': 'C', 'WIND_UNIT': 'm/s', 'PRECIP_UNIT': 'mm', 'PRESSURE_UNIT': 'hPa',
+        'MPLBACKEND': 'Agg',
+    })
+
+
+def environment_info():
+    info = {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count()}
+    for module in ['numpy', 'pandas', 'pyarrow', 'matplotlib', 'requests']:
+        try:
+            info[module] = __import__(module).__version__
+        except ImportError:
+            info[module] = None
+    return info
+
+
+@suite('fetch')
+def bench_fetch(size, server, metrics, info):
+    from fetch_weather_data import build_segments, fetch_segments, fetch_weather_data
+    from rate_limiting import get_stats, reset_stats
+    end_date = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    segments = build_segments(end_date - timedelta(days=size['fetch_days']), end_date)
+    for workers in (1, 8):
+        reset_stats()
+        seconds, records = best_of(lambda: fetch_segments('mock-token', MOCK_DEVICE['id'], segments, workers),
+                                   repeat=2)
+        metrics[f'fetch.segments_workers_{workers}'] = seconds
+        info[f'fetch.workers_{workers}'] = {'segments': len(segments), 'records': len(records),
+                                            'retries': get_stats()['retries']}
+    # Whole pipeline once: login, plan, fetch, flatten and write every output
+    started = time.perf_counter()
+    fetch_weather_data(size['fetch_days'] * 24)
+    metrics['fetch.pipeline'] = time.perf_counter() - started
+    info['fetch.mock'] = dict(server.stats)
+
+
+@suite('flatten')
+def bench_flatten(size, server, metrics, info):
+    from bench_flatten import make_records
+    from data_saving import flatten_to_frame
+    records = make_records(size['flatten_rows'])
+    metrics['flatten.flatten_to_frame'], frame = best_of(lambda: flatten_to_frame(records))
+    info['flatten.rows'] = len(frame)
+
+
+@suite('save_load')
+def bench_save_load(size, server, metrics, info):
+    import parquet_storage
+    import raw_archive
+    import sqlite_storage
+    from bench_flatten import make_records
+    from data_saving import flatten_to_frame, CsvWriter, ExcelWriter
+    from data_loading import last_csv_timestamp
+    from unit_conversion import CANONICAL_UNITS
+    records = make_records(size['store_rows'])
+    frame = flatten_to_frame(records)
+    device_id = 'bench-device'
+    scratch = os.path.abspath('save_load')
+
+    def fresh(name):
+        path = os.path.join(scratch, name)
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+        return (path,)
+
+    if parquet_storage.is_available():
+        metrics['store.parquet_append'], _ = best_of(
+            lambda path: parquet_storage.append_records(frame, device_id, base_dir=path), setup=lambda: fresh('pq'))
+        parquet_dir = os.path.join(scratch, 'pq')
+        metrics['store.parquet_read'], _ = best_of(lambda: parquet_storage.read_records(device_id, base_dir=parquet_dir))
+        metrics['store.parquet_last_timestamp'], _ = best_of(
+            lambda: parquet_storage.get_last_timestamp(device_id, base_dir=parquet_dir))
+
+        # Scheduler steady state: one single-hour append per poll, then the month is re-read for rollups.
+        # Compaction keeps the late polls of a month as cheap as the early ones.
+        hours = frame.iloc[:min(len(frame), 24 * 30)]
+        poll_dir = fresh('pq_polls')[0]
+        tick_seconds = []
+        for index in range(len(hours)):
+            started = time.perf_counter()
+            parquet_storage.append_records(hours.iloc[index:index + 1], device_id, base_dir=poll_dir)
+            parquet_storage.read_records(device_id, base_dir=poll_dir, start=hours['timestamp'].iloc[index])
+            tick_seconds.append(time.perf_counter() - started)
+        metrics['store.parquet_poll_tick'] = sum(tick_seconds[-24:]) / len(tick_seconds[-24:])
+        info['store.parquet_poll_files'] = sum(len(files) for _, _, files in os.walk(poll_dir))
+    metrics['store.sqlite_upsert'], _ = best_of(
+        lambda path: sqlite_storage.upsert_records(frame, device_id, path=os.path.join(path, 'w.sqlite3')),
+        setup=lambda: fresh('sqlite'))
+    sqlite_path = os.path.join(scratch, 'sqlite', 'w.sqlite3')
+    metrics['store.sqlite_query'], _ = best_of(lambda: sqlite_storage.query_range(device_id, path=sqlite_path))
+
+    def write_csv(path):
+        writer = CsvWriter(os.path.join(path, 'bench.csv'))
+        writer.write(frame)
+        writer.close()
+    metrics['store.csv_write'], _ = best_of(write_csv, setup=lambda: fresh('csv'))
+    csv_path = os.path.join(scratch, 'csv', 'bench.csv')
+
+    def write_excel(path):
+        writer = ExcelWriter(os.path.join(path, 'bench.xlsx'), units=CANONICAL_UNITS)
+        writer.write(frame)
+        writer.close()
+    metrics['store.excel_write'], _ = best_of(write_excel, setup=lambda: fresh('excel'))
+    metrics['store.csv_last_timestamp'], _ = best_of(lambda: last_csv_timestamp(csv_path))
+    metrics['store.raw_archive_append'], _ = best_of(
+        lambda path: raw_archive.append_records(device_id, records, base_dir=path), setup=lambda: fresh('raw'))
+    raw_dir = os.path.join(scratch, 'raw')
+    metrics['store.raw_archive_read'], _ = best_of(
+        lambda: sum(1 for _ in raw_archive.iter_records(device_id, base_dir=raw_dir)))
+    info['store.rows'] = len(frame)
+
+
+@suite('plot')
+def bench_plot(size, server, metrics, info):
+    import pandas as pd
+    import data_visualization
+    from bench_flatten import make_records
+    from data_saving import flatten_to_frame
+    from unit_conversion import CANONICAL_UNITS
+    frame = flatten_to_frame(make_records(size['plot_hours']))
+    metrics['plot.all_measurements_png'], _ = best_of(
+        lambda: data_visualization.plot_measurements(frame, output='plots/all.png', units=CANONICAL_UNITS), repeat=2)
+    legacy = pd.read_csv(os.path.join(REPO_DIR, 'previous_weather_data.csv')).values.tolist()
+    metrics['plot.precipitation_legacy_png'], _ = best_of(
+        lambda: data_visualization.plot_precipitation(legacy, len(legacy), output='plots/precipitation.png'), repeat=2)
+    info['plot.hours'] = size['plot_hours']
+
+
+@suite('rollups')
+def bench_rollups(size, server, metrics, info):
+    import numpy as np
+    import pandas as pd
+    import rollups
+    import sqlite_storage
+    from weather_schema import MEASUREMENT_COLUMNS
+    # A DST zone, starting before the November clock change, fed one day per update as the fetch does
+    timestamps = pd.date_range('2024-10-15', periods=24 * size['rollup_days'], freq='h', tz='America/New_York')
+    frame = pd.DataFrame({'timestamp': timestamps, 'icon': '',
+                          **{column: np.ones(len(timestamps), dtype='float32') for column in MEASUREMENT_COLUMNS}})
+    device_id = 'bench-dst'
+    sqlite_storage.upsert_records(frame, device_id)
+
+    def update_daily():
+        for start in range(0, len(frame), 24):
+            rollups.update_rollups(frame.iloc[start:start + 24], device_id, 'sqlite')
+    metrics['rollups.update_daily'], _ = best_of(update_daily, repeat=2)
+    incremental = {period: rollups.query_rollups(device_id, period) for period in rollups.PERIODS}
+    metrics['rollups.rebuild'], _ = best_of(lambda: rollups.rebuild_rollups(device_id, 'sqlite'), repeat=2)
+    for period in rollups.PERIODS:
+        rebuilt = rollups.query_rollups(device_id, period)
+        # Every bucket starts at local midnight, once, and incremental updates agree with a rebuild
+        if not rebuilt['label'].is_unique or (rebuilt['bucket_start'].dt.hour != 0).any():
+            raise AssertionError(f"{period} rollup buckets are split around a DST change")
+        pd.testing.assert_frame_equal(incremental[period].reset_index(drop=True), rebuilt.reset_index(drop=True))
+    info['rollups.hours'] = len(frame)
+
+
+def compare(metrics, baseline, tolerance):
+    """Prints each metric against the baseline and returns the names that got slower than tolerance allows."""
+    regressions = []
+    print(f"\n{'metric':<36}{'baseline':>12}{'current':>12}{'change':>10}")
+    for name, seconds in metrics.items():
+        before = baseline.get(name)
+        if before is None:
+            print(f"{name:<36}{'-':>12}{seconds:>11.3f}s{'new':>10}")
+            continue
+        change = seconds / before - 1 if before else 0.0
+        flag = ''
+        if change > tolerance:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print(f"{name:<36}{before:>11.3f}s{seconds:>11.3f}s{change:>+10.1%}{flag}")
+    return regressions
+
+
+def import_times(module, runs=5):
+    """Best cumulative -X importtime seconds for `import module` in a fresh interpreter, plus its slowest imports."""
+    best, slowest = None, []
+    for _ in range(runs):
+        completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', f"import {module}"],
+                                   env={**os.environ, 'PYTHONPATH': REPO_DIR}, capture_output=True, text=True,
+                                   check=True)
+        # Lines look like "import time:  self [us] | cumulative | <indent>name"
+        rows = []
+        for line in completed.stderr.splitlines():
+            parts = line.split('|')
+            if len(parts) == 3 and parts[1].strip().isdigit():
+                rows.append((int(parts[1]), len(parts[2]) - len(parts[2].lstrip()), parts[2].strip()))
+        index = max(i for i, row in enumerate(rows) if row[2] == module)
+        total, depth = rows[index][0] / 1e6, rows[index][1]
+        if best is None or total < best:
+            # A module's imports are listed just before it, one level deeper; those explain where the time goes
+            children = []
+            for cumulative, indent, name in reversed(rows[:index]):
+                if indent <= depth:
+                    break
+                if indent == depth + 2:
+                    children.append((name, cumulative / 1e6))
+            best, slowest = total, sorted(children, key=lambda item: -item[1])[:5]
+    return best, slowest
+
+
+@suite('startup')
+def bench_startup(size, server, metrics, info):
+    # Cron runs pay interpreter start plus imports every time; each command's import cost in isolation
+    for module in ['wxm', 'settings', 'fetch_weather_data', 'excel_export', 'data_visualization']:
+        metrics[f'startup.import_{module}'], info[f'startup.slowest_{module}'] = import_times(module)
+    metrics['startup.wxm_help'], _ = best_of(
+        lambda: subprocess.run([sys.executable, os.path.join(REPO_DIR, 'wxm.py'), '--help'],
+                               capture_output=True, check=True), repeat=5)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the offline benchmark suite against the mock WeatherXM API.")
+    parser.add_argument('--suites', default=','.join(SUITES), help=f"comma-separated ({', '.join(SUITES)})")
+    parser.add_argument('--quick', action='store_true', help="smaller problem sizes")
+    parser.add_argument('--save-baseline', action='store_true', help="store this run as the comparison baseline")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed slowdown before flagging (0.2 = 20%%)")
+    parser.add_argument('--fail-on-regression', action='store_true', help="exit with status 1 on any regression")
+    args = parser.parse_args(argv)
+    names = [name.strip() for name in args.suites.split(',') if name.strip()]
+    unknown = set(names) - set(SUITES)
+    if unknown:
+        parser.error(f"unknown suites: {', '.join(sorted(unknown))}")
+    size = {key: values[0 if args.quick else 1] for key, values in SIZES.items()}
+
+    server, base_url = start_mock_server(MOCK_LATENCY, error_rate=MOCK_ERROR_RATE,
+                                         throttle_rate=MOCK_THROTTLE_RATE, seed=1)
+    workdir = tempfile.mkdtemp(prefix='wxm-bench-')
+    original_cwd = os.getcwd()
+    configure_environment(workdir, base_url)
+    metrics, info = {}, {}
+    try:
+        for name in names:
+            print(f"Running {name}...")
+            started = time.perf_counter()
+            SUITES[name](size, server, metrics, info)
+            print(f"  {name} done in {time.perf_counter() - started:.1f}s")
+    finally:
+        os.chdir(original_cwd)
+        server.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    result = {
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'quick': args.quick,
+        'sizes': size,
+        'environment': environment_info(),
+        'metrics': metrics,
+        'info': info,
+    }
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    with open(os.path.join(RESULTS_DIR, 'latest.json'), 'w') as f:
+        json.dump(result, f, indent=2)
+    with open(os.path.join(RESULTS_DIR, 'history.jsonl'), 'a') as f:
+        f.write(json.dumps(result) + '\n')
+
+    baseline_path = os.path.join(RESULTS_DIR, 'baseline.json')
+    baseline = {}
+    if os.path.exists(baseline_path):
+        with open(baseline_path, 'r') as f:
+            saved = json.load(f)
+        if saved.get('quick') == args.quick:
+            baseline = saved['metrics']
+        else:
+            print("Baseline was recorded with different sizes (--quick); not comparing.")
+    regressions = compare(metrics, baseline, args.tolerance)
+    if args.save_baseline:
+        with open(baseline_path, 'w') as f:
+            json.dump(result, f, indent=2)
+        print(f"Baseline saved to: {baseline_path}")
+    if regressions:
+        print(f"\n{len(regressions)} metric(s) slower than the baseline by more than {args.tolerance:.0%}.")
+    return 1 if regressions and args.fail_on_regression else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,88 @@
+# coverage_index.py
+import os
+import json
+import threading
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timezone
+
+COVERAGE_FILE = os.path.join(os.getcwd(), "data", "coverage_index.json")
+HOUR = 3600
+
+
+def _to_hour(value, round_up=False):
+    """Converts a datetime to a whole number of hours since the epoch."""
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    seconds = value.timestamp()
+    hours = int(seconds // HOUR)
+    if round_up and seconds % HOUR:
+        hours += 1
+    return hours
+
+
+def _from_hour(hours):
+    return datetime.fromtimestamp(hours * HOUR, tz=timezone.utc)
+
+
+class CoverageIndex:
+    """Per-device set of hour ranges already stored, persisted as a JSON sidecar.
+
+    Each device maps to sorted, non-overlapping [start, end) intervals in epoch hours.
+    """
+
+    def __init__(self, path=COVERAGE_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.intervals = {}
+        try:
+            with open(path, 'r') as f:
+                self.intervals = {device: [tuple(span) for span in spans] for device, spans in json.load(f).items()}
+        except (OSError, ValueError):
+            pass
+
+    def has_device(self, device_id):
+        return bool(self.intervals.get(device_id))
+
+    def add(self, device_id, start, end):
+        """Marks the whole hours inside [start, end) as stored."""
+        first, last = _to_hour(start, round_up=True), _to_hour(end)
+        if first >= last:
+            return
+        with self.lock:
+            spans = self.intervals.setdefault(device_id, [])
+            starts = [span[0] for span in spans]
+            # Every span touching [first, last) is absorbed into one merged span
+            lo = bisect_left([span[1] for span in spans], first)
+            hi = bisect_right(starts, last)
+            if lo < hi:
+                first = min(first, spans[lo][0])
+                last = max(last, spans[hi - 1][1])
+            spans[lo:hi] = [(first, last)]
+
+    def missing(self, device_id, start, end):
+        """Returns the (from, to) datetime ranges inside [start, end) that are not stored yet."""
+        gaps = []
+        cursor = start
+        with self.lock:
+            spans = list(self.intervals.get(device_id, []))
+        for span_start, span_end in spans:
+            span_start, span_end = _from_hour(span_start), _from_hour(span_end)
+            if span_end <= cursor:
+                continue
+            if span_start >= end:
+                break
+            if span_start > cursor:
+                gaps.append((cursor, span_start))
+            cursor = max(cursor, span_end)
+        if cursor < end:
+            gaps.append((cursor, end))
+        return gaps
+
+    def save(self):
+        """Atomically writes the index back to disk."""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = f"{self.path}.tmp"
+        with self.lock:
+            with open(temp_path, 'w') as f:
+                json.dump({device: [list(span) for span in spans] for device, spans in self.intervals.items()}, f)
+            os.replace(temp_path, self.path)
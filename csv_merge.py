@@ -0,0 +1,153 @@
+# csv_merge.py
+"""Upserts rows into CSV files kept sorted by timestamp, rewriting only the affected tail.
+
+Rows are ordered by UTC timestamp, then by the other key columns. A new batch is
+located with a binary search over byte offsets, so only the rows from its earliest
+timestamp onwards are read, merged (new rows win) and written back in place. In the
+usual case, where a batch starts after the newest stored hour, that is a plain append.
+"""
+import os
+import csv
+from datetime import datetime, timezone
+import pandas as pd
+
+# Below this many bytes the binary search switches to reading lines one by one
+SCAN_BYTES = 64 * 1024
+
+
+def _epochs(timestamps):
+    """Converts ISO 8601 strings with offsets to epoch seconds."""
+    parsed = pd.to_datetime(pd.Series(timestamps, dtype='string'), utc=True, format='ISO8601')
+    return ((parsed - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(seconds=1)).to_numpy()
+
+
+def _line_epoch(line, timestamp_index):
+    value = next(csv.reader([line.decode('utf-8')]))[timestamp_index]
+    timestamp = datetime.fromisoformat(value)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return int(timestamp.timestamp())
+
+
+def find_offset(f, epoch, data_start, timestamp_index):
+    """Returns the byte offset of the first row at or after epoch in a sorted CSV opened in binary mode."""
+    lo = data_start
+    hi = answer = f.seek(0, os.SEEK_END)
+    # Rows starting before lo are older than epoch; answer is the first row known not to be (or EOF),
+    # and no row starts between hi and answer
+    while hi - lo > SCAN_BYTES:
+        mid = (lo + hi) // 2
+        f.seek(mid - 1)
+        f.readline()
+        line_start = f.tell()
+        line = f.readline()
+        if line_start >= answer or not line.strip():
+            hi = mid
+        elif _line_epoch(line, timestamp_index) < epoch:
+            lo = f.tell()
+        else:
+            answer, hi = line_start, mid
+    f.seek(lo)
+    while f.tell() < min(hi, answer):
+        line_start = f.tell()
+        line = f.readline()
+        if line.strip() and _line_epoch(line, timestamp_index) >= epoch:
+            return line_start
+    return answer
+
+
+def _keyed(lines, key_columns, header, frame=None):
+    """Returns a DataFrame of (epoch, other key columns..., line) for CSV row lines.
+
+    When the lines were just rendered from frame, the keys are taken from it instead of re-parsed.
+    """
+    if frame is not None:
+        keys = pd.DataFrame({column: frame[column].astype(str).to_numpy() for column in key_columns})
+    else:
+        rows = list(csv.reader(lines))
+        keys = pd.DataFrame({column: [row[index] for row in rows]
+                             for column, index in ((column, header.index(column)) for column in key_columns)})
+    keys['timestamp'] = _epochs(keys['timestamp'])
+    keys['line'] = lines
+    return keys
+
+
+def _render(frame, columns):
+    text = frame.to_csv(columns=columns, header=False, index=False, lineterminator='\n')
+    return text.splitlines()
+
+
+def _key_order(key_columns):
+    return ['timestamp'] + [column for column in key_columns if column != 'timestamp']
+
+
+def _merge(existing, new, key_columns):
+    """New rows replace existing ones with the same key; returns (sorted rows, number replaced)."""
+    order = _key_order(key_columns)
+    replaced = len(new[order].merge(existing[order].drop_duplicates(), on=order)) if len(existing) else 0
+    merged = pd.concat([existing, new], ignore_index=True).drop_duplicates(subset=order, keep='last')
+    return merged.sort_values(order, kind='stable'), replaced
+
+
+def upsert_csv(file_path, frame, columns, key_columns=('timestamp',), fill=None):
+    """Upserts frame into file_path and returns (inserted, replaced) row counts.
+
+    frame holds the rows as they should be written (timestamps as ISO 8601 strings).
+    A file whose header is not exactly `columns` (an older layout) is rewritten once
+    in the new layout and order, dropping duplicate rows; `fill` gives values for
+    columns it lacks, e.g. {'device_id': ...}.
+    """
+    key_columns = list(key_columns)
+    if frame.empty:
+        return 0, 0
+    new = _keyed(_render(frame, columns), key_columns, columns, frame)
+    new, _ = _merge(new.iloc[:0], new, key_columns)
+    header = ','.join(columns)
+    if not os.path.exists(file_path) or os.path.getsize(file_path) == 0:
+        directory = os.path.dirname(file_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(file_path, 'w', newline='') as f:
+            f.write('\n'.join([header] + new['line'].tolist()) + '\n')
+        return len(new), 0
+
+    with open(file_path, 'rb') as f:
+        existing_header = f.readline().decode('utf-8').rstrip('\r\n')
+    if existing_header != header:
+        return _rewrite_layout(file_path, new, columns, key_columns, fill or {})
+
+    timestamp_index = columns.index('timestamp')
+    with open(file_path, 'r+b') as f:
+        f.readline()
+        data_start = f.tell()
+        offset = find_offset(f, int(new['timestamp'].iloc[0]), data_start, timestamp_index)
+        f.seek(offset)
+        tail_text = f.read()
+        if tail_text and not tail_text.endswith(b'\n'):
+            # A file cut off mid-row; the partial row is dropped and refetched next run
+            tail_text = tail_text[:tail_text.rfind(b'\n') + 1]
+        tail_lines = [line for line in tail_text.decode('utf-8').splitlines() if line.strip()]
+        existing = _keyed(tail_lines, key_columns, columns) if tail_lines else new.iloc[:0]
+        merged, replaced = _merge(existing, new, key_columns)
+        f.seek(offset)
+        f.write(('\n'.join(merged['line'].tolist()) + '\n').encode('utf-8'))
+        f.truncate()
+    return len(new) - replaced, replaced
+
+
+def _rewrite_layout(file_path, new, columns, key_columns, fill):
+    """Rewrites a file written in another column layout, merged with the new rows."""
+    old = pd.read_csv(file_path, dtype=str, keep_default_na=False)
+    for column, value in fill.items():
+        if column not in old.columns:
+            old[column] = value
+    old = old.reindex(columns=columns, fill_value='')
+    old = old[old['timestamp'] != '']
+    existing = _keyed(_render(old, columns), key_columns, columns, old) if not old.empty else new.iloc[:0]
+    merged, replaced = _merge(existing, new, key_columns)
+    temp_path = f"{file_path}.tmp"
+    with open(temp_path, 'w', newline='') as f:
+        f.write('\n'.join([','.join(columns)] + merged['line'].tolist()) + '\n')
+    os.replace(temp_path, file_path)
+    print(f"Rewrote {file_path} in the current column layout ({len(merged)} rows).")
+    return len(new) - replaced, replaced
@@ -0,0 +1,218 @@
+# csv_migration.py
+"""Bulk import of legacy and exported CSV history into the configured history store.
+
+Each file's layout is recognised from its header (see LAYOUTS). Files are read
+MIGRATION_CHUNK_ROWS rows at a time; every chunk has its timestamps parsed with the
+layout's explicit format, its columns renamed to the schema and converted to the
+canonical units a whole column at a time, and is then upserted through
+data_saving.append_to_history in the station's zone (--tz), which is what the rollups
+record for a station they have not seen before. Memory stays bounded by one chunk whatever the file size.
+"""
+import os
+import sys
+import glob
+import argparse
+from dotenv import load_dotenv
+import numpy as np
+import pandas as pd
+from data_loading import LEGACY_TIMESTAMP_FORMAT, detect_timestamp_format
+from data_saving import CUMULATIVE_CSV, append_to_history, parse_iso_timestamps
+from rollups import history_backend
+from unit_conversion import CANONICAL_UNITS, LEGACY_UNITS, convert_frame, normalize_unit
+from weather_schema import FLAT_COLUMNS, MEASUREMENT_COLUMNS, MEASUREMENT_DTYPE
+
+# Load environment variables
+load_dotenv()
+
+MIGRATION_CHUNK_ROWS = int(os.getenv('MIGRATION_CHUNK_ROWS', '50000'))
+
+# Known CSV layouts, tried in order. 'required' header columns identify a layout, 'columns' maps
+# its headers to schema fields and 'units' gives the units it was written in (--from-units overrides them).
+LAYOUTS = {
+    # data/csv/all_weather_data.csv: every station, canonical units
+    'cumulative': {
+        'required': {'device_id', 'timestamp'},
+        'columns': {},
+        'timestamp_format': 'ISO8601',
+        'units': CANONICAL_UNITS,
+    },
+    # previous_weather_data.csv: capitalised headers, "November 06, 2024 07:00 AM", imperial units, no icon
+    'legacy_export': {
+        'required': {'Timestamp', 'Temperature'},
+        'columns': {'Timestamp': 'timestamp', 'Temperature': 'temperature', 'Humidity': 'humidity',
+                    'Wind Speed': 'wind_speed', 'Precipitation': 'precipitation', 'Pressure': 'pressure'},
+        'timestamp_format': LEGACY_TIMESTAMP_FORMAT,
+        'units': LEGACY_UNITS,
+    },
+    # data/csv/YYYY-MM-DD.csv: one station, canonical units
+    'daily': {
+        'required': {'timestamp'},
+        'columns': {},
+        'timestamp_format': 'ISO8601',
+        'units': CANONICAL_UNITS,
+    },
+}
+
+
+def detect_layout(header_columns):
+    """Returns the name of the first layout whose required columns are all in the header, or None."""
+    header = set(header_columns)
+    for name, layout in LAYOUTS.items():
+        if layout['required'] <= header:
+            return name
+    return None
+
+
+def read_header(file_path):
+    return list(pd.read_csv(file_path, nrows=0).columns)
+
+
+def parse_units(value):
+    """Parses 'temperature=F,wind=mph' into a {quantity: unit} dict."""
+    units = {}
+    for item in filter(None, (part.strip() for part in (value or '').split(','))):
+        quantity, _, unit = item.partition('=')
+        if quantity.strip() not in CANONICAL_UNITS:
+            raise ValueError(f"Unknown quantity: {quantity.strip()!r}")
+        units[quantity.strip()] = normalize_unit(unit)
+    return units
+
+
+def parse_chunk_timestamps(values, fmt, tz='UTC'):
+    """Parses one chunk's timestamp strings with an explicit format into UTC; unparseable values become NaT.
+
+    Naive timestamps (the legacy export) are wall time in tz.
+    """
+    if fmt == 'ISO8601':
+        text = values.astype(str).tolist()
+        try:
+            parsed = parse_iso_timestamps(text)
+        except ValueError:
+            parsed = pd.Series(pd.to_datetime(text, utc=True, format='ISO8601', errors='coerce'))
+        return parsed.set_axis(values.index)
+    parsed = pd.Series(pd.to_datetime(values, format=fmt, errors='coerce'), index=values.index)
+    if parsed.dt.tz is None:
+        try:
+            parsed = parsed.dt.tz_localize(tz, ambiguous='infer', nonexistent='NaT')
+        except Exception:
+            # The repeated hour at a DST change cannot be told apart; drop it rather than guess
+            parsed = parsed.dt.tz_localize(tz, ambiguous='NaT', nonexistent='NaT')
+    return parsed.dt.tz_convert('UTC')
+
+
+def normalize_chunk(chunk, layout, timestamp_format, from_units, tz='UTC'):
+    """Turns one chunk of a layout into a canonical flattened frame (in tz, float32, canonical units)."""
+    chunk = chunk.rename(columns=layout['columns'])
+    chunk = chunk[chunk['timestamp'].notna()]
+    timestamps = parse_chunk_timestamps(chunk['timestamp'], timestamp_format, tz)
+    frame = pd.DataFrame({'timestamp': timestamps.dt.tz_convert(tz)})
+    for column in MEASUREMENT_COLUMNS:
+        if column in chunk.columns:
+            frame[column] = pd.to_numeric(chunk[column], errors='coerce').astype('float64')
+    frame = convert_frame(frame, CANONICAL_UNITS, from_units)
+    for column in MEASUREMENT_COLUMNS:
+        values = frame[column] if column in frame.columns else np.nan
+        frame[column] = pd.Series(values, index=frame.index, dtype=MEASUREMENT_DTYPE)
+    icons = chunk['icon'].fillna('').astype(str) if 'icon' in chunk.columns else ''
+    frame['icon'] = pd.Categorical(pd.Series(icons, index=chunk.index))
+    if 'device_id' in chunk.columns:
+        frame['device_id'] = chunk['device_id'].astype(str)
+    return frame[frame['timestamp'].notna()].reindex(
+        columns=FLAT_COLUMNS + (['device_id'] if 'device_id' in frame.columns else []))
+
+
+def migrate_file(file_path, device_id=None, tz='UTC', from_units=None, chunk_rows=MIGRATION_CHUNK_ROWS,
+                 dry_run=False):
+    """Imports one CSV into the history store and returns (layout, rows read, rows imported).
+
+    device_id is required for layouts without a device_id column; from_units overrides
+    the layout's units for the quantities it names.
+    """
+    header = read_header(file_path)
+    name = detect_layout(header)
+    if name is None:
+        print(f"Skipping {file_path}: unrecognised columns {header}")
+        return None, 0, 0
+    layout = LAYOUTS[name]
+    if 'device_id' not in header and not device_id:
+        raise ValueError(f"{file_path} has no device_id column; pass a device ID for it.")
+    if os.path.abspath(file_path) == os.path.abspath(CUMULATIVE_CSV) and history_backend() is None:
+        print(f"Skipping {file_path}: it already is the history store.")
+        return name, 0, 0
+    units = {**layout['units'], **(from_units or {})}
+    timestamp_column = {target: source for source, target in layout['columns'].items()}.get('timestamp', 'timestamp')
+    dtype = {column: 'string' for column in (timestamp_column, 'device_id', 'icon') if column in header}
+
+    timestamp_format = None
+    read = imported = 0
+    for chunk in pd.read_csv(file_path, chunksize=chunk_rows, dtype=dtype):
+        read += len(chunk)
+        if timestamp_format is None:
+            # Check the declared format against the file's first value once; odd files fall back to detection
+            first = chunk[timestamp_column].dropna()
+            if first.empty:
+                continue
+            detected = detect_timestamp_format(first.iloc[0])
+            timestamp_format = layout['timestamp_format'] if detected in (None, layout['timestamp_format']) \
+                else detected
+        frame = normalize_chunk(chunk, layout, timestamp_format, units, tz)
+        imported += len(frame)
+        if dry_run or frame.empty:
+            continue
+        if 'device_id' in frame.columns:
+            for device, rows in frame.groupby('device_id', sort=False):
+                append_to_history(rows.drop(columns='device_id'), device)
+        else:
+            append_to_history(frame, device_id)
+    skipped = read - imported
+    print(f"{file_path}: {name} layout, {imported} rows {'checked' if dry_run else 'imported'}"
+          + (f", {skipped} skipped (no usable timestamp)" if skipped else ""))
+    return name, read, imported
+
+
+def expand_paths(paths):
+    """Expands directories to the CSV files inside them, in name order."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, '*.csv'))))
+        else:
+            files.append(path)
+    return files
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Import legacy and exported CSV history into the history store.")
+    parser.add_argument('paths', nargs='+', help="CSV files or directories of them")
+    parser.add_argument('--device', default=os.getenv('DEVICE_ID', '').strip('"\''),
+                        help="device ID for files without a device_id column (default: DEVICE_ID)")
+    parser.add_argument('--tz', default='UTC',
+                        help="the station's zone: naive timestamps such as the legacy export's are read in it, "
+                             "and rollups use it for a station seen for the first time")
+    parser.add_argument('--from-units', help="override the source units, e.g. temperature=F,wind=mph")
+    parser.add_argument('--chunk-rows', type=int, default=MIGRATION_CHUNK_ROWS, help="rows read at a time")
+    parser.add_argument('--dry-run', action='store_true', help="detect and convert without writing")
+    args = parser.parse_args(argv)
+    try:
+        from_units = parse_units(args.from_units)
+    except ValueError as e:
+        parser.error(str(e))
+    totals = {'files': 0, 'read': 0, 'imported': 0}
+    for file_path in expand_paths(args.paths):
+        try:
+            layout, read, imported = migrate_file(file_path, args.device, args.tz, from_units, args.chunk_rows,
+                                                  args.dry_run)
+        except (OSError, ValueError) as e:
+            print(f"Could not import {file_path}: {e}")
+            continue
+        if layout:
+            totals['files'] += 1
+            totals['read'] += read
+            totals['imported'] += imported
+    print(f"{totals['files']} file(s), {totals['imported']} of {totals['read']} rows "
+          f"{'checked' if args.dry_run else 'imported'}.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,27 +1,168 @@
+import io
 import os
-import pandas as pd
+import csv
 from datetime import datetime, timedelta, timezone
+import pandas as pd
+import parquet_storage
+import sqlite_storage
+from data_saving import CUMULATIVE_CSV, parse_iso_timestamps
 
 SAVE_LOCATION = os.getenv('FILE_SAVE_LOCATION', os.getcwd())
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'parquet').lower()
+
+# Timestamp layouts found in stored CSVs, tried in order against the first value of a file.
+# The legacy export (previous_weather_data.csv) uses "November 06, 2024 07:00 AM".
+LEGACY_TIMESTAMP_FORMAT = "%B %d, %Y %I:%M %p"
+TIMESTAMP_FORMATS = ["ISO8601", LEGACY_TIMESTAMP_FORMAT]
+TIMESTAMP_COLUMNS = ['timestamp', 'Timestamp']
+# Column dtypes of the legacy export; anything else is left to pandas
+LEGACY_DTYPES = {
+    'Timestamp': 'string',
+    'Temperature': 'float64',
+    'Humidity': 'float64',
+    'Wind Speed': 'float64',
+    'Precipitation': 'float64',
+    'Pressure': 'float64',
+}
+# Bytes read from the end of a CSV when looking for its last timestamp
+TAIL_BYTES = 64 * 1024
+
+
+def detect_timestamp_format(value):
+    """Returns the entry of TIMESTAMP_FORMATS that parses a sample timestamp, or None."""
+    for fmt in TIMESTAMP_FORMATS:
+        try:
+            if fmt == "ISO8601":
+                datetime.fromisoformat(str(value))
+            else:
+                datetime.strptime(str(value), fmt)
+            return fmt
+        except ValueError:
+            continue
+    return None
+
+
+# Function to parse a column of stored timestamps
+def parse_timestamps(values):
+    """Parses timestamp strings into a tz-aware (UTC) Series using one explicit format.
+
+    The format is detected from the first value instead of being inferred row by row.
+    Naive timestamps (the legacy export) are taken as UTC, as before.
+    """
+    values = pd.Series(values).dropna().astype(str)
+    if values.empty:
+        return pd.Series(pd.to_datetime(values, utc=True))
+    fmt = detect_timestamp_format(values.iloc[0])
+    if fmt == "ISO8601":
+        return parse_iso_timestamps(values.tolist())
+    return pd.Series(pd.to_datetime(values, utc=True, format=fmt or 'mixed').to_numpy())
+
+
+def _timestamp_column(columns):
+    for column in TIMESTAMP_COLUMNS:
+        if column in columns:
+            return column
+    return None
+
 
 def load_existing_data(filename="weather_data.csv"):
-    """Loads data from an existing CSV file."""
+    """Loads data from an existing CSV file with declared dtypes and parsed timestamps."""
     try:
         file_path = os.path.join(SAVE_LOCATION, filename)
-        return pd.read_csv(file_path)
+        df = pd.read_csv(file_path, dtype=LEGACY_DTYPES)
     except FileNotFoundError:
         print("No existing data found.")
         return pd.DataFrame()
+    column = _timestamp_column(df.columns)
+    if column and not df.empty:
+        df[column] = parse_timestamps(df[column]).set_axis(df[column].dropna().index).reindex(df.index)
+    return df
+
+
+def _read_tail_lines(file_path, tail_bytes=TAIL_BYTES):
+    """Returns the header line and the complete lines within the last tail_bytes of a file."""
+    with open(file_path, 'rb') as f:
+        header = f.readline()
+        header_end = f.tell()
+        size = f.seek(0, os.SEEK_END)
+        start = max(header_end, size - tail_bytes)
+        f.seek(start)
+        tail = f.read()
+    lines = tail.splitlines()
+    if start > header_end and lines:
+        # The first line is most likely cut in half
+        lines = lines[1:]
+    return header.decode('utf-8'), [line.decode('utf-8') for line in lines if line.strip()]
+
+
+def last_csv_timestamp(file_path, tail_bytes=TAIL_BYTES, device_id=None):
+    """Returns the newest timestamp in a CSV, reading only its first and last rows when it is in time order.
+
+    Files the pipeline writes are chronological, so the tail holds the newest rows.
+    If the first row is newer than the last one (e.g. a reordered export), only the
+    timestamp column of the whole file is read instead. With device_id, a file that has
+    a device_id column (the cumulative CSV) only counts that device's rows.
+    """
+    try:
+        header, lines = _read_tail_lines(file_path, tail_bytes)
+    except FileNotFoundError:
+        return None
+    header_columns = next(csv.reader([header]), [])
+    column = _timestamp_column(header_columns)
+    if column is None or not lines:
+        return None
+    device_id = device_id if device_id and 'device_id' in header_columns else None
+    usecols = [column, 'device_id'] if device_id else [column]
+    dtype = {name: 'string' for name in usecols}
+    tail = pd.read_csv(io.StringIO('\n'.join([header.rstrip('\r\n')] + lines)), usecols=usecols, dtype=dtype)
+    if device_id:
+        tail = tail[tail['device_id'] == device_id]
+        if tail.empty:
+            # The device's rows are further up; read the two key columns of the whole file
+            full = pd.read_csv(file_path, usecols=usecols, dtype=dtype)
+            timestamps = parse_timestamps(full.loc[full['device_id'] == device_id, column])
+            return timestamps.max() if not timestamps.empty else None
+    first = pd.read_csv(file_path, usecols=[column], dtype={column: 'string'}, nrows=1)[column]
+    timestamps = parse_timestamps(pd.concat([first, tail[column]], ignore_index=True))
+    if timestamps.empty:
+        return None
+    if timestamps.iloc[0] > timestamps.iloc[-1]:
+        full = pd.read_csv(file_path, usecols=usecols, dtype=dtype)
+        if device_id:
+            full = full[full['device_id'] == device_id]
+        timestamps = parse_timestamps(full[column])
+    return timestamps.max()
+
+
+def load_last_timestamp(device_id, file_path=CUMULATIVE_CSV):
+    """Returns the newest stored timestamp from the configured history store."""
+    if STORAGE_BACKEND == 'sqlite':
+        return sqlite_storage.get_last_timestamp(device_id)
+    if STORAGE_BACKEND == 'parquet' and parquet_storage.is_available():
+        return parquet_storage.get_last_timestamp(device_id)
+    # The cumulative CSV is the fallback store; it is kept in time order
+    return last_csv_timestamp(file_path, device_id=device_id)
 
 
 def determine_new_data_range(existing_data, requested_hours):
-    """Determines the range of new data to fetch based on existing data."""
-    if existing_data.empty:
-        end_date = datetime.utcnow().replace(tzinfo=timezone.utc)
+    """Determines the range of new data to fetch based on existing data.
+
+    existing_data is either a DataFrame with a timestamp column or the last stored timestamp (or None).
+    """
+    if isinstance(existing_data, pd.DataFrame):
+        column = _timestamp_column(existing_data.columns)
+        if existing_data.empty or column is None:
+            existing_data = None
+        else:
+            timestamps = existing_data[column]
+            if not pd.api.types.is_datetime64_any_dtype(timestamps):
+                timestamps = parse_timestamps(timestamps)
+            existing_data = timestamps.max()
+    end_date = datetime.now(timezone.utc)
+    if existing_data is None or pd.isna(existing_data):
         start_date = end_date - timedelta(hours=requested_hours)
         return start_date, end_date
 
-    last_timestamp = pd.to_datetime(existing_data["Timestamp"].max(), utc=True)
-    end_date = datetime.utcnow().replace(tzinfo=timezone.utc)
+    last_timestamp = pd.to_datetime(existing_data, utc=True)
     start_date = max(last_timestamp, end_date - timedelta(hours=requested_hours))
     return start_date, end_date
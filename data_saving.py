@@ -1,22 +1,37 @@
 # data_saving.py
 
 import os
+import re
 import json
+from operator import itemgetter
+import numpy as np
 import pandas as pd
-import csv
 from datetime import datetime
+import parquet_storage
+import sqlite_storage
+import rollups
+from csv_merge import upsert_csv
+from weather_schema import FLAT_COLUMNS, MEASUREMENT_COLUMNS, MEASUREMENT_DTYPE, ICON_DTYPE, widen_measurements
+from unit_conversion import CANONICAL_UNITS, convert_frame, units_from_settings
 
-# Define base data directories
+# Define base data directories (created by the first write into them, not at import)
 BASE_DIR = os.path.join(os.getcwd(), "data")
 RAW_DIR = os.path.join(BASE_DIR, "raw")
 CSV_DIR = os.path.join(BASE_DIR, "csv")
 EXCEL_DIR = os.path.join(BASE_DIR, "excel")
 CUMULATIVE_CSV = os.path.join(CSV_DIR, "all_weather_data.csv")
-
-# Ensure directories exist
-os.makedirs(RAW_DIR, exist_ok=True)
-os.makedirs(CSV_DIR, exist_ok=True)
-os.makedirs(EXCEL_DIR, exist_ok=True)
+# Field order of the cumulative CSV; rows are unique per (device_id, timestamp) and kept in time order
+CUMULATIVE_COLUMNS = ['device_id'] + FLAT_COLUMNS
+# Where the cumulative history lives: 'parquet' (needs pyarrow), 'sqlite' or 'csv'
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'parquet').lower()
+# Excel output: one sheet per station and month instead of one long sheet, and the rows per sheet
+# (header included) before the export continues on a new one; Excel itself stops at 1,048,576
+EXCEL_SHEET_PER_MONTH = os.getenv('EXCEL_SHEET_PER_MONTH', '0') not in ('0', 'false', 'False', 'no')
+EXCEL_MAX_ROWS = min(int(os.getenv('EXCEL_MAX_ROWS', '1048576')), 1048576)
+# Day zero of Excel's 1900 date system
+EXCEL_EPOCH = pd.Timestamp('1899-12-30')
+# Rows buffered before a streamed batch is appended to the history store (about a month of hours)
+HISTORY_BATCH_ROWS = int(os.getenv('HISTORY_BATCH_ROWS', '744'))
 
 # Function to save raw JSON data
 def save_raw_data(raw_data, filename=None):
@@ -24,30 +39,87 @@ def save_raw_data(raw_data, filename=None):
     if not filename:
         filename = f"{datetime.now().strftime('%Y-%m-%d')}.json"
     file_path = os.path.join(RAW_DIR, filename)
+    os.makedirs(RAW_DIR, exist_ok=True)
     with open(file_path, 'w') as f:
         json.dump(raw_data, f, indent=4)
     print(f"Raw data saved to: {file_path}")
 
-# Function to flatten data for CSV and Excel
-def flatten_data(json_data):
-    """Flattens nested JSON data into tabular format."""
-    flattened = []
+def parse_iso_timestamps(values):
+    """Parses ISO 8601 timestamps with UTC offsets into a tz-aware (UTC) Series.
+
+    The API's fixed-width 'YYYY-MM-DDTHH:MM:SS+HH:MM' form is parsed with NumPy, since
+    there are only a handful of distinct offsets; anything else goes through pandas.
+    """
+    array = np.array(values)
+    if array.dtype.kind != 'U' or len(array) == 0 or not (np.char.str_len(array) == 25).all():
+        return pd.Series(pd.to_datetime(array, utc=True, format='ISO8601'))
+    local = array.astype('U19').astype('datetime64[s]')
+    characters = array.view('U1').reshape(len(array), -1)
+    offsets, offset_index = np.unique(characters[:, 19:].copy().view('U6').ravel(), return_inverse=True)
+    offset_seconds = np.array([
+        (1 if offset[0] == '+' else -1) * (int(offset[1:3]) * 3600 + int(offset[4:6]) * 60) for offset in offsets
+    ])
+    utc = local - offset_seconds[offset_index.ravel()].astype('timedelta64[s]')
+    return pd.Series(utc).dt.tz_localize('UTC')
+
+
+# Reads every measurement of an hourly entry in one C-level call
+_MEASUREMENT_GETTER = itemgetter(*MEASUREMENT_COLUMNS)
+
+
+def _measurement_block(hourly_entries, dtype):
+    """Builds one (rows, measurements) array from the entries in a single pass; missing fields become NaN."""
+    try:
+        rows = list(map(_MEASUREMENT_GETTER, hourly_entries))
+    except KeyError:
+        rows = [tuple(map(entry.get, MEASUREMENT_COLUMNS)) for entry in hourly_entries]
+    try:
+        return np.array(rows, dtype=dtype).reshape(len(rows), len(MEASUREMENT_COLUMNS))
+    except (TypeError, ValueError):
+        # Non-numeric values somewhere: coerce them column by column
+        frame = pd.DataFrame.from_records(rows, columns=MEASUREMENT_COLUMNS, nrows=len(rows))
+        return frame.apply(pd.to_numeric, errors='coerce').to_numpy(dtype=dtype)
+
+
+# Function to flatten data into typed columns
+def flatten_to_frame(json_data, measurement_dtype=MEASUREMENT_DTYPE):
+    """Flattens nested JSON data into a typed DataFrame with one column per schema field.
+
+    Measurements are float32, icon is categorical and timestamp is tz-aware
+    (in the station's timezone when the records agree on one, otherwise UTC).
+    """
+    hourly_entries = []
+    timezones = set()
     for record in json_data:
         # Ensure the 'hourly' key exists
         if 'hourly' in record:
-            for hourly_entry in record['hourly']:
-                flattened.append({
-                    'timestamp': hourly_entry.get('timestamp', None),
-                    'temperature': hourly_entry.get('temperature', None),
-                    'precipitation_accumulated': hourly_entry.get('precipitation_accumulated', None),
-                    'wind_speed': hourly_entry.get('wind_speed', None),
-                    'humidity': hourly_entry.get('humidity', None),
-                    'pressure': hourly_entry.get('pressure', None),
-                    'icon': hourly_entry.get('icon', ''),  # Optional field
-                })
+            hourly_entries.extend(record['hourly'])
+            timezones.add(record.get('tz'))
         else:
             print(f"Skipping record without 'hourly' data: {record}")
-    return flattened
+
+    # All measurements land in one 2-D block, so the frame is built without per-column copies
+    frame = pd.DataFrame(_measurement_block(hourly_entries, measurement_dtype), columns=MEASUREMENT_COLUMNS)
+    timestamps = parse_iso_timestamps([entry.get('timestamp') for entry in hourly_entries])
+    if len(timezones) == 1 and None not in timezones:
+        timestamps = timestamps.dt.tz_convert(timezones.pop())
+    frame.insert(0, 'timestamp', timestamps)
+    frame['icon'] = pd.Series([entry.get('icon') or '' for entry in hourly_entries], dtype=ICON_DTYPE)
+    return frame
+
+
+def format_timestamps(timestamps):
+    """Formats tz-aware timestamps as ISO 8601 strings, e.g. 2024-12-06T00:00:00-05:00."""
+    return timestamps.dt.strftime('%Y-%m-%dT%H:%M:%S%z').str.replace(r'([+-]\d{2})(\d{2})$', r'\1:\2', regex=True)
+
+
+# Function to flatten data for CSV and Excel
+def flatten_data(json_data):
+    """Flattens nested JSON data into a list of row dicts (ISO timestamp strings)."""
+    df = flatten_to_frame(json_data, measurement_dtype='float64')
+    df['timestamp'] = format_timestamps(df['timestamp'])
+    df['icon'] = df['icon'].astype(str)
+    return df.astype(object).where(df.notna(), None).to_dict('records')
 
 # Function to save flattened data to a daily CSV
 def save_to_csv(data, filename=None):
@@ -55,32 +127,271 @@ def save_to_csv(data, filename=None):
     if not filename:
         filename = f"{datetime.now().strftime('%Y-%m-%d')}.csv"
     file_path = os.path.join(CSV_DIR, filename)
-    df = pd.DataFrame(data)
-    df.to_csv(file_path, index=False)
+    df = pd.DataFrame(list(data))
+    if df.empty:
+        return
+    # Schema fields first in their fixed order, then anything extra
+    columns = FLAT_COLUMNS + [column for column in df.columns if column not in FLAT_COLUMNS]
+    upsert_csv(file_path, df.reindex(columns=columns), columns)
     print(f"Flattened data saved to: {file_path}")
 
 # Function to save flattened data to an Excel file
 def save_to_excel(data, filename="weather_data.xlsx"):
-    """Saves weather data to an Excel file in the data/excel directory."""
-    file_path = os.path.join(EXCEL_DIR, filename)
-    df = pd.DataFrame(data)
-    df.to_excel(file_path, index=False)
-    print(f"Flattened data saved to: {file_path}")
+    """Saves weather data to an Excel file in the data/excel directory (streamed, see ExcelWriter)."""
+    df = pd.DataFrame(list(data))
+    if df.empty:
+        return
+    # Keep each row's local wall time from its ISO 8601 string, as the streaming pipeline does
+    df['timestamp'] = pd.to_datetime(df['timestamp'].astype(str).str[:19], format='%Y-%m-%dT%H:%M:%S')
+    for column in MEASUREMENT_COLUMNS:
+        df[column] = pd.to_numeric(df.get(column), errors='coerce')
+    writer = ExcelWriter(filename, units=CANONICAL_UNITS)
+    writer.write(df)
+    writer.close()
+
+# Function to merge data into a cumulative CSV
+def append_to_cumulative_csv(data, device_id=None):
+    """Upserts flattened data (row dicts or a flattened DataFrame) into the cumulative CSV.
 
-# Function to append data to a cumulative CSV
-def append_to_cumulative_csv(data):
-    """Appends flattened data to a cumulative CSV file."""
+    Rows are keyed by (device_id, timestamp), so re-fetching an overlapping window
+    replaces hours instead of duplicating them; only the file's tail is rewritten.
+    """
     file_path = CUMULATIVE_CSV
-    keys = data[0].keys() if data else []
-
-    # Check if the cumulative file exists
-    write_header = not os.path.exists(file_path)
-    with open(file_path, 'a', newline='') as f:
-        writer = csv.DictWriter(f, fieldnames=keys)
-        if write_header:
-            writer.writeheader()
-        writer.writerows(data)
-    print(f"Data appended to cumulative CSV: {file_path}")
+    device_id = device_id or os.getenv('DEVICE_ID', '').strip('"\'')
+    if isinstance(data, pd.DataFrame):
+        frame = widen_measurements(data.assign(timestamp=format_timestamps(data['timestamp'])))
+    else:
+        frame = pd.DataFrame(list(data))
+    if frame.empty:
+        return
+    frame = frame.assign(device_id=device_id).reindex(columns=CUMULATIVE_COLUMNS)
+    inserted, replaced = upsert_csv(file_path, frame, CUMULATIVE_COLUMNS, key_columns=('device_id', 'timestamp'),
+                                    fill={'device_id': device_id})
+    print(f"Cumulative CSV: {inserted} rows added, {replaced} updated: {file_path}")
+
+_parquet_fallback_warned = False
+
+def use_parquet_backend():
+    """Returns True when cumulative history should go to the Parquet store."""
+    global _parquet_fallback_warned
+    if STORAGE_BACKEND != 'parquet':
+        return False
+    if not parquet_storage.is_available():
+        # Once per process, not on every append
+        if not _parquet_fallback_warned:
+            print("pyarrow is not installed; falling back to the cumulative CSV.")
+            _parquet_fallback_warned = True
+        return False
+    return True
+
+# Function to append data to the cumulative history store
+def append_to_history(data, device_id):
+    """Appends flattened data to the configured cumulative store (Parquet, SQLite or CSV).
+
+    Daily/weekly/monthly rollups of the touched buckets are refreshed afterwards (Parquet and SQLite only).
+    """
+    if STORAGE_BACKEND == 'sqlite':
+        count = sqlite_storage.upsert_records(data, device_id)
+        print(f"{count} rows upserted into SQLite store: {sqlite_storage.SQLITE_PATH}")
+        backend = 'sqlite'
+    elif use_parquet_backend():
+        parquet_storage.append_records(data, device_id)
+        backend = 'parquet'
+    else:
+        append_to_cumulative_csv(data, device_id)
+        backend = None
+    if backend and rollups.ROLLUPS_ENABLED:
+        rollups.update_rollups(data, device_id, backend)
+
+# Incremental writers used by the streaming fetch pipeline. Each one accepts
+# a segment at a time through write() so memory stays bounded by one segment.
+# The Excel export is converted to the units chosen in settings.py; the daily CSVs
+# and the history store always keep the API's metric units, so rows merged into them
+# by later runs agree whatever the settings were at the time.
+# Raw records go to raw_archive.RawArchiveWriter.
+class CsvWriter:
+    """Streams flattened DataFrames into a CSV file with a fixed column order.
+
+    Segments are upserted by timestamp, so a second run on the same day merges into
+    that day's file instead of replacing it. Values are written in the canonical units.
+    """
+
+    def __init__(self, filename=None):
+        if not filename:
+            filename = f"{datetime.now().strftime('%Y-%m-%d')}.csv"
+        self.file_path = os.path.join(CSV_DIR, filename)
+        self.inserted = 0
+        self.replaced = 0
+
+    def write(self, frame):
+        if frame.empty:
+            return
+        frame = frame.assign(timestamp=format_timestamps(frame['timestamp']))
+        inserted, replaced = upsert_csv(self.file_path, frame, FLAT_COLUMNS)
+        self.inserted += inserted
+        self.replaced += replaced
+
+    def close(self):
+        if self.inserted or self.replaced:
+            print(f"Flattened data saved to: {self.file_path} ({self.inserted} new, {self.replaced} updated rows)")
+
+
+class ExcelWriter:
+    """Streams flattened DataFrames into an .xlsx workbook with constant memory.
+
+    Rows go straight to xlsxwriter's constant_memory worksheets (falling back to
+    openpyxl's write-only mode when xlsxwriter is not installed), so a year of hours
+    across several stations never sits in memory at once. A sheet that reaches
+    Excel's row limit continues on 'Name (2)', 'Name (3)', ...; with sheet_per_month
+    every station and month gets its own sheet. Each group's rows must arrive in order.
+    """
+
+    def __init__(self, filename="weather_data.xlsx", units=None, sheet_per_month=EXCEL_SHEET_PER_MONTH,
+                 max_rows=EXCEL_MAX_ROWS):
+        self.file_path = os.path.join(EXCEL_DIR, filename)
+        self.units = units or units_from_settings()
+        self.sheet_per_month = sheet_per_month
+        self.max_rows = max_rows
+        self.workbook = None
+        self.backend = None
+        self.sheets = {}
+        self.sheet_names = set()
+        self.rows = 0
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.file_path) or '.', exist_ok=True)
+        try:
+            import xlsxwriter
+        except ImportError:
+            print("xlsxwriter is not installed (pip install xlsxwriter); using openpyxl's write-only mode.")
+            from openpyxl import Workbook
+            self.workbook = Workbook(write_only=True)
+            self.backend = 'openpyxl'
+            return
+        self.workbook = xlsxwriter.Workbook(self.file_path, {'constant_memory': True})
+        self.header_format = self.workbook.add_format({'bold': True})
+        self.date_format = self.workbook.add_format({'num_format': 'yyyy-mm-dd hh:mm'})
+        self.backend = 'xlsxwriter'
+
+    def _sheet_name(self, base, part):
+        # Excel sheet names are at most 31 characters and cannot contain []:*?/\
+        base = re.sub(r'[\[\]:*?/\\]', '_', base).strip("'") or 'Sheet'
+        suffix = f" ({part})" if part > 1 else ''
+        name = base[:31 - len(suffix)] + suffix
+        counter = 1
+        while name.lower() in self.sheet_names:
+            counter += 1
+            extra = f"~{counter}"
+            name = base[:31 - len(suffix) - len(extra)] + extra + suffix
+        self.sheet_names.add(name.lower())
+        return name
+
+    def _new_sheet(self, base, part):
+        name = self._sheet_name(base, part)
+        if self.backend == 'openpyxl':
+            sheet = self.workbook.create_sheet(name)
+            sheet.append(FLAT_COLUMNS)
+            return sheet
+        sheet = self.workbook.add_worksheet(name)
+        sheet.freeze_panes(1, 0)
+        sheet.set_column(0, 0, 17, self.date_format)
+        sheet.set_column(1, len(FLAT_COLUMNS) - 1, 12)
+        sheet.write_row(0, 0, FLAT_COLUMNS, self.header_format)
+        return sheet
+
+    def _append(self, group, base, rows):
+        """Appends rows to the group's current sheet, starting a new one at the row limit."""
+        state = self.sheets.get(group)
+        while rows:
+            if state is None or state['row'] >= self.max_rows:
+                part = state['part'] + 1 if state else 1
+                state = self.sheets[group] = {'sheet': self._new_sheet(base, part), 'row': 1, 'part': part}
+            take = rows[:self.max_rows - state['row']]
+            rows = rows[len(take):]
+            sheet = state['sheet']
+            if self.backend == 'openpyxl':
+                for row in take:
+                    sheet.append(row)
+            else:
+                # Typed writes skip write_row's per-cell type dispatch; empty cells are left out
+                write_number, write_string, last = sheet.write_number, sheet.write_string, len(FLAT_COLUMNS) - 1
+                for row_index, row in enumerate(take, state['row']):
+                    write_number(row_index, 0, row[0], self.date_format)
+                    for column in range(1, last):
+                        if row[column] is not None:
+                            write_number(row_index, column, row[column])
+                    if row[last]:
+                        write_string(row_index, last, row[last])
+            state['row'] += len(take)
+
+    def write(self, frame, label=None):
+        """Writes one frame of flattened rows; label (e.g. the station name) prefixes its sheet names."""
+        if frame.empty:
+            return
+        if self.workbook is None:
+            self._open()
+        # Excel has no timezone support, so write the station-local wall time
+        timestamps = frame['timestamp']
+        if getattr(timestamps.dt, 'tz', None) is not None:
+            timestamps = timestamps.dt.tz_localize(None)
+        values = widen_measurements(convert_frame(frame, self.units))[MEASUREMENT_COLUMNS].to_numpy(dtype='float64')
+        cells = values.astype(object)
+        cells[np.isnan(values)] = None
+        icons = frame['icon'].astype(str).tolist() if 'icon' in frame.columns else [''] * len(frame)
+        if self.backend == 'xlsxwriter':
+            # Excel serial day numbers, computed for the whole frame instead of converting each datetime
+            stamps = ((timestamps - EXCEL_EPOCH) / pd.Timedelta(days=1)).tolist()
+        else:
+            stamps = timestamps.dt.to_pydatetime().tolist()
+        rows = [[timestamp, *measurements, icon] for timestamp, measurements, icon in zip(stamps, cells.tolist(), icons)]
+        if self.sheet_per_month:
+            months = timestamps.dt.strftime('%Y-%m').to_numpy()
+            # Split the frame at month boundaries (rows are in time order)
+            bounds = np.flatnonzero(months[1:] != months[:-1]) + 1
+            for begin, end in zip(np.r_[0, bounds], np.r_[bounds, len(rows)]):
+                month = months[begin]
+                base = f"{label} {month}" if label else month
+                self._append((label, month), base, rows[begin:end])
+        else:
+            self._append((label, None), label or 'Sheet1', rows)
+        self.rows += len(rows)
+
+    def close(self):
+        if self.workbook is None:
+            return
+        if self.backend == 'openpyxl':
+            self.workbook.save(self.file_path)
+        else:
+            self.workbook.close()
+        self.workbook = None
+        print(f"Flattened data saved to: {self.file_path} ({self.rows} rows, {len(self.sheet_names)} sheets)")
+
+
+class HistoryWriter:
+    """Buffers streamed DataFrames and appends them to the history store in batches."""
+
+    def __init__(self, device_id, batch_rows=HISTORY_BATCH_ROWS):
+        self.device_id = device_id
+        self.batch_rows = batch_rows
+        self.pending = []
+        self.pending_rows = 0
+
+    def write(self, frame):
+        if frame.empty:
+            return
+        self.pending.append(frame)
+        self.pending_rows += len(frame)
+        if self.pending_rows >= self.batch_rows:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            append_to_history(pd.concat(self.pending, ignore_index=True), self.device_id)
+            self.pending = []
+            self.pending_rows = 0
+
+    def close(self):
+        self.flush()
 
 # Example Usage
 if __name__ == "__main__":
@@ -1,45 +1,238 @@
-import matplotlib.pyplot as plt
+import os
+import sys
+import argparse
+import numpy as np
 import pandas as pd
 
+# Figures are sized in inches at this DPI; series longer than the plot's pixel width are downsampled to it
+PLOT_WIDTH_INCHES = 10
+PLOT_HEIGHT_INCHES = 5
+PLOT_DPI = int(os.getenv('PLOT_DPI', '100'))
+# Bars get individual value labels only up to this many bars; above it only the peak is annotated
+PLOT_LABEL_THRESHOLD = int(os.getenv('PLOT_LABEL_THRESHOLD', '48'))
+# Windows longer than this are plotted from daily rollups instead of hourly rows
+ROLLUP_PLOT_HOURS = 1440
 
-def plot_precipitation(weather_records, num_hours):
-    # Convert weather_records into a DataFrame for easier manipulation
+# Measurements drawn as bars (amount per interval, summed when downsampling); everything else is a line
+BAR_COLUMNS = {'precipitation'}
+UNIT_LABELS = {
+    'temperature': {'C': '°C', 'F': '°F', 'K': 'K'},
+    'humidity': '%', 'wind_direction': '°', 'uv_index': 'index', 'illuminance': 'lx', 'solar_irradiance': 'W/m²',
+}
+
+
+def lttb(x, y, threshold):
+    """Largest-Triangle-Three-Buckets: indices of `threshold` points that keep the shape of (x, y)."""
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    every = (n - 2) / (threshold - 2)
+    edges = (np.arange(threshold - 1) * every).astype(np.int64) + 1
+    edges[-1] = n - 1
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        next_start, next_end = end, (edges[i + 2] if i + 2 < len(edges) else n)
+        avg_x, avg_y = x[next_start:next_end].mean(), y[next_start:next_end].mean()
+        # Twice the area of the triangle (point a, candidate, next bucket's average) for every candidate
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(area))
+        selected[i + 1] = a
+    return selected
+
+
+def bucket_reduce(values, n_buckets, how='max'):
+    """Reduces values into n_buckets consecutive buckets; returns (bucket start indices, reduced values)."""
+    starts = np.unique(np.linspace(0, len(values), n_buckets + 1).astype(np.int64)[:-1])
+    if how == 'sum':
+        return starts, np.add.reduceat(np.nan_to_num(values), starts)
+    # fmax ignores NaN unless the whole bucket is NaN
+    return starts, np.fmax.reduceat(values, starts)
+
+
+def downsample(timestamps, values, max_points, kind='line'):
+    """Returns (timestamps, values, bar widths or None) with at most about max_points points."""
+    timestamps = np.asarray(timestamps, dtype='datetime64[s]')
+    values = np.asarray(values, dtype='float64')
+    if kind == 'bar':
+        if len(values) <= max_points:
+            step = np.median(np.diff(timestamps)) if len(timestamps) > 1 else np.timedelta64(3600, 's')
+            return timestamps, values, np.full(len(values), step)
+        starts, reduced = bucket_reduce(values, max_points, how='sum')
+        ends = np.append(timestamps[starts[1:]], timestamps[-1] + (timestamps[-1] - timestamps[-2]))
+        return timestamps[starts], reduced, ends - timestamps[starts]
+    keep = ~np.isnan(values)
+    timestamps, values = timestamps[keep], values[keep]
+    indices = lttb(timestamps.astype(np.int64).astype(np.float64), values, max_points)
+    return timestamps[indices], values[indices], None
+
+
+def _new_figure(rows, headless):
+    """Creates a figure; headless figures use the Agg canvas directly and never touch a GUI backend."""
+    figsize = (PLOT_WIDTH_INCHES, PLOT_HEIGHT_INCHES if rows == 1 else 2.2 * rows)
+    if headless:
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        fig = Figure(figsize=figsize, dpi=PLOT_DPI)
+        FigureCanvasAgg(fig)
+    else:
+        import matplotlib.pyplot as plt
+        fig = plt.figure(figsize=figsize, dpi=PLOT_DPI)
+    return fig, fig.subplots(rows, 1, sharex=True, squeeze=False)[:, 0]
+
+
+def _finish(fig, output):
+    fig.tight_layout()
+    if output:
+        directory = os.path.dirname(output)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # The file extension picks the format (png, svg, pdf)
+        fig.savefig(output)
+        print(f"Chart saved to: {output}")
+    else:
+        import matplotlib.pyplot as plt
+        plt.show()
+    return fig
+
+
+def _unit_label(column, units):
+    quantity_label = UNIT_LABELS.get(column)
+    if isinstance(quantity_label, str):
+        return quantity_label
+    from unit_conversion import COLUMN_QUANTITIES, normalize_unit
+    quantity = COLUMN_QUANTITIES.get(column)
+    if quantity is None:
+        return ''
+    unit = normalize_unit(units[quantity])
+    return UNIT_LABELS['temperature'].get(unit, unit) if quantity == 'temperature' else unit
+
+
+def draw_series(ax, timestamps, values, kind='line', title=None, ylabel='', max_points=None, color=None):
+    """Draws one (downsampled) series on ax; bar labels are skipped above PLOT_LABEL_THRESHOLD."""
+    import matplotlib.dates as mdates
+    max_points = max_points or int(ax.figure.get_figwidth() * ax.figure.dpi)
+    x, y, widths = downsample(timestamps, values, max_points, kind)
+    if kind == 'bar':
+        if len(y) <= PLOT_LABEL_THRESHOLD:
+            bars = ax.bar(x, y, width=widths / np.timedelta64(1, 'D'), align='edge', color=color or 'blue')
+            ax.bar_label(bars, fmt='%g', fontsize=7)
+        elif len(y):
+            # One collection of rectangles instead of one Rectangle artist per bar
+            from matplotlib.collections import PolyCollection
+            left = mdates.date2num(x)
+            right = left + widths / np.timedelta64(1, 'D')
+            top = np.nan_to_num(y)
+            verts = np.stack([np.column_stack([left, np.zeros_like(top)]), np.column_stack([left, top]),
+                              np.column_stack([right, top]), np.column_stack([right, np.zeros_like(top)])], axis=1)
+            ax.add_collection(PolyCollection(verts, facecolors=color or 'blue', edgecolors='none'))
+            ax.xaxis_date()
+            ax.set_xlim(left.min(), right.max())
+            peak = int(np.argmax(top))
+            if top[peak] > 0:
+                ax.annotate(f"max {y[peak]:g}", (left[peak], y[peak]), xytext=(0, 3), textcoords='offset points',
+                            ha='center', fontsize=8)
+        highest = np.nan_to_num(y).max() if len(y) else 0
+        if highest > 0:
+            ax.set_ylim(0, highest * 1.25)
+    else:
+        ax.plot(x, y, linewidth=1, color=color)
+    locator = mdates.AutoDateLocator()
+    ax.xaxis.set_major_locator(locator)
+    ax.xaxis.set_major_formatter(mdates.ConciseDateFormatter(locator))
+    if title:
+        ax.set_title(title, fontsize=10)
+    ax.set_ylabel(ylabel)
+
+
+def plot_precipitation(weather_records, num_hours, output=None):
+    """Bar chart of precipitation (inches) from legacy-format records; saved headless when output is a path."""
+    from data_loading import parse_timestamps
     df = pd.DataFrame(weather_records,
                       columns=["Timestamp", "Temperature", "Humidity", "Wind Speed", "Precipitation", "Pressure"])
+    timestamps = parse_timestamps(df['Timestamp']).dt.tz_localize(None)
+    precipitation = pd.to_numeric(df['Precipitation'], errors='coerce').to_numpy()[df['Timestamp'].notna().to_numpy()]
+    order = np.argsort(timestamps.to_numpy(), kind='stable')
 
-    # Convert the Timestamp column to datetime
-    df['Timestamp'] = pd.to_datetime(df['Timestamp'])
-    df['Precipitation'] = pd.to_numeric(df['Precipitation'], errors='coerce')
+    fig, (ax,) = _new_figure(1, headless=bool(output))
+    draw_series(ax, timestamps.to_numpy()[order], precipitation[order], kind='bar',
+                title=f'Precipitation Data (last {num_hours} hours)', ylabel='Precipitation (inches)')
+    ax.set_xlabel('Date')
+    return _finish(fig, output)
 
-    # Set the Timestamp as the index
-    df.set_index('Timestamp', inplace=True)
 
-    # Plotting
-    plt.figure(figsize=(10, 5))
+def plot_measurements(frame, columns=None, output=None, units=None, title=None):
+    """One panel per measurement for a flattened (canonical-unit) DataFrame, converted to `units`.
 
-    # Determine the x-axis labeling
-    if num_hours > 1440:  # More than 60 days
-        # Set monthly ticks
-        ax = plt.gca()  # Get current axes
-        ax.xaxis.set_major_locator(plt.MaxNLocator(integer=True))  # Automatically manage ticks
-        plt.xticks(pd.date_range(start=df.index.min(), end=df.index.max(), freq='MS'),
-                   rotation=45)  # 'MS' means month start
-    else:
-        # Set daily ticks
-        plt.xticks(rotation=45)
+    columns defaults to every measurement with data; units defaults to the settings.py preferences.
+    """
+    from unit_conversion import convert_frame, units_from_settings
+    from weather_schema import MEASUREMENT_COLUMNS
+    units = units or units_from_settings()
+    if columns is None:
+        columns = [column for column in MEASUREMENT_COLUMNS if column in frame and frame[column].notna().any()]
+    if not columns:
+        print("Nothing to plot.")
+        return None
+    frame = convert_frame(frame, units)
+    timestamps = frame['timestamp']
+    if isinstance(timestamps.dtype, pd.DatetimeTZDtype):
+        # Matplotlib draws wall-clock time; keep the station's local time
+        timestamps = timestamps.dt.tz_localize(None)
+    timestamps = timestamps.to_numpy()
+    fig, axes = _new_figure(len(columns), headless=bool(output))
+    for ax, column in zip(axes, columns):
+        kind = 'bar' if column in BAR_COLUMNS else 'line'
+        draw_series(ax, timestamps, frame[column].to_numpy(dtype='float64'), kind=kind,
+                    title=column.replace('_', ' ').capitalize(), ylabel=_unit_label(column, units))
+    if title:
+        fig.suptitle(title)
+    return _finish(fig, output)
+
+
+def plot_device_history(device_id, hours, columns=None, output=None, units=None):
+    """Plots a device's stored history; windows over ROLLUP_PLOT_HOURS read daily rollups instead of hourly rows."""
+    import rollups
+    from datetime import datetime, timedelta, timezone
+    end = datetime.now(timezone.utc)
+    start = end - timedelta(hours=hours)
+    backend = rollups.history_backend()
+    if backend is None:
+        print("Plotting stored history needs the Parquet or SQLite backend.")
+        return None
+    if hours > ROLLUP_PLOT_HOURS:
+        daily = rollups.query_rollups(device_id, 'day', start, end)
+        if not daily.empty:
+            # Precipitation bars show daily totals, every other measurement its daily mean
+            frame = pd.DataFrame({'timestamp': daily['bucket_start']})
+            for column in rollups.MEASUREMENT_COLUMNS:
+                stat = 'sum' if column in BAR_COLUMNS else 'mean'
+                frame[column] = daily[f"{column}_{stat}"]
+            return plot_measurements(frame, columns, output, units, title=f"{device_id}: daily, last {hours} hours")
+    frame = rollups.read_hours(device_id, start, end, backend)
+    if frame.empty:
+        print("No stored data in that window.")
+        return None
+    return plot_measurements(frame, columns, output, units, title=f"{device_id}: last {hours} hours")
 
-    plt.bar(df.index, df['Precipitation'], color='blue')
-    plt.title('Precipitation Data')
-    plt.xlabel('Date')
-    plt.ylabel('Precipitation (inches)')
 
-    # Set y-axis limit
-    max_y = df['Precipitation'].max() * 1.25  # 25% higher than max
-    plt.ylim(0, max_y)
+def main(argv=None):
+    from dotenv import load_dotenv
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Chart a station's stored weather history.")
+    parser.add_argument('--device', default=os.getenv('DEVICE_ID', '').strip('"\''),
+                        help="device ID (default: DEVICE_ID)")
+    parser.add_argument('--hours', type=int, default=168, help="hours of history to plot")
+    parser.add_argument('--columns', help="comma-separated measurements (default: every one with data)")
+    parser.add_argument('--output', help="save to this file (png, svg or pdf) instead of opening a window")
+    args = parser.parse_args(argv)
+    if not args.device:
+        parser.error("no device: pass --device or set DEVICE_ID")
+    columns = args.columns.split(',') if args.columns else None
+    plot_device_history(args.device, args.hours, columns, args.output)
 
-    # Show data labels
-    for i, v in enumerate(df['Precipitation']):
-        plt.text(df.index[i], v + 0.1, str(v), ha='center', va='bottom')
 
-    plt.tight_layout()  # Adjust layout to prevent clipping of tick-labels
-    plt.show()
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,114 @@
+# excel_export.py
+"""Exports stored hourly history for one or more stations to a single Excel workbook.
+
+History is read one calendar month per station at a time and streamed through
+data_saving.ExcelWriter, so memory stays bounded by a month of hours however long
+the range is. Timestamps are written as station-local wall time when the station's
+zone is known (from the rollups), else as UTC.
+"""
+import os
+import sys
+import argparse
+from datetime import datetime, timezone
+from dotenv import load_dotenv
+import pandas as pd
+import parquet_storage
+import rollups
+import sqlite_storage
+from data_saving import CUMULATIVE_CSV, EXCEL_SHEET_PER_MONTH, ExcelWriter, parse_iso_timestamps
+from weather_schema import FLAT_COLUMNS, MEASUREMENT_COLUMNS
+
+# Load environment variables
+load_dotenv()
+
+# Rows read at a time from the cumulative CSV when there is no Parquet or SQLite store
+CSV_CHUNK_ROWS = 100_000
+
+
+def _utc(value):
+    timestamp = pd.Timestamp(value)
+    return timestamp.tz_convert('UTC') if timestamp.tzinfo else timestamp.tz_localize('UTC')
+
+
+def month_ranges(start, end):
+    """Splits [start, end) into [from, to) pieces at UTC month boundaries."""
+    boundaries = pd.date_range(start.normalize().replace(day=1), end, freq='MS', tz='UTC')
+    edges = [start] + [boundary for boundary in boundaries if start < boundary < end] + [end]
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def iter_history(device_id, start, end, backend):
+    """Yields one station's stored hours in [start, end) as canonical flattened frames (UTC), month by month."""
+    if backend is None:
+        yield from _iter_csv_history(device_id, start, end)
+        return
+    for month_start, month_end in month_ranges(start, end):
+        if backend == 'sqlite':
+            frame = sqlite_storage.query_range(device_id, month_start, month_end,
+                                               columns=MEASUREMENT_COLUMNS + ['icon'])
+        else:
+            frame = parquet_storage.read_records(device_id, columns=FLAT_COLUMNS, start=month_start, end=month_end)
+        if not frame.empty:
+            yield frame
+
+
+def _iter_csv_history(device_id, start, end, file_path=CUMULATIVE_CSV):
+    # The cumulative CSV holds every station in time order, so it is read in chunks and filtered
+    if not os.path.exists(file_path):
+        return
+    for chunk in pd.read_csv(file_path, chunksize=CSV_CHUNK_ROWS, dtype={'device_id': str, 'icon': str}):
+        if 'device_id' in chunk.columns:
+            chunk = chunk[chunk['device_id'] == device_id]
+        if chunk.empty:
+            continue
+        timestamps = parse_iso_timestamps(chunk['timestamp'].astype(str).tolist())
+        timestamps.index = chunk.index
+        chunk = chunk.assign(timestamp=timestamps)
+        chunk = chunk[(chunk['timestamp'] >= start) & (chunk['timestamp'] < end)]
+        if not chunk.empty:
+            yield chunk.reindex(columns=FLAT_COLUMNS)
+
+
+def export_history(device_ids, start, end=None, filename=None, units=None, sheet_per_month=EXCEL_SHEET_PER_MONTH,
+                   tz=None, backend=None):
+    """Writes [start, end) of every station's stored history into one workbook and returns its path.
+
+    Each station gets its own sheets, labelled with its device ID. tz overrides the
+    per-station zone; backend defaults to the configured history store.
+    """
+    start = _utc(start)
+    end = _utc(end) if end is not None else pd.Timestamp(datetime.now(timezone.utc))
+    backend = backend or rollups.history_backend()
+    if not filename:
+        filename = f"weather_history_{start:%Y%m%d}_{end:%Y%m%d}.xlsx"
+    writer = ExcelWriter(filename, units=units, sheet_per_month=sheet_per_month)
+    for device_id in device_ids:
+        zone = tz or rollups.stored_timezone(device_id) or 'UTC'
+        rows = 0
+        for frame in iter_history(device_id, start, end, backend):
+            writer.write(frame.assign(timestamp=frame['timestamp'].dt.tz_convert(zone)), label=device_id)
+            rows += len(frame)
+        print(f"{device_id}: {rows} rows exported ({zone}).")
+    writer.close()
+    return writer.file_path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export stored weather history to Excel with constant memory.")
+    parser.add_argument('--devices', default=os.getenv('DEVICE_ID', ''),
+                        help="comma-separated device IDs (default: DEVICE_ID)")
+    parser.add_argument('--start', required=True, help="first day to export (YYYY-MM-DD, UTC)")
+    parser.add_argument('--end', help="day to stop at, exclusive (YYYY-MM-DD, UTC; default: now)")
+    parser.add_argument('--output', help="workbook name inside data/excel")
+    parser.add_argument('--sheet-per-month', action='store_true', default=EXCEL_SHEET_PER_MONTH,
+                        help="one sheet per station and month")
+    parser.add_argument('--tz', help="write timestamps in this zone instead of each station's own")
+    args = parser.parse_args(argv)
+    device_ids = [device_id.strip().strip('"\'') for device_id in args.devices.split(',') if device_id.strip()]
+    if not device_ids:
+        parser.error("no devices: pass --devices or set DEVICE_ID")
+    export_history(device_ids, args.start, args.end, args.output, sheet_per_month=args.sheet_per_month, tz=args.tz)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,49 +1,350 @@
 import os
+import sys
+import argparse
+import requests
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-from datetime import timedelta
-from data_loading import load_existing_data, determine_new_data_range
+from datetime import datetime, timedelta, timezone
+from coverage_index import CoverageIndex
 from api_manager import initialize_api, fetch_data_segment
-from data_saving import save_to_csv, save_to_excel, save_raw_data, flatten_data
+from raw_archive import RawArchiveWriter
+from rate_limiting import get_stats, record_stat
+from metrics import metrics, timer, profile_run, METRICS_REPORT
+from response_cache import response_cache
+from segment_sizing import (segment_limits, segment_span_hours, truncated_until, MIN_SEGMENT_HOURS,
+                            SIZE_ERROR_STATUS_CODES)
 
 # Load environment variables
 load_dotenv()
 
-DEFAULT_HOURS_HISTORY = int(os.getenv('HOURS_OF_HISTORY', '24'))
-
-def fetch_weather_data(requested_hours=DEFAULT_HOURS_HISTORY):
-    """Fetches and saves weather data."""
-    # Initialize API credentials
-    api_key, device_id = initialize_api()
+# data_loading and data_saving pull in pandas (about half a second), so they are imported inside the
+# functions that need them: other commands importing this module, or a run with nothing new, skip it
 
-    # Load existing data
-    existing_data = load_existing_data()
+DEFAULT_HOURS_HISTORY = int(os.getenv('HOURS_OF_HISTORY', '24'))
+# Segment size when adaptive sizing is off; otherwise the learned size in data/segment_limits.json is used
+SEGMENT_HOURS = 24
+# Number of history segments requested in parallel (1 = fetch serially)
+MAX_CONCURRENT_REQUESTS = int(os.getenv('MAX_CONCURRENT_REQUESTS', '8'))
+# Hours this recent are refetched on the next run because the API may still be filling them in
+COVERAGE_SETTLE_HOURS = int(os.getenv('COVERAGE_SETTLE_HOURS', '1'))
+# A segment that came back with no hours at all (station offline, or the API not caught up yet) is only
+# marked as stored once it is this old, so a temporarily empty window is fetched again
+COVERAGE_EMPTY_SETTLE_HOURS = int(os.getenv('COVERAGE_EMPTY_SETTLE_HOURS', '48'))
 
-    # Determine range of new data to fetch
-    start_date, end_date = determine_new_data_range(existing_data, requested_hours)
-    print(f"Fetching data from {start_date} to {end_date}")
 
-    # Fetch data in hourly segments
-    all_records = []
+def build_segments(start_date, end_date, segment_hours=SEGMENT_HOURS):
+    """Splits the requested window into consecutive (from, to) segments."""
+    segments = []
     while start_date < end_date:
-        segment_end_date = min(start_date + timedelta(hours=24), end_date)
-        records = fetch_data_segment(api_key, device_id, start_date, segment_end_date)
-        all_records.extend(records)
+        segment_end_date = min(start_date + timedelta(hours=segment_hours), end_date)
+        segments.append((start_date, segment_end_date))
         start_date = segment_end_date
+    return segments
+
 
-    # Save new data
-    if all_records:
-        # Save raw data for debugging or reprocessing purposes
-        save_raw_data(all_records)
+def segment_hours_for(device_id, limits=segment_limits):
+    """Segment size to plan a device's requests with."""
+    return limits.hours(device_id) if limits is not None else SEGMENT_HOURS
 
-        # Flatten the aggregated data for tabular storage
-        flattened_data = flatten_data(all_records)
 
-        # Save flattened data to CSV and Excel
-        save_to_csv(flattened_data)
-        save_to_excel(flattened_data)
+def fetch_adaptive(api_key, device_id, segment, limits=segment_limits):
+    """Fetches one segment, splitting it when its size looks like the problem.
 
+    A segment larger than the device's known-good size is halved on any error; one at or
+    below it only on statuses that reject the window itself. A truncated response is
+    completed with a follow-up request for the rest. Outcomes feed the learned limit.
+    Raises RequestException when the segment cannot be fetched.
+    """
+    if limits is None:
+        return fetch_data_segment(api_key, device_id, *segment, raise_errors=True)
+    start, end = segment
+    hours = segment_span_hours(segment)
+    try:
+        records = fetch_data_segment(api_key, device_id, start, end, raise_errors=True)
+    except requests.exceptions.RequestException as e:
+        status = getattr(e.response, 'status_code', None)
+        if hours <= MIN_SEGMENT_HOURS or (hours <= limits.hours(device_id) and status not in SIZE_ERROR_STATUS_CODES):
+            raise
+        limits.failed(device_id, hours)
+        # The halves stand in for this request, so it no longer counts as a lost segment
+        record_stat('failed_segments', -1)
+        record_stat('split_segments')
+        middle = start + timedelta(hours=hours // 2)
+        print(f"{hours}-hour request from {start} failed; retrying as two smaller requests")
+        return (fetch_adaptive(api_key, device_id, (start, middle), limits)
+                + fetch_adaptive(api_key, device_id, (middle, end), limits))
+    resume_at = truncated_until(records, start, end)
+    if resume_at is None:
+        limits.succeeded(device_id, hours)
+        return records
+    rest = fetch_adaptive(api_key, device_id, (resume_at, end), limits)
+    # Only count it as a size limit when the follow-up found the hours the first response left out
+    if any(record.get('hourly') for record in rest):
+        limits.failed(device_id, hours)
     else:
+        limits.succeeded(device_id, hours)
+    return records + rest
+
+
+def iter_segment_results(api_key, device_id, segments, max_workers=MAX_CONCURRENT_REQUESTS):
+    """Fetches segments concurrently and yields (segment, records) in segment order.
+
+    records is None when the fetch failed. At most 2 * max_workers segments are in
+    flight or waiting to be consumed, so memory does not grow with the window size.
+    """
+    def fetch(segment):
+        try:
+            return fetch_adaptive(api_key, device_id, segment)
+        except requests.exceptions.RequestException:
+            return None
+
+    if max_workers <= 1 or len(segments) <= 1:
+        for segment in segments:
+            yield segment, fetch(segment)
+        return
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(segments))) as executor:
+        pending = deque()
+        try:
+            for segment in segments:
+                pending.append((segment, executor.submit(fetch, segment)))
+                if len(pending) >= 2 * max_workers:
+                    segment, future = pending.popleft()
+                    yield segment, future.result()
+            while pending:
+                segment, future = pending.popleft()
+                yield segment, future.result()
+        finally:
+            # If the consumer stops early (Ctrl-C, error), drop queued requests instead of waiting on them
+            for _, future in pending:
+                future.cancel()
+
+
+def merge_segments(segments):
+    """Joins back-to-back segments into contiguous (from, to) windows."""
+    windows = []
+    for start, end in segments:
+        if windows and windows[-1][1] == start:
+            windows[-1] = (windows[-1][0], end)
+        else:
+            windows.append((start, end))
+    return windows
+
+
+def iter_window_results(api_key, device_id, segments, max_workers=MAX_CONCURRENT_REQUESTS, limits=segment_limits):
+    """Like iter_segment_results, but re-plans the segments at the device's learned size first.
+
+    While the limit can still grow, the start of the window is fetched one request at a
+    time with larger and larger segments; the rest then goes out concurrently at the size
+    learned. Yields (segment, records) for the segments actually requested.
+    """
+    if limits is None:
+        yield from iter_segment_results(api_key, device_id, segments, max_workers)
+        return
+    windows = merge_segments(segments)
+    while windows and limits.can_grow(device_id):
+        start, end = windows[0]
+        if end - start <= timedelta(hours=limits.hours(device_id)):
+            break
+        probe = (start, min(end, start + timedelta(hours=limits.probe_hours(device_id))))
+        try:
+            records = fetch_adaptive(api_key, device_id, probe, limits)
+        except requests.exceptions.RequestException:
+            records = None
+        yield probe, records
+        if probe[1] == end:
+            windows.pop(0)
+        else:
+            windows[0] = (probe[1], end)
+        if records is None:
+            break
+    hours = limits.hours(device_id)
+    rest = [segment for window in windows for segment in build_segments(*window, segment_hours=hours)]
+    yield from iter_segment_results(api_key, device_id, rest, max_workers)
+
+
+def learn_segment_limit(api_key, device_id, start_date, end_date, limits=segment_limits):
+    """Probes growing segment sizes from start_date until the device's limit is known; returns it.
+
+    The probe responses are not stored. Used to size a long backfill before it is planned.
+    """
+    if limits is None:
+        return SEGMENT_HOURS
+    probe_start = start_date
+    while limits.can_grow(device_id):
+        probe_end = probe_start + timedelta(hours=limits.probe_hours(device_id))
+        if probe_end > end_date:
+            break
+        try:
+            fetch_adaptive(api_key, device_id, (probe_start, probe_end), limits)
+        except requests.exceptions.RequestException:
+            break
+    return limits.hours(device_id)
+
+
+def fetch_segment_results(api_key, device_id, segments, max_workers=MAX_CONCURRENT_REQUESTS):
+    """Returns one entry per segment, in segment order: its records, or None if the fetch failed."""
+    return [records for _, records in iter_segment_results(api_key, device_id, segments, max_workers)]
+
+
+def fetch_segments(api_key, device_id, segments, max_workers=MAX_CONCURRENT_REQUESTS):
+    """Fetches every segment concurrently and returns all records in segment order."""
+    all_records = []
+    for records in fetch_segment_results(api_key, device_id, segments, max_workers):
+        all_records.extend(records or [])
+    return all_records
+
+
+def floor_to_hour(value):
+    return value.replace(minute=0, second=0, microsecond=0)
+
+
+def plan_segments(coverage, device_id, requested_hours):
+    """Builds hour-aligned segments covering only the hours of the window that are not stored yet."""
+    segment_hours = segment_hours_for(device_id)
+    if not coverage.has_device(device_id):
+        # No coverage recorded yet: fall back to resuming after the newest stored timestamp
+        from data_loading import load_last_timestamp, determine_new_data_range
+        start_date, end_date = determine_new_data_range(load_last_timestamp(device_id), requested_hours)
+        return build_segments(floor_to_hour(start_date), end_date, segment_hours)
+    end_date = datetime.now(timezone.utc)
+    segments = []
+    window_start = floor_to_hour(end_date - timedelta(hours=requested_hours))
+    for gap_start, gap_end in coverage.missing(device_id, window_start, end_date):
+        segments.extend(build_segments(gap_start, gap_end, segment_hours))
+    return segments
+
+
+def has_hours(records):
+    """Returns True when fetched records contain at least one hourly entry."""
+    return any(record.get('hourly') for record in records)
+
+
+def record_coverage(coverage, device_id, fetched_segments, empty_segments=()):
+    """Marks successfully fetched segments as stored, excluding hours that may still be filling in.
+
+    empty_segments returned no hours; they count as stored only once older than COVERAGE_EMPTY_SETTLE_HOURS.
+    """
+    now = floor_to_hour(datetime.now(timezone.utc))
+    for segments, settle_hours in ((fetched_segments, COVERAGE_SETTLE_HOURS),
+                                   (empty_segments, COVERAGE_EMPTY_SETTLE_HOURS)):
+        settled_until = now - timedelta(hours=settle_hours)
+        for start, end in segments:
+            coverage.add(device_id, start, min(end, settled_until))
+    coverage.save()
+
+
+def report_fetch_stats():
+    """Prints retry/throttle and response cache counters so lost segments are never silent."""
+    stats = get_stats()
+    if stats['retries'] or stats['failed_segments']:
+        print(f"Requests: {stats['requests']}, retries: {stats['retries']}, "
+              f"throttled: {stats['throttled_responses']} ({stats['throttled_seconds']:.1f}s waiting), "
+              f"failed segments: {stats['failed_segments']}")
+    if stats['split_segments']:
+        print(f"Split {stats['split_segments']} oversized request(s); "
+              f"learned segment size is kept in {segment_limits.path}")
+    if stats['failed_segments']:
+        print("Warning: some segments could not be fetched; rerun to fill the gaps.")
+    if response_cache is not None:
+        cache_stats = response_cache.get_stats()
+        if cache_stats['hits'] + cache_stats['misses']:
+            print(f"Response cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses "
+                  f"({cache_stats['hit_rate']:.0%} hit rate), {cache_stats['evictions']} evictions")
+    # Per-stage timings (see metrics.py)
+    if METRICS_REPORT:
+        metrics.report()
+    metrics_path = metrics.export()
+    if metrics_path:
+        print(f"Metrics written to: {metrics_path}")
+
+
+def create_writers(device_id, file_prefix=''):
+    """Opens the raw, daily CSV, Excel and history writers for one device's run."""
+    from data_saving import CsvWriter, ExcelWriter, HistoryWriter
+    started = datetime.now()
+    raw_writer = RawArchiveWriter(device_id)
+    # The daily CSV is upserted, so runs on the same day merge into it; a workbook cannot be appended
+    # to in constant-memory mode, so each run writes its own (wxm export rebuilds any range from the store)
+    row_writers = [CsvWriter(f"{file_prefix}{started:%Y-%m-%d}.csv"),
+                   ExcelWriter(f"{file_prefix}weather_data_{started:%Y-%m-%d_%H%M%S}.xlsx"),
+                   HistoryWriter(device_id)]
+    return raw_writer, row_writers
+
+
+def write_segment(records, raw_writer, row_writers):
+    """Writes one fetched segment to every output and returns its record count."""
+    if not records:
+        return 0
+    # Archive raw data for debugging or reprocessing purposes
+    with timer('write.RawArchiveWriter', records=len(records)):
+        raw_writer.write(records)
+    # Flatten the segment for tabular storage (daily CSV, Excel and cumulative history)
+    from data_saving import flatten_to_frame
+    with timer('flatten', records=len(records)) as fields:
+        frame = flatten_to_frame(records)
+        fields['rows'] = len(frame)
+    for writer in row_writers:
+        with timer(f"write.{type(writer).__name__}", rows=len(frame)):
+            writer.write(frame)
+    return len(records)
+
+
+def close_writers(raw_writer, row_writers):
+    for writer in [raw_writer] + row_writers:
+        # Closing flushes buffered rows (history batches, the Excel workbook), so it is timed too
+        with timer(f"close.{type(writer).__name__}"):
+            writer.close()
+
+
+def fetch_weather_data(requested_hours=DEFAULT_HOURS_HISTORY, max_workers=MAX_CONCURRENT_REQUESTS):
+    """Fetches and saves weather data."""
+    # Initialize API credentials
+    with timer('initialize_api'):
+        api_key, device_id = initialize_api()
+
+    # Work out which hours of the window are not stored yet
+    coverage = CoverageIndex()
+    with timer('plan_segments') as fields:
+        segments = plan_segments(coverage, device_id, requested_hours)
+        fields['segments'] = len(segments)
+    if not segments:
+        print("All requested hours are already stored.")
+        return
+    print(f"Fetching {len(segments)} segment(s) from {segments[0][0]} to {segments[-1][1]}")
+
+    # Stream each segment through fetch -> flatten -> write so only one segment is held in memory
+    fetched_segments, empty_segments = [], []
+    record_count = 0
+    raw_writer, row_writers = create_writers(device_id)
+    with timer('fetch_run', segments=len(segments)) as fields:
+        try:
+            for segment, records in iter_window_results(api_key, device_id, segments, max_workers):
+                if records is None:
+                    continue
+                (fetched_segments if has_hours(records) else empty_segments).append(segment)
+                record_count += write_segment(records, raw_writer, row_writers)
+        finally:
+            close_writers(raw_writer, row_writers)
+        fields['records'] = record_count
+    report_fetch_stats()
+
+    if not record_count:
         print("No new records to save.")
 
+    # Only remember hours once their data has been written
+    record_coverage(coverage, device_id, fetched_segments, empty_segments)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fetch new weather history for the configured WeatherXM station.")
+    parser.add_argument('--hours', type=int, default=DEFAULT_HOURS_HISTORY,
+                        help="hours of history to cover (default: HOURS_OF_HISTORY)")
+    parser.add_argument('--workers', type=int, default=MAX_CONCURRENT_REQUESTS, help="requests in flight")
+    args = parser.parse_args(argv)
+    # PROFILE=cprofile or PROFILE=pyinstrument saves a profile of the whole run
+    profile_run(fetch_weather_data, args.hours, args.workers)
+
+
 if __name__ == "__main__":
-    fetch_weather_data()
+    main(sys.argv[1:])
@@ -0,0 +1,145 @@
+# fleet_fetch.py
+import os
+import sys
+import argparse
+import asyncio
+import requests
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from api_manager import get_api_key, list_devices
+from coverage_index import CoverageIndex
+from fetch_weather_data import (DEFAULT_HOURS_HISTORY, plan_segments, create_writers, write_segment,
+                                close_writers, record_coverage, report_fetch_stats, fetch_adaptive,
+                                has_hours)
+
+# Load environment variables
+load_dotenv()
+
+# Comma-separated device IDs or names to fetch (empty = every device on the account)
+FLEET_DEVICES = os.getenv('FLEET_DEVICES', '')
+# Segment requests in flight across the whole fleet, and per device
+FLEET_MAX_CONCURRENT = int(os.getenv('FLEET_MAX_CONCURRENT', '16'))
+FLEET_PER_DEVICE_CONCURRENT = int(os.getenv('FLEET_PER_DEVICE_CONCURRENT', '4'))
+
+
+def select_devices(devices, wanted=None):
+    """Filters the account's devices by ID or name; an empty filter keeps them all."""
+    if not wanted:
+        return devices
+    wanted = {item.strip() for item in wanted if item.strip()}
+    selected = [device for device in devices if device['id'] in wanted or device.get('name') in wanted]
+    unknown = wanted - {device['id'] for device in selected} - {device.get('name') for device in selected}
+    if unknown:
+        print(f"Unknown devices skipped: {', '.join(sorted(unknown))}")
+    return selected
+
+
+def _fetch_or_none(api_key, device_id, segment):
+    try:
+        return fetch_adaptive(api_key, device_id, segment)
+    except requests.exceptions.RequestException:
+        return None
+
+
+async def fetch_device(api_key, device, requested_hours, coverage, global_limit, per_device_limit):
+    """Fetches one device's missing segments and writes them to that device's own files."""
+    device_id = device['id']
+    device_limit = asyncio.Semaphore(per_device_limit)
+    segments = plan_segments(coverage, device_id, requested_hours)
+    if not segments:
+        print(f"{device.get('name', device_id)}: all requested hours are already stored.")
+        return 0
+
+    async def fetch(segment):
+        async with device_limit, global_limit:
+            return await asyncio.to_thread(_fetch_or_none, api_key, device_id, segment)
+
+    # Segments are requested concurrently but written in order. At most 2 * per_device_limit are
+    # in flight or waiting behind the oldest unfinished one, so a long backfill's results cannot pile up
+    window = 2 * per_device_limit
+    upcoming = iter(segments)
+    pending = deque()
+
+    def schedule():
+        while len(pending) < window:
+            segment = next(upcoming, None)
+            if segment is None:
+                return
+            pending.append((segment, asyncio.ensure_future(fetch(segment))))
+
+    fetched_segments, empty_segments = [], []
+    record_count = 0
+    raw_writer, row_writers = create_writers(device_id, file_prefix=f"{device_id}_")
+    try:
+        schedule()
+        while pending:
+            segment, task = pending.popleft()
+            records = await task
+            schedule()
+            if records is None:
+                continue
+            (fetched_segments if has_hours(records) else empty_segments).append(segment)
+            record_count += await asyncio.to_thread(write_segment, records, raw_writer, row_writers)
+    finally:
+        for _, task in pending:
+            task.cancel()
+        await asyncio.to_thread(close_writers, raw_writer, row_writers)
+    record_coverage(coverage, device_id, fetched_segments, empty_segments)
+    print(f"{device.get('name', device_id)}: {record_count} records from "
+          f"{len(fetched_segments) + len(empty_segments)}/{len(segments)} segments")
+    return record_count
+
+
+async def fetch_fleet_async(requested_hours=DEFAULT_HOURS_HISTORY, device_filter=None,
+                            max_concurrent=FLEET_MAX_CONCURRENT, per_device=FLEET_PER_DEVICE_CONCURRENT):
+    """Fetches history for every selected device concurrently under global and per-device caps."""
+    api_key = get_api_key(os.getenv('WXM_API_KEY'))
+    if not api_key:
+        raise RuntimeError("Failed to retrieve API key.")
+    devices = select_devices(list_devices(api_key), device_filter)
+    if not devices:
+        print("No devices to fetch.")
+        return {}
+
+    # Blocking requests run in worker threads; size the pool to the global cap plus writer threads
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=max_concurrent + len(devices)))
+    global_limit = asyncio.Semaphore(max_concurrent)
+    coverage = CoverageIndex()
+    print(f"Fetching {len(devices)} device(s), up to {max_concurrent} requests in flight "
+          f"({per_device} per device)")
+    counts = await asyncio.gather(*(
+        fetch_device(api_key, device, requested_hours, coverage, global_limit, per_device) for device in devices
+    ), return_exceptions=True)
+    results = {}
+    for device, count in zip(devices, counts):
+        if isinstance(count, Exception):
+            print(f"{device.get('name', device['id'])}: failed with {count!r}")
+        results[device['id']] = count
+    report_fetch_stats()
+    return results
+
+
+def fetch_fleet(requested_hours=DEFAULT_HOURS_HISTORY, device_filter=None,
+                max_concurrent=FLEET_MAX_CONCURRENT, per_device=FLEET_PER_DEVICE_CONCURRENT):
+    """Synchronous wrapper around fetch_fleet_async."""
+    return asyncio.run(fetch_fleet_async(requested_hours, device_filter, max_concurrent, per_device))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fetch weather history for many WeatherXM stations at once.")
+    parser.add_argument('--hours', type=int, default=DEFAULT_HOURS_HISTORY, help="hours of history to fetch")
+    parser.add_argument('--devices', default=FLEET_DEVICES,
+                        help="comma-separated device IDs or names (default: all devices)")
+    parser.add_argument('--max-concurrent', type=int, default=FLEET_MAX_CONCURRENT,
+                        help="requests in flight across all devices")
+    parser.add_argument('--per-device', type=int, default=FLEET_PER_DEVICE_CONCURRENT,
+                        help="requests in flight per device")
+    args = parser.parse_args(argv)
+    device_filter = args.devices.split(',') if args.devices else None
+    fetch_fleet(args.hours, device_filter, args.max_concurrent, args.per_device)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
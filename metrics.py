@@ -0,0 +1,184 @@
+# metrics.py
+import os
+import json
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Per-stage timings are kept in memory and cost one perf_counter pair per stage
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', '1') not in ('0', 'false', 'False', 'no')
+# Where report_fetch_stats exports them: *.prom is written as Prometheus text (for node_exporter's
+# textfile collector), anything else gets one JSON line per event appended
+METRICS_PATH = os.getenv('METRICS_PATH', '')
+# Print a per-stage timing table after each run
+METRICS_REPORT = os.getenv('METRICS_REPORT', '0') not in ('0', 'false', 'False', 'no')
+# Events held for export between flushes; older ones are dropped (the per-stage totals are not)
+METRICS_MAX_EVENTS = int(os.getenv('METRICS_MAX_EVENTS', '10000'))
+# Profile a whole run: 'cprofile' or 'pyinstrument' (optional dependency)
+PROFILE = os.getenv('PROFILE', '').lower()
+PROFILE_DIR = os.path.join(os.getcwd(), "data", "profiles")
+
+
+class Metrics:
+    """Thread-safe per-stage timings with running totals and a bounded event buffer."""
+
+    def __init__(self, enabled=METRICS_ENABLED, max_events=METRICS_MAX_EVENTS):
+        self.enabled = enabled
+        self.events = deque(maxlen=max_events)
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    def record(self, stage, seconds, **fields):
+        """Adds one timed event; numeric fields (bytes, records, retries, ...) are summed per stage."""
+        if not self.enabled:
+            return
+        started = datetime.now(timezone.utc) - timedelta(seconds=seconds)
+        event = {'started': started.isoformat(timespec='milliseconds'), 'stage': stage,
+                 'seconds': round(seconds, 6), **fields}
+        with self.lock:
+            self.events.append(event)
+            totals = self.stages.setdefault(stage, {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+            totals['count'] += 1
+            totals['seconds'] += seconds
+            totals['max_seconds'] = max(totals['max_seconds'], seconds)
+            for name, value in fields.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    totals[name] = totals.get(name, 0) + value
+
+    @contextmanager
+    def timer(self, stage, **fields):
+        """Times the with-block as one event of `stage`; the yielded dict collects extra fields.
+
+        The event is recorded even when the block raises, with the exception's type as 'error'.
+        """
+        started = time.perf_counter()
+        try:
+            yield fields
+        except BaseException as e:
+            fields.setdefault('error', type(e).__name__)
+            raise
+        finally:
+            self.record(stage, time.perf_counter() - started, **fields)
+
+    def summary(self):
+        """Returns {stage: {count, seconds, max_seconds, summed fields...}} since the last reset."""
+        with self.lock:
+            return {stage: dict(totals) for stage, totals in self.stages.items()}
+
+    def drain_events(self):
+        """Returns and clears the buffered events."""
+        with self.lock:
+            events = list(self.events)
+            self.events.clear()
+            return events
+
+    def reset(self):
+        with self.lock:
+            self.events.clear()
+            self.stages.clear()
+
+    def to_prometheus(self, prefix='wxm'):
+        """Renders the per-stage totals in the Prometheus text exposition format."""
+        summary = self.summary()
+        series = {}
+        for stage, totals in summary.items():
+            for name, value in totals.items():
+                series.setdefault(name, []).append((stage, value))
+        lines = []
+        for name, values in series.items():
+            if name == 'count':
+                metric, kind = f"{prefix}_stage_calls_total", 'counter'
+            elif name == 'max_seconds':
+                metric, kind = f"{prefix}_stage_max_seconds", 'gauge'
+            else:
+                metric, kind = f"{prefix}_stage_{name}_total", 'counter'
+            lines.append(f"# TYPE {metric} {kind}")
+            for stage, value in values:
+                label = stage.replace('\\', '\\\\').replace('"', '\\"')
+                lines.append(f'{metric}{{stage="{label}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+    def export(self, path=METRICS_PATH):
+        """Writes the metrics to path (see METRICS_PATH); does nothing without a path."""
+        if not path or not self.enabled:
+            return None
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if path.endswith('.prom'):
+            # Replace atomically so a scraper never reads a half-written file
+            temp_path = f"{path}.tmp"
+            with open(temp_path, 'w') as f:
+                f.write(self.to_prometheus())
+            os.replace(temp_path, path)
+        else:
+            with open(path, 'a') as f:
+                for event in self.drain_events():
+                    f.write(json.dumps(event, default=str) + "\n")
+        return path
+
+    def report(self):
+        """Prints stages by total time, slowest first."""
+        summary = self.summary()
+        if not summary:
+            return
+        print(f"{'stage':<28}{'calls':>7}{'total s':>10}{'mean ms':>10}{'max ms':>10}")
+        for stage, totals in sorted(summary.items(), key=lambda item: -item[1]['seconds']):
+            print(f"{stage:<28}{totals['count']:>7}{totals['seconds']:>10.3f}"
+                  f"{1000 * totals['seconds'] / totals['count']:>10.1f}{1000 * totals['max_seconds']:>10.1f}")
+
+
+# Shared registry for the whole process
+metrics = Metrics()
+
+
+def timer(stage, **fields):
+    """Shortcut for metrics.timer."""
+    return metrics.timer(stage, **fields)
+
+
+def profile_run(func, *args, mode=PROFILE, output=None, **kwargs):
+    """Calls func(*args, **kwargs) under cProfile or pyinstrument when mode is set and saves the profile.
+
+    cProfile output (.prof) opens with `python -m pstats` or snakeviz; pyinstrument writes HTML.
+    """
+    if mode not in ('cprofile', 'pyinstrument'):
+        if mode:
+            print(f"Unknown PROFILE mode {mode!r}; running without a profiler.")
+        return func(*args, **kwargs)
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+    name = getattr(func, '__name__', 'run')
+    if mode == 'pyinstrument':
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            print("pyinstrument is not installed (pip install pyinstrument); running without a profiler.")
+            return func(*args, **kwargs)
+        output = output or os.path.join(PROFILE_DIR, f"{name}-{stamp}.html")
+        profiler = Profiler()
+        profiler.start()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profiler.stop()
+            os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+            with open(output, 'w') as f:
+                f.write(profiler.output_html())
+            print(f"Profile saved to: {output}")
+    import cProfile
+    import pstats
+    output = output or os.path.join(PROFILE_DIR, f"{name}-{stamp}.prof")
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args, **kwargs)
+    finally:
+        os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+        profiler.dump_stats(output)
+        print(f"Profile saved to: {output}")
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(15)
@@ -0,0 +1,227 @@
+# parquet_storage.py
+import os
+import time
+import uuid
+import threading
+import pandas as pd
+from datetime import datetime, timezone
+from dotenv import load_dotenv
+from weather_schema import MEASUREMENT_COLUMNS
+from unit_conversion import convert_frame
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:  # Optional dependency: pip install pyarrow
+    pa = pc = ds = pq = None
+
+# Load environment variables
+load_dotenv()
+
+PARQUET_DIR = os.path.join(os.getcwd(), "data", "parquet")
+PARQUET_COMPRESSION = os.getenv('PARQUET_COMPRESSION', 'zstd')
+# A month partition is compacted into one file once an append leaves it with more part files than this
+# (the scheduler appends one small file per device per poll)
+PARQUET_COMPACT_FILES = int(os.getenv('PARQUET_COMPACT_FILES', '24'))
+
+_sequence_lock = threading.Lock()
+_last_sequence = 0
+
+
+def is_available():
+    """Returns True when pyarrow is installed."""
+    return pa is not None
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError("The Parquet storage backend requires pyarrow. Install it with: pip install pyarrow")
+
+
+def get_schema():
+    """Typed schema of the stored columns (device_id and month come from the partition path)."""
+    _require_pyarrow()
+    return pa.schema(
+        [pa.field('timestamp', pa.timestamp('us', tz='UTC'))]
+        + [pa.field(column, pa.float32()) for column in MEASUREMENT_COLUMNS]
+        + [pa.field('icon', pa.dictionary(pa.int32(), pa.string()))]
+    )
+
+
+def _partitioning():
+    return ds.partitioning(pa.schema([('device_id', pa.string()), ('month', pa.string())]), flavor='hive')
+
+
+def _to_frame(data):
+    """Converts flattened rows (dicts or a flattened DataFrame) into a DataFrame matching the Parquet schema."""
+    df = pd.DataFrame(data)
+    df['timestamp'] = pd.to_datetime(df['timestamp'], utc=True, format='ISO8601')
+    for column in MEASUREMENT_COLUMNS:
+        df[column] = pd.to_numeric(df.get(column), errors='coerce').astype('float32')
+    df['icon'] = df.get('icon', pd.Series('', index=df.index)).fillna('').astype(str)
+    return df[['timestamp'] + MEASUREMENT_COLUMNS + ['icon']]
+
+
+def _next_sequence():
+    """Returns a nanosecond clock reading that is strictly greater than the previous one from this process."""
+    global _last_sequence
+    with _sequence_lock:
+        _last_sequence = max(time.time_ns(), _last_sequence + 1)
+        return _last_sequence
+
+
+def _part_file_name():
+    # Names sort in write order: a UTC second then its nanoseconds, so an append within the same
+    # second still sorts after the one before it (and after the older second-resolution names)
+    sequence = _next_sequence()
+    second, nanos = divmod(sequence, 1_000_000_000)
+    stamp = datetime.fromtimestamp(second, tz=timezone.utc).strftime('%Y%m%dT%H%M%S')
+    return f"part-{stamp}{nanos:09d}-{uuid.uuid4().hex[:8]}.parquet"
+
+
+def _part_files(partition_dir):
+    """Part files of one partition, oldest first."""
+    return sorted(name for name in os.listdir(partition_dir) if name.endswith('.parquet'))
+
+
+def append_records(data, device_id, base_dir=PARQUET_DIR):
+    """Appends flattened records as new files under device_id=<id>/month=<YYYY-MM>/ partitions.
+
+    A partition left with more than PARQUET_COMPACT_FILES part files is compacted, so hourly
+    appends keep reads (and the rollup refresh after each append) bounded.
+    """
+    _require_pyarrow()
+    if len(data) == 0:
+        return
+    df = _to_frame(data)
+    schema = get_schema()
+    months = df['timestamp'].dt.strftime('%Y-%m')
+    for month, month_df in df.groupby(months, sort=True):
+        partition_dir = os.path.join(base_dir, f"device_id={device_id}", f"month={month}")
+        os.makedirs(partition_dir, exist_ok=True)
+        file_name = _part_file_name()
+        table = pa.Table.from_pandas(month_df.sort_values('timestamp'), schema=schema, preserve_index=False)
+        pq.write_table(table, os.path.join(partition_dir, file_name), compression=PARQUET_COMPRESSION)
+        if len(_part_files(partition_dir)) > PARQUET_COMPACT_FILES:
+            compact_partition(partition_dir)
+    print(f"Data appended to Parquet store: {os.path.join(base_dir, f'device_id={device_id}')}")
+
+
+def _to_utc(value):
+    value = pd.Timestamp(value)
+    return value.tz_convert('UTC') if value.tzinfo else value.tz_localize('UTC')
+
+
+def _dataset(base_dir):
+    return ds.dataset(base_dir, format='parquet', partitioning=_partitioning(),
+                      schema=get_schema().append(pa.field('device_id', pa.string()))
+                      .append(pa.field('month', pa.string())))
+
+
+def read_records(device_id=None, columns=None, start=None, end=None, base_dir=PARQUET_DIR, units=None):
+    """Reads stored rows as a DataFrame, projecting columns and pruning partitions by device and time.
+
+    Values are stored in metric units; pass units ({quantity: unit}) to convert on the way out.
+    """
+    _require_pyarrow()
+    if not os.path.isdir(base_dir):
+        return pd.DataFrame(columns=columns or [])
+    expression = None
+    filters = []
+    if device_id is not None:
+        filters.append(ds.field('device_id') == device_id)
+    if start is not None:
+        start = _to_utc(start)
+        filters.append(ds.field('month') >= start.strftime('%Y-%m'))
+        filters.append(ds.field('timestamp') >= start.to_pydatetime())
+    if end is not None:
+        end = _to_utc(end)
+        filters.append(ds.field('month') <= end.strftime('%Y-%m'))
+        filters.append(ds.field('timestamp') < end.to_pydatetime())
+    for condition in filters:
+        expression = condition if expression is None else expression & condition
+    table = _dataset(base_dir).to_table(columns=columns, filter=expression)
+    df = table.to_pandas()
+    if 'timestamp' in df.columns:
+        # Overlapping appends can repeat an hour; newer part files win (dataset discovery
+        # lists files in path order, which is write order, and to_table keeps that order)
+        keys = [column for column in ('device_id', 'timestamp') if column in df.columns]
+        df = df.drop_duplicates(subset=keys, keep='last')
+        df = df.sort_values('timestamp', kind='stable').reset_index(drop=True)
+    return convert_frame(df, units) if units else df
+
+
+def compact_partition(partition_dir):
+    """Rewrites one month partition's part files as a single file. Returns the number of files removed.
+
+    Repeated hours keep their newest value. The result replaces the newest input file under its
+    name, so files appended meanwhile still sort after it, and readers never see a partial month.
+    """
+    _require_pyarrow()
+    names = _part_files(partition_dir)
+    if len(names) < 2:
+        return 0
+    schema = get_schema()
+    table = pa.concat_tables([pq.read_table(os.path.join(partition_dir, name), schema=schema) for name in names])
+    df = table.to_pandas()
+    df = df.drop_duplicates(subset='timestamp', keep='last').sort_values('timestamp', kind='stable')
+    newest = os.path.join(partition_dir, names[-1])
+    # A leading dot keeps a half-written file out of dataset discovery
+    temporary = os.path.join(partition_dir, f".{names[-1]}.tmp")
+    pq.write_table(pa.Table.from_pandas(df, schema=schema, preserve_index=False), temporary,
+                   compression=PARQUET_COMPRESSION)
+    os.replace(temporary, newest)
+    for name in names[:-1]:
+        os.remove(os.path.join(partition_dir, name))
+    return len(names) - 1
+
+
+def compact_device(device_id, base_dir=PARQUET_DIR, min_files=2):
+    """Compacts every month partition of a device holding at least min_files part files."""
+    _require_pyarrow()
+    device_dir = os.path.join(base_dir, f"device_id={device_id}")
+    if not os.path.isdir(device_dir):
+        return 0
+    removed = 0
+    for month_dir in sorted(name for name in os.listdir(device_dir) if name.startswith('month=')):
+        path = os.path.join(device_dir, month_dir)
+        if len(_part_files(path)) >= min_files:
+            removed += compact_partition(path)
+    return removed
+
+
+def _footer_max_timestamp(path):
+    """Returns the newest timestamp recorded in a part file's footer statistics, or None if absent."""
+    metadata = pq.read_metadata(path)
+    column_index = metadata.schema.names.index('timestamp')
+    newest = None
+    for group in range(metadata.num_row_groups):
+        statistics = metadata.row_group(group).column(column_index).statistics
+        if statistics is None or not statistics.has_min_max:
+            return None
+        newest = statistics.max if newest is None else max(newest, statistics.max)
+    return newest
+
+
+def get_last_timestamp(device_id, base_dir=PARQUET_DIR):
+    """Returns the newest stored timestamp for a device from the footers of its latest month partition."""
+    _require_pyarrow()
+    device_dir = os.path.join(base_dir, f"device_id={device_id}")
+    if not os.path.isdir(device_dir):
+        return None
+    months = sorted(name for name in os.listdir(device_dir) if name.startswith('month='))
+    for month_dir in reversed(months):
+        path = os.path.join(device_dir, month_dir)
+        newest = []
+        for name in os.listdir(path):
+            if name.endswith('.parquet'):
+                newest.append(_footer_max_timestamp(os.path.join(path, name)))
+        if newest and None not in newest:
+            return _to_utc(max(newest))
+        # Files written without statistics: scan the timestamp column instead
+        table = ds.dataset(path, format='parquet', schema=get_schema()).to_table(columns=['timestamp'])
+        if table.num_rows:
+            return pd.Timestamp(pc.max(table['timestamp']).as_py())
+    return None
@@ -0,0 +1,152 @@
+# rate_limiting.py
+import os
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import requests
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Rate limit and retry configuration
+RATE_LIMIT_PER_SECOND = float(os.getenv('RATE_LIMIT_PER_SECOND', '10'))
+RATE_LIMIT_BURST = int(os.getenv('RATE_LIMIT_BURST', '20'))
+MAX_RETRIES = int(os.getenv('MAX_RETRIES', '5'))
+BACKOFF_BASE_SECONDS = float(os.getenv('BACKOFF_BASE_SECONDS', '0.5'))
+BACKOFF_MAX_SECONDS = float(os.getenv('BACKOFF_MAX_SECONDS', '30'))
+
+THROTTLE_STATUS_CODES = {429, 503}
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """Thread-safe token bucket that halves its rate when throttled and recovers on success."""
+
+    def __init__(self, rate=RATE_LIMIT_PER_SECOND, burst=RATE_LIMIT_BURST):
+        self.max_rate = rate
+        self.min_rate = rate / 16
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a token is available and returns the seconds spent waiting."""
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def throttled(self):
+        """Multiplicative decrease after the server pushed back."""
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def succeeded(self):
+        """Additive increase back towards the configured rate."""
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+
+# Shared limiter for the history endpoint
+history_limiter = TokenBucket()
+
+_stats = {
+    'requests': 0,
+    'retries': 0,
+    'throttled_responses': 0,
+    'throttled_seconds': 0.0,
+    'backoff_seconds': 0.0,
+    'failed_segments': 0,
+    'split_segments': 0,
+}
+_stats_lock = threading.Lock()
+
+
+def record_stat(name, amount=1):
+    """Increments one of the retry/throttle counters."""
+    with _stats_lock:
+        _stats[name] += amount
+
+
+def get_stats():
+    """Returns a snapshot of the retry/throttle counters."""
+    with _stats_lock:
+        return dict(_stats)
+
+
+def reset_stats():
+    """Zeroes all retry/throttle counters."""
+    with _stats_lock:
+        for key in _stats:
+            _stats[key] = type(_stats[key])()
+
+
+def retry_after_seconds(response):
+    """Parses a Retry-After header (seconds or HTTP date) into seconds, or None."""
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+        return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt):
+    """Exponential backoff with full jitter for the given retry attempt (0-based)."""
+    return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * (2 ** attempt)))
+
+
+def request_with_retry(send, limiter=history_limiter, max_retries=MAX_RETRIES):
+    """Calls send() under the rate limiter, retrying throttled and transient failures.
+
+    Returns the last response; connection errors are re-raised once retries run out.
+    """
+    for attempt in range(max_retries + 1):
+        record_stat('throttled_seconds', limiter.acquire())
+        record_stat('requests')
+        try:
+            response = send()
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            if attempt == max_retries:
+                raise
+            delay = backoff_delay(attempt)
+            record_stat('backoff_seconds', delay)
+        else:
+            if response.status_code not in RETRY_STATUS_CODES:
+                limiter.succeeded()
+                return response
+            if attempt == max_retries:
+                return response
+            if response.status_code in THROTTLE_STATUS_CODES:
+                limiter.throttled()
+                record_stat('throttled_responses')
+                server_delay = retry_after_seconds(response)
+            else:
+                server_delay = None
+            if server_delay is not None:
+                delay = server_delay
+                record_stat('throttled_seconds', delay)
+            else:
+                delay = backoff_delay(attempt)
+                record_stat('backoff_seconds', delay)
+        record_stat('retries')
+        time.sleep(delay)
@@ -0,0 +1,165 @@
+# raw_archive.py
+import os
+import gzip
+import json
+import threading
+from datetime import datetime, timezone
+from dotenv import load_dotenv
+
+try:
+    import zstandard
+except ImportError:  # Optional dependency: pip install zstandard
+    zstandard = None
+
+# Load environment variables
+load_dotenv()
+
+RAW_ARCHIVE_DIR = os.path.join(os.getcwd(), "data", "raw")
+# 'gzip' (default) or 'zstd' (needs the zstandard package)
+RAW_ARCHIVE_CODEC = os.getenv('RAW_ARCHIVE_CODEC', 'gzip').lower()
+
+_CODECS = {'gzip': '.ndjson.gz', 'zstd': '.ndjson.zst'}
+_archive_lock = threading.Lock()
+
+
+def _codec():
+    if RAW_ARCHIVE_CODEC == 'zstd':
+        if zstandard is not None:
+            return 'zstd'
+        print("zstandard is not installed; archiving raw data with gzip.")
+    return 'gzip'
+
+
+def _compress(codec, data):
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor().compress(data)
+    return gzip.compress(data)
+
+
+def _decompress(codec, data):
+    if codec == 'zstd':
+        return zstandard.ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+
+def _record_date(record):
+    """Returns the YYYY-MM-DD day a raw API record belongs to."""
+    if record.get('date'):
+        return str(record['date'])[:10]
+    hourly = record.get('hourly') or [{}]
+    timestamp = hourly[0].get('timestamp')
+    return str(timestamp)[:10] if timestamp else 'unknown'
+
+
+def _paths(device_id, month, codec, base_dir):
+    device_dir = os.path.join(base_dir, device_id)
+    return os.path.join(device_dir, f"{month}{_CODECS[codec]}"), os.path.join(device_dir, f"{month}.idx")
+
+
+def append_records(device_id, records, base_dir=RAW_ARCHIVE_DIR):
+    """Appends raw daily records to the device's monthly archive, one compressed frame per record.
+
+    Each frame's byte offset and length go to a sidecar .idx file (one JSON line per frame)
+    so a date range can be read back without decompressing whole files.
+    """
+    codec = _codec()
+    archived_at = datetime.now(timezone.utc).isoformat()
+    by_month = {}
+    for record in records:
+        date = _record_date(record)
+        by_month.setdefault(date[:7], []).append((date, record))
+
+    with _archive_lock:
+        for month, month_records in by_month.items():
+            data_path, index_path = _paths(device_id, month, codec, base_dir)
+            os.makedirs(os.path.dirname(data_path), exist_ok=True)
+            index_lines = []
+            with open(data_path, 'ab') as f:
+                for date, record in month_records:
+                    frame = _compress(codec, (json.dumps(record, separators=(',', ':')) + '\n').encode('utf-8'))
+                    index_lines.append(json.dumps({
+                        'date': date, 'offset': f.tell(), 'length': len(frame), 'codec': codec,
+                        'hours': len(record.get('hourly') or []), 'archived_at': archived_at,
+                    }))
+                    f.write(frame)
+            # The index is written after the data, so a crash never indexes a partial frame
+            with open(index_path, 'a') as f:
+                f.write('\n'.join(index_lines) + '\n')
+
+
+def _read_index(index_path):
+    entries = []
+    try:
+        with open(index_path, 'r') as f:
+            for line in f:
+                if line.strip():
+                    entries.append(json.loads(line))
+    except OSError:
+        pass
+    return entries
+
+
+def _merge_day(frames):
+    """Combines every archived copy of one day; later copies win for repeated hours."""
+    merged = dict(frames[-1])
+    hourly = {}
+    for frame in frames:
+        for entry in frame.get('hourly') or []:
+            hourly[entry.get('timestamp')] = entry
+    merged['hourly'] = [hourly[timestamp] for timestamp in sorted(hourly, key=str)]
+    return merged
+
+
+def iter_records(device_id, start_date=None, end_date=None, base_dir=RAW_ARCHIVE_DIR):
+    """Yields raw daily records for start_date <= date <= end_date (YYYY-MM-DD strings or dates).
+
+    Only the matching frames are read and decompressed. A day archived in several frames
+    (segments crossing midnight, reruns) is yielded once with its hours merged.
+    """
+    start = str(start_date)[:10] if start_date else None
+    end = str(end_date)[:10] if end_date else None
+    device_dir = os.path.join(base_dir, device_id)
+    if not os.path.isdir(device_dir):
+        return
+    months = sorted(name[:-len('.idx')] for name in os.listdir(device_dir) if name.endswith('.idx'))
+    for month in months:
+        if (start and month < start[:7]) or (end and month > end[:7]):
+            continue
+        by_date = {}
+        for entry in _read_index(os.path.join(device_dir, f"{month}.idx")):
+            if (start and entry['date'] < start) or (end and entry['date'] > end):
+                continue
+            by_date.setdefault(entry['date'], []).append(entry)
+        open_files = {}
+        try:
+            for date in sorted(by_date):
+                frames = []
+                for entry in by_date[date]:
+                    codec = entry.get('codec', 'gzip')
+                    if codec not in open_files:
+                        open_files[codec] = open(_paths(device_id, month, codec, base_dir)[0], 'rb')
+                    f = open_files[codec]
+                    f.seek(entry['offset'])
+                    frames.append(json.loads(_decompress(codec, f.read(entry['length']))))
+                yield frames[0] if len(frames) == 1 else _merge_day(frames)
+        finally:
+            for f in open_files.values():
+                f.close()
+
+
+class RawArchiveWriter:
+    """Streaming-pipeline writer that appends each fetched segment to the raw archive."""
+
+    def __init__(self, device_id, base_dir=RAW_ARCHIVE_DIR):
+        self.device_id = device_id
+        self.base_dir = base_dir
+        self.record_count = 0
+
+    def write(self, records):
+        if records:
+            append_records(self.device_id, records, self.base_dir)
+            self.record_count += len(records)
+
+    def close(self):
+        if self.record_count:
+            print(f"Raw data archived to: {os.path.join(self.base_dir, self.device_id)}")
@@ -0,0 +1,143 @@
+# response_cache.py
+import os
+import gzip
+import json
+import time
+import uuid
+import hashlib
+import threading
+from datetime import datetime, timedelta, timezone
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+RESPONSE_CACHE_ENABLED = os.getenv('RESPONSE_CACHE_ENABLED', '1') not in ('0', 'false', 'False', 'no')
+RESPONSE_CACHE_DIR = os.getenv('RESPONSE_CACHE_DIR', os.path.join(os.getcwd(), "data", "cache"))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv('RESPONSE_CACHE_MAX_BYTES', str(512 * 1024 * 1024)))
+# Segments that ended at least this long ago are treated as closed and never expire
+RESPONSE_CACHE_SETTLE_HOURS = int(os.getenv('RESPONSE_CACHE_SETTLE_HOURS', '24'))
+# Lifetime of cached segments that still overlap the open (current) day
+RESPONSE_CACHE_TTL_SECONDS = int(os.getenv('RESPONSE_CACHE_TTL_SECONDS', '300'))
+
+
+class ResponseCache:
+    """On-disk cache of history responses keyed by (device_id, fromDate, toDate).
+
+    Entries are gzip files named by the SHA-256 of the key. Reads refresh an entry's
+    mtime, and once the directory grows past max_bytes the least recently used
+    entries are evicted.
+    """
+
+    def __init__(self, directory=RESPONSE_CACHE_DIR, max_bytes=RESPONSE_CACHE_MAX_BYTES,
+                 settle_hours=RESPONSE_CACHE_SETTLE_HOURS, ttl_seconds=RESPONSE_CACHE_TTL_SECONDS):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.settle = timedelta(hours=settle_hours)
+        self.ttl_seconds = ttl_seconds
+        self.lock = threading.Lock()
+        self.total_bytes = None
+        self.stats = {'hits': 0, 'misses': 0, 'expired': 0, 'writes': 0, 'evictions': 0}
+
+    def _path(self, device_id, from_date, to_date):
+        key = f"{device_id}|{from_date.isoformat()}|{to_date.isoformat()}"
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest[:2], f"{digest}.json.gz")
+
+    def _is_closed(self, to_date):
+        if to_date.tzinfo is None:
+            to_date = to_date.replace(tzinfo=timezone.utc)
+        return to_date <= datetime.now(timezone.utc) - self.settle
+
+    def _count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def get(self, device_id, from_date, to_date):
+        """Returns the cached records for a segment, or None on a miss or expired entry."""
+        path = self._path(device_id, from_date, to_date)
+        try:
+            modified = os.path.getmtime(path)
+            if not self._is_closed(to_date) and time.time() - modified > self.ttl_seconds:
+                self._count('expired')
+                self._count('misses')
+                return None
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                records = json.load(f)['records']
+        except (OSError, ValueError, KeyError):
+            self._count('misses')
+            return None
+        # Closed entries keep their mtime as an LRU stamp; open ones need it for the TTL
+        if self._is_closed(to_date):
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+        self._count('hits')
+        return records
+
+    def put(self, device_id, from_date, to_date, records):
+        """Stores a segment's records and evicts old entries if the cache is over budget."""
+        path = self._path(device_id, from_date, to_date)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        payload = {'device_id': device_id, 'fromDate': from_date.isoformat(), 'toDate': to_date.isoformat(),
+                   'records': records}
+        with gzip.open(temp_path, 'wt', encoding='utf-8') as f:
+            json.dump(payload, f, separators=(',', ':'))
+        size = os.path.getsize(temp_path)
+        try:
+            previous_size = os.path.getsize(path)
+        except OSError:
+            previous_size = 0
+        os.replace(temp_path, path)
+        with self.lock:
+            self.stats['writes'] += 1
+            if self.total_bytes is None:
+                self.total_bytes = self._scan_size()
+            else:
+                self.total_bytes += size - previous_size
+            over_budget = self.total_bytes > self.max_bytes
+        if over_budget:
+            self.evict()
+
+    def _entries(self):
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith('.json.gz'):
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    yield stat.st_mtime, stat.st_size, path
+
+    def _scan_size(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self):
+        """Deletes least recently used entries until the cache is at 90% of its budget."""
+        with self.lock:
+            entries = sorted(self._entries())
+            total = sum(size for _, size, _ in entries)
+            target = self.max_bytes * 0.9
+            for _, size, path in entries:
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                self.stats['evictions'] += 1
+            self.total_bytes = total
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
+
+response_cache = ResponseCache() if RESPONSE_CACHE_ENABLED else None
@@ -0,0 +1,286 @@
+# rollups.py
+import os
+import sys
+import sqlite3
+import argparse
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+import parquet_storage
+import sqlite_storage
+from unit_conversion import COLUMN_QUANTITIES, get_factors, CANONICAL_UNITS
+from weather_schema import MEASUREMENT_COLUMNS
+
+# Load environment variables
+load_dotenv()
+
+# Rollups live in a SQLite file next to (or inside) the hourly SQLite store, whatever the history backend is
+ROLLUP_PATH = os.getenv('ROLLUP_PATH', sqlite_storage.SQLITE_PATH)
+ROLLUPS_ENABLED = os.getenv('ROLLUPS_ENABLED', '1') not in ('0', 'false', 'False', 'no')
+PERIODS = ['day', 'week', 'month']
+STATS = ['min', 'max', 'mean', 'sum', 'count']
+STAT_COLUMNS = [f"{column}_{stat}" for column in MEASUREMENT_COLUMNS for stat in STATS]
+
+
+def connect(path=ROLLUP_PATH):
+    """Opens the rollup database and creates its tables if needed."""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS rollups ("
+        "device_id TEXT NOT NULL, period TEXT NOT NULL, bucket_start INTEGER NOT NULL, "
+        "bucket_end INTEGER NOT NULL, label TEXT NOT NULL, hours INTEGER NOT NULL, "
+        + "".join(f"{column} {'INTEGER' if column.endswith('_count') else 'REAL'}, " for column in STAT_COLUMNS)
+        + "PRIMARY KEY (device_id, period, bucket_start)) WITHOUT ROWID"
+    )
+    # Buckets follow the station's local calendar; the zone is fixed the first time a device is rolled up
+    conn.execute("CREATE TABLE IF NOT EXISTS rollup_timezones (device_id TEXT PRIMARY KEY, tz TEXT NOT NULL)")
+    conn.commit()
+    return conn
+
+
+def _device_timezone(conn, device_id, timestamps=None):
+    row = conn.execute("SELECT tz FROM rollup_timezones WHERE device_id = ?", (device_id,)).fetchone()
+    if row:
+        return row[0]
+    tz = 'UTC'
+    if timestamps is not None and getattr(timestamps.dt, 'tz', None) is not None:
+        tz = str(timestamps.dt.tz)
+    with conn:
+        conn.execute("INSERT INTO rollup_timezones (device_id, tz) VALUES (?, ?)", (device_id, tz))
+    return tz
+
+
+def stored_timezone(device_id, path=ROLLUP_PATH):
+    """Returns the zone recorded for device_id when it was first rolled up, or None."""
+    if not os.path.exists(path):
+        return None
+    conn = sqlite3.connect(path)
+    try:
+        row = conn.execute("SELECT tz FROM rollup_timezones WHERE device_id = ?", (device_id,)).fetchone()
+    except sqlite3.OperationalError:
+        row = None
+    finally:
+        conn.close()
+    return row[0] if row else None
+
+
+def bucket_starts(local_timestamps, period):
+    """Floors tz-aware local timestamps to the start of their day, ISO week (Monday) or month.
+
+    Flooring happens in wall time: subtracting whole days from a tz-aware midnight would
+    land an hour off midnight whenever a DST change falls in between.
+    """
+    days = local_timestamps.dt.tz_localize(None).dt.normalize()
+    if period == 'week':
+        days = days - pd.to_timedelta(days.dt.weekday, unit='D')
+    elif period == 'month':
+        days = days - pd.to_timedelta(days.dt.day - 1, unit='D')
+    elif period != 'day':
+        raise ValueError(f"Unknown rollup period: {period}")
+    # Zones that change clocks at midnight: take the first midnight, or the first hour after a skipped one
+    return days.dt.tz_localize(local_timestamps.dt.tz, ambiguous=np.ones(len(days), dtype=bool),
+                               nonexistent='shift_forward')
+
+
+def _bucket_ends(starts, period):
+    if period == 'day':
+        offset = pd.DateOffset(days=1)
+    elif period == 'week':
+        offset = pd.DateOffset(weeks=1)
+    else:
+        offset = pd.DateOffset(months=1)
+    # DateOffset keeps local wall time across DST changes
+    return starts + offset
+
+
+def _labels(starts, period):
+    if period == 'day':
+        return starts.dt.strftime('%Y-%m-%d')
+    if period == 'week':
+        iso = starts.dt.isocalendar()
+        return iso['year'].astype(str) + '-W' + iso['week'].astype(str).str.zfill(2)
+    return starts.dt.strftime('%Y-%m')
+
+
+def read_hours(device_id, start, end, backend):
+    """Reads canonical hourly rows in [start, end) from the history store."""
+    if backend == 'sqlite':
+        return sqlite_storage.query_range(device_id, start, end, columns=MEASUREMENT_COLUMNS)
+    return parquet_storage.read_records(device_id, columns=['timestamp'] + MEASUREMENT_COLUMNS, start=start, end=end)
+
+
+def aggregate(hours, period, tz):
+    """Aggregates hourly rows into one row per bucket with min/max/mean/sum/count for every measurement."""
+    starts = bucket_starts(hours['timestamp'].dt.tz_convert(tz), period).rename('bucket_start')
+    grouped = hours[MEASUREMENT_COLUMNS].astype('float64').groupby(starts, sort=True)
+    stats = grouped.agg(STATS)
+    stats.columns = [f"{column}_{stat}" for column, stat in stats.columns]
+    # A column with no values in a bucket has no sum either
+    for column in MEASUREMENT_COLUMNS:
+        stats.loc[stats[f"{column}_count"] == 0, f"{column}_sum"] = np.nan
+    stats = stats.reset_index()
+    stats.insert(1, 'bucket_end', _bucket_ends(stats['bucket_start'], period))
+    stats.insert(2, 'label', _labels(stats['bucket_start'], period))
+    stats.insert(3, 'hours', grouped.size().to_numpy())
+    return stats
+
+
+def _epochs(timestamps):
+    return (timestamps - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(seconds=1)
+
+
+def _write_buckets(conn, device_id, period, buckets):
+    columns = ['device_id', 'period', 'bucket_start', 'bucket_end', 'label', 'hours'] + STAT_COLUMNS
+    sql = f"INSERT OR REPLACE INTO rollups ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})"
+    values = buckets[STAT_COLUMNS].astype(object)
+    values = values.where(values.notna(), None)
+    rows = list(zip([device_id] * len(buckets), [period] * len(buckets), _epochs(buckets['bucket_start']).tolist(),
+                    _epochs(buckets['bucket_end']).tolist(), buckets['label'].tolist(),
+                    buckets['hours'].astype(int).tolist(), *(values[c].tolist() for c in STAT_COLUMNS)))
+    conn.executemany(sql, rows)
+    return len(rows)
+
+
+def update_rollups(data, device_id, backend=None, path=ROLLUP_PATH):
+    """Recomputes only the day/week/month buckets touched by newly stored hours.
+
+    data is the flattened frame (or rows) that was just written to the history store;
+    each touched bucket is re-aggregated from the store so re-fetched hours never double count.
+    """
+    backend = backend or history_backend()
+    if backend is None or len(data) == 0:
+        return 0
+    timestamps = pd.DataFrame(data)['timestamp']
+    if not isinstance(timestamps.dtype, pd.DatetimeTZDtype):
+        timestamps = pd.to_datetime(timestamps, utc=True, format='ISO8601')
+    conn = connect(path)
+    try:
+        tz = _device_timezone(conn, device_id, timestamps)
+        local = timestamps.dt.tz_convert(tz)
+        # Months contain every day bucket; weeks can straddle month boundaries
+        month_starts = bucket_starts(local, 'month').drop_duplicates()
+        week_starts = bucket_starts(local, 'week').drop_duplicates()
+        span_start = min(month_starts.min(), week_starts.min())
+        span_end = max(_bucket_ends(month_starts, 'month').max(), _bucket_ends(week_starts, 'week').max())
+        hours = read_hours(device_id, span_start.tz_convert('UTC'), span_end.tz_convert('UTC'), backend)
+        if hours.empty:
+            return 0
+        written = 0
+        with conn:
+            for period in PERIODS:
+                buckets = aggregate(hours, period, tz)
+                buckets = buckets[buckets['bucket_start'].isin(bucket_starts(local, period))]
+                written += _write_buckets(conn, device_id, period, buckets)
+        return written
+    finally:
+        conn.close()
+
+
+def rebuild_rollups(device_id, backend=None, path=ROLLUP_PATH):
+    """Recomputes every bucket for a device from its full hourly history."""
+    backend = backend or history_backend()
+    if backend is None:
+        return 0
+    hours = read_hours(device_id, None, None, backend)
+    if hours.empty:
+        return 0
+    conn = connect(path)
+    try:
+        tz = _device_timezone(conn, device_id)
+        written = 0
+        with conn:
+            conn.execute("DELETE FROM rollups WHERE device_id = ?", (device_id,))
+            for period in PERIODS:
+                written += _write_buckets(conn, device_id, period, aggregate(hours, period, tz))
+        return written
+    finally:
+        conn.close()
+
+
+def query_rollups(device_id, period='day', start=None, end=None, columns=None, stats=None, units=None,
+                  path=ROLLUP_PATH):
+    """Returns one row per bucket overlapping [start, end), with bucket_start as a local tz-aware timestamp.
+
+    columns and stats narrow the returned measurement statistics (default: all). Values are
+    metric; pass units ({quantity: unit}) to convert them.
+    """
+    if period not in PERIODS:
+        raise ValueError(f"Unknown rollup period: {period}")
+    selected = [f"{column}_{stat}" for column in (columns or MEASUREMENT_COLUMNS) for stat in (stats or STATS)]
+    unknown = set(selected) - set(STAT_COLUMNS)
+    if unknown:
+        raise ValueError(f"Unknown rollup columns: {', '.join(sorted(unknown))}")
+    if not os.path.exists(path):
+        return pd.DataFrame(columns=['bucket_start', 'bucket_end', 'label', 'hours'] + selected)
+    sql = (f"SELECT bucket_start, bucket_end, label, hours, {', '.join(selected)} FROM rollups "
+           f"WHERE device_id = ? AND period = ?")
+    params = [device_id, period]
+    if start is not None:
+        sql += " AND bucket_end > ?"
+        params.append(sqlite_storage._to_epoch(start))
+    if end is not None:
+        sql += " AND bucket_start < ?"
+        params.append(sqlite_storage._to_epoch(end))
+    conn = connect(path)
+    try:
+        df = pd.read_sql_query(sql + " ORDER BY bucket_start", conn, params=params)
+        tz = _device_timezone(conn, device_id)
+    finally:
+        conn.close()
+    for column in ['bucket_start', 'bucket_end']:
+        df[column] = pd.to_datetime(df[column], unit='s', utc=True).dt.tz_convert(tz)
+    # Columns that are NULL in every bucket come back as objects
+    for column in selected:
+        df[column] = df[column].astype('int64' if column.endswith('_count') else 'float64')
+    return convert_rollups(df, units) if units else df
+
+
+def convert_rollups(df, units):
+    """Converts rollup statistics to other units; sums account for the affine offset via the counts."""
+    df = df.copy()
+    for column in MEASUREMENT_COLUMNS:
+        quantity = COLUMN_QUANTITIES.get(column)
+        if quantity is None or quantity not in units:
+            continue
+        scale, offset = get_factors(quantity, CANONICAL_UNITS[quantity], units[quantity])
+        for stat in ['min', 'max', 'mean']:
+            if f"{column}_{stat}" in df:
+                df[f"{column}_{stat}"] = df[f"{column}_{stat}"] * scale + offset
+        if f"{column}_sum" in df:
+            counts = df[f"{column}_count"] if f"{column}_count" in df else np.nan if offset else 0
+            df[f"{column}_sum"] = df[f"{column}_sum"] * scale + offset * counts
+    return df
+
+
+def history_backend():
+    """Returns the history backend rollups can read from, or None for the CSV fallback."""
+    from data_saving import STORAGE_BACKEND, use_parquet_backend
+    if STORAGE_BACKEND == 'sqlite':
+        return 'sqlite'
+    if STORAGE_BACKEND == 'parquet' and use_parquet_backend():
+        return 'parquet'
+    return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rebuild or show daily/weekly/monthly rollups.")
+    parser.add_argument('--device', default=os.getenv('DEVICE_ID'), help="device ID (default: DEVICE_ID)")
+    parser.add_argument('--rebuild', action='store_true', help="recompute every bucket from the hourly store")
+    parser.add_argument('--period', choices=PERIODS, default='month', help="period to show")
+    args = parser.parse_args(argv)
+    if not args.device:
+        parser.error("no device: pass --device or set DEVICE_ID")
+    if args.rebuild:
+        print(f"{rebuild_rollups(args.device)} rollup rows rebuilt for {args.device}")
+    df = query_rollups(args.device, args.period, columns=['temperature', 'precipitation'],
+                       stats=['min', 'max', 'mean', 'sum'])
+    print(df.drop(columns=['bucket_start', 'bucket_end']).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,200 @@
+# scheduler.py
+import os
+import sys
+import time
+import argparse
+import threading
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from api_manager import initialize_api, get_api_key
+from coverage_index import CoverageIndex
+from data_loading import load_last_timestamp
+from data_saving import HistoryWriter
+from fetch_weather_data import (MAX_CONCURRENT_REQUESTS, build_segments, floor_to_hour, iter_segment_results,
+                                write_segment, record_coverage, has_hours)
+from http_client import get_client
+from metrics import metrics
+from raw_archive import RawArchiveWriter
+
+# Load environment variables
+load_dotenv()
+
+# Comma-separated device IDs to poll (default: DEVICE_ID from .env)
+SCHEDULER_DEVICES = os.getenv('SCHEDULER_DEVICES', '')
+# Polls run once per interval, aligned to the hour, offset to give the API time to publish the hour
+SCHEDULER_INTERVAL_SECONDS = int(os.getenv('SCHEDULER_INTERVAL_SECONDS', '3600'))
+SCHEDULER_OFFSET_SECONDS = int(os.getenv('SCHEDULER_OFFSET_SECONDS', '120'))
+# When a poll fails, try again this much later (until the next aligned poll)
+SCHEDULER_RETRY_SECONDS = int(os.getenv('SCHEDULER_RETRY_SECONDS', '300'))
+# Hours to fetch for a device with no stored history
+SCHEDULER_INITIAL_HOURS = int(os.getenv('SCHEDULER_INITIAL_HOURS', '1'))
+
+
+def next_aligned_time(now, interval=SCHEDULER_INTERVAL_SECONDS, offset=SCHEDULER_OFFSET_SECONDS):
+    """Returns the first interval boundary (plus offset) after now."""
+    epoch = now.timestamp()
+    next_run = epoch // interval * interval + offset
+    while next_run <= epoch:
+        next_run += interval
+    return datetime.fromtimestamp(next_run, tz=timezone.utc)
+
+
+def _parse_timestamp(value):
+    timestamp = datetime.fromisoformat(value)
+    return timestamp if timestamp.tzinfo else timestamp.replace(tzinfo=timezone.utc)
+
+
+def records_after(records, last_timestamp):
+    """Drops hourly entries at or before last_timestamp; returns (records, newest timestamp or None)."""
+    kept, newest = [], None
+    for record in records:
+        hourly = []
+        for entry in record.get('hourly') or []:
+            if not entry.get('timestamp'):
+                continue
+            timestamp = _parse_timestamp(entry['timestamp'])
+            if last_timestamp is None or timestamp > last_timestamp:
+                hourly.append(entry)
+                newest = timestamp if newest is None else max(newest, timestamp)
+        if hourly:
+            kept.append(dict(record, hourly=hourly))
+    return kept, newest
+
+
+class PollingScheduler:
+    """Polls devices for their newest hours, keeping the last timestamp of each in memory.
+
+    The HTTP session, token cache and writers stay open across cycles, so a steady-state
+    poll is one small request per device plus one append to the history store.
+    """
+
+    def __init__(self, api_key, device_ids, coverage=None):
+        self.api_key = api_key
+        self.device_ids = list(device_ids)
+        self.coverage = coverage or CoverageIndex()
+        self.last_timestamps = {}
+        self.raw_writers = {}
+        self.history_writers = {}
+        self.stop_event = threading.Event()
+        for device_id in self.device_ids:
+            # Read once at startup from the store's metadata; afterwards the scheduler keeps it current
+            last_timestamp = load_last_timestamp(device_id)
+            self.last_timestamps[device_id] = None if last_timestamp is None else last_timestamp.to_pydatetime()
+            self.raw_writers[device_id] = RawArchiveWriter(device_id)
+            self.history_writers[device_id] = HistoryWriter(device_id)
+
+    def poll_device(self, device_id, now=None):
+        """Fetches and stores the hours after the device's last timestamp. Returns the number of new hours."""
+        now = now or datetime.now(timezone.utc)
+        last_timestamp = self.last_timestamps.get(device_id)
+        if last_timestamp is None:
+            start_date = floor_to_hour(now) - timedelta(hours=SCHEDULER_INITIAL_HOURS)
+        else:
+            start_date = floor_to_hour(last_timestamp) + timedelta(hours=1)
+        if start_date >= now:
+            return 0
+        # Normally a single short segment; after downtime this catches up in day-sized pieces
+        segments = build_segments(start_date, now)
+        new_hours = 0
+        fetched_segments, empty_segments = [], []
+        for segment, records in iter_segment_results(self.api_key, device_id, segments, MAX_CONCURRENT_REQUESTS):
+            if records is None:
+                # Keep what was fetched; the remaining hours are retried after a short delay
+                if not fetched_segments and not empty_segments:
+                    raise RuntimeError(f"could not fetch {segment[0]} to {segment[1]}")
+                break
+            returned = has_hours(records)
+            records, newest = records_after(records, self.last_timestamps.get(device_id))
+            if records:
+                write_segment(records, self.raw_writers[device_id], [self.history_writers[device_id]])
+                # One small append per poll; the Parquet store compacts the month past PARQUET_COMPACT_FILES
+                self.history_writers[device_id].flush()
+                self.last_timestamps[device_id] = newest
+                new_hours += sum(len(record['hourly']) for record in records)
+            (fetched_segments if returned else empty_segments).append(segment)
+        if fetched_segments or empty_segments:
+            record_coverage(self.coverage, device_id, fetched_segments, empty_segments)
+        return new_hours
+
+    def run_once(self, executor=None):
+        """Polls every device once and returns {device_id: new hours, or None if the poll failed}."""
+        def poll(device_id):
+            try:
+                return self.poll_device(device_id)
+            except Exception as e:
+                print(f"{device_id}: poll failed: {e!r}")
+                return None
+
+        if executor is None or len(self.device_ids) == 1:
+            results = [poll(device_id) for device_id in self.device_ids]
+        else:
+            results = list(executor.map(poll, self.device_ids))
+        return dict(zip(self.device_ids, results))
+
+    def run_forever(self, interval=SCHEDULER_INTERVAL_SECONDS, offset=SCHEDULER_OFFSET_SECONDS,
+                    retry=SCHEDULER_RETRY_SECONDS, max_cycles=None):
+        """Polls immediately, then once per aligned interval until stop() or Ctrl-C."""
+        cycles = 0
+        with ThreadPoolExecutor(max_workers=min(len(self.device_ids), MAX_CONCURRENT_REQUESTS)) as executor:
+            try:
+                while not self.stop_event.is_set():
+                    started = time.perf_counter()
+                    results = self.run_once(executor)
+                    cycles += 1
+                    summary = ", ".join(f"{device_id}: {'failed' if hours is None else hours}"
+                                        for device_id, hours in results.items())
+                    print(f"[{datetime.now(timezone.utc):%Y-%m-%d %H:%M:%S}Z] Poll {cycles} "
+                          f"({time.perf_counter() - started:.2f}s) new hours: {summary}")
+                    # Each cycle's request/flatten/write timings go to METRICS_PATH when it is set
+                    metrics.export()
+                    if max_cycles is not None and cycles >= max_cycles:
+                        break
+                    now = datetime.now(timezone.utc)
+                    next_run = next_aligned_time(now, interval, offset)
+                    if any(hours is None for hours in results.values()):
+                        # An hour not published yet is picked up by the next slot; only failures retry early
+                        next_run = min(next_run, now + timedelta(seconds=retry))
+                    self.stop_event.wait((next_run - now).total_seconds())
+            except KeyboardInterrupt:
+                print("\nScheduler stopped.")
+            finally:
+                self.close()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def close(self):
+        for writer in list(self.raw_writers.values()) + list(self.history_writers.values()):
+            writer.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Poll WeatherXM stations for new hourly data on a schedule.")
+    parser.add_argument('--devices', default=SCHEDULER_DEVICES,
+                        help="comma-separated device IDs (default: DEVICE_ID from .env)")
+    parser.add_argument('--interval', type=int, default=SCHEDULER_INTERVAL_SECONDS, help="seconds between polls")
+    parser.add_argument('--offset', type=int, default=SCHEDULER_OFFSET_SECONDS,
+                        help="seconds after each interval boundary to poll")
+    parser.add_argument('--once', action='store_true', help="poll once and exit")
+    args = parser.parse_args(argv)
+
+    if args.devices:
+        api_key = get_api_key(os.getenv('WXM_API_KEY'))
+        if not api_key:
+            raise RuntimeError("Failed to retrieve API key.")
+        device_ids = [device_id.strip() for device_id in args.devices.split(',') if device_id.strip()]
+    else:
+        api_key, device_id = initialize_api()
+        device_ids = [device_id]
+
+    scheduler = PollingScheduler(api_key, device_ids)
+    print(f"Polling {len(device_ids)} device(s) every {args.interval}s (offset {args.offset}s). Press Ctrl-C to stop.")
+    try:
+        scheduler.run_forever(args.interval, args.offset, max_cycles=1 if args.once else None)
+    finally:
+        get_client().close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
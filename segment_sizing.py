@@ -0,0 +1,133 @@
+# segment_sizing.py
+import os
+import json
+import threading
+from datetime import datetime, timedelta, timezone
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+SEGMENT_LIMITS_FILE = os.path.join(os.getcwd(), "data", "segment_limits.json")
+# Learn the largest history window the API accepts per device instead of always asking for one day
+ADAPTIVE_SEGMENTS = os.getenv('ADAPTIVE_SEGMENTS', '1') not in ('0', 'false', 'False', 'no')
+DEFAULT_SEGMENT_HOURS = 24
+MIN_SEGMENT_HOURS = int(os.getenv('MIN_SEGMENT_HOURS', '1'))
+MAX_SEGMENT_HOURS = int(os.getenv('MAX_SEGMENT_HOURS', str(24 * 31)))
+# A size that failed is not tried again for this long; afterwards the limit is probed again
+SEGMENT_CEILING_TTL_HOURS = int(os.getenv('SEGMENT_CEILING_TTL_HOURS', '168'))
+# Statuses that point at the window being too large rather than at the server
+SIZE_ERROR_STATUS_CODES = {400, 413, 414, 422}
+# A response whose newest hour falls this far short of the requested end counts as truncated
+TRUNCATION_SLACK_HOURS = 2
+
+
+class SegmentLimits:
+    """Per-device segment size learned from the history endpoint, persisted as a JSON sidecar.
+
+    Each device keeps the largest size known to work ('hours') and, after a failure, the
+    smallest size known to fail ('ceiling'). Probes grow 'hours' towards the ceiling by
+    doubling or bisecting, so the limit is found in a handful of requests.
+    """
+
+    def __init__(self, path=SEGMENT_LIMITS_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.devices = {}
+        try:
+            with open(path, 'r') as f:
+                self.devices = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    def _ceiling(self, entry):
+        if entry.get('ceiling') is None:
+            return None
+        failed_at = datetime.fromisoformat(entry['ceiling_at'])
+        if datetime.now(timezone.utc) - failed_at > timedelta(hours=SEGMENT_CEILING_TTL_HOURS):
+            return None
+        return entry['ceiling']
+
+    def hours(self, device_id):
+        """Segment size to plan requests with."""
+        with self.lock:
+            return self.devices.get(device_id, {}).get('hours', DEFAULT_SEGMENT_HOURS)
+
+    def probe_hours(self, device_id):
+        """Next larger size worth trying, or the current size when there is nothing left to learn."""
+        with self.lock:
+            entry = self.devices.get(device_id, {})
+            hours = entry.get('hours', DEFAULT_SEGMENT_HOURS)
+            target = min(hours * 2, MAX_SEGMENT_HOURS)
+            ceiling = self._ceiling(entry)
+            if ceiling is not None:
+                target = min(target, (hours + ceiling) // 2)
+            # Stop bisecting once the remaining gain is small
+            return target if target - hours >= max(1, hours // 8) else hours
+
+    def can_grow(self, device_id):
+        return self.probe_hours(device_id) > self.hours(device_id)
+
+    def succeeded(self, device_id, hours):
+        """Records a window of `hours` that came back complete."""
+        with self.lock:
+            entry = self.devices.setdefault(device_id, {'hours': DEFAULT_SEGMENT_HOURS})
+            if hours <= entry['hours']:
+                return
+            entry['hours'] = min(hours, MAX_SEGMENT_HOURS)
+            if entry.get('ceiling') is not None and hours >= entry['ceiling']:
+                entry['ceiling'] = entry['ceiling_at'] = None
+            self._save()
+
+    def failed(self, device_id, hours):
+        """Records a window of `hours` that errored or came back truncated."""
+        with self.lock:
+            entry = self.devices.setdefault(device_id, {'hours': DEFAULT_SEGMENT_HOURS})
+            if hours <= entry['hours']:
+                # The limit went down (or was never right); plan below the failing size from now on
+                entry['hours'] = max(MIN_SEGMENT_HOURS, hours // 2)
+            if self._ceiling(entry) is None or hours < entry['ceiling']:
+                entry['ceiling'] = hours
+            entry['ceiling_at'] = datetime.now(timezone.utc).isoformat()
+            self._save()
+
+    def _save(self):
+        # Limits change rarely (growth and failures only), so every change is written straight away
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(self.devices, f, indent=1)
+        os.replace(temp_path, self.path)
+
+
+def segment_span_hours(segment):
+    """Whole hours in a (from, to) segment."""
+    return int((segment[1] - segment[0]).total_seconds() // 3600)
+
+
+def truncated_until(records, from_date, to_date, now=None):
+    """Returns where a truncated history response stops (the hour after its newest entry), else None.
+
+    Empty responses are not treated as truncated: a station can simply have no data.
+    """
+    newest = None
+    for record in records or []:
+        for entry in record.get('hourly') or []:
+            if entry.get('timestamp'):
+                timestamp = datetime.fromisoformat(entry['timestamp'])
+                newest = timestamp if newest is None else max(newest, timestamp)
+    if newest is None:
+        return None
+    if newest.tzinfo is None:
+        newest = newest.replace(tzinfo=timezone.utc)
+    expected_end = min(to_date, now or datetime.now(timezone.utc))
+    if newest >= expected_end - timedelta(hours=1 + TRUNCATION_SLACK_HOURS):
+        return None
+    resume_at = newest.astimezone(timezone.utc).replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+    return resume_at if from_date < resume_at < to_date else None
+
+
+# Shared limits for the process (None when adaptive sizing is disabled)
+segment_limits = SegmentLimits() if ADAPTIVE_SEGMENTS else None
@@ -1,9 +1,7 @@
-import requests
-import subprocess
-import sys
 import os
-from dotenv import load_dotenv
 import sys
+import argparse
+from dotenv import load_dotenv
 
 # Load .env file with existing environment variables
 load_dotenv()
@@ -62,9 +60,8 @@ def configure_settings():
             hours_of_history = configure_history_range()
         elif choice == '7':  # Add file save location change
             configure_file_save_location()
-        elif choice == '8':  # Run fetch_weather_data script
-            # explicitly invoke the correct environment's Python interpreter
-            subprocess.run([sys.executable, "fetch_weather_data.py"], check=True)
+        elif choice == '8':  # Run fetch_weather_data in this process
+            run_fetch(username, password)
         elif choice == '9':
             # Save changes to .env and exit
             update_env_file(username, password, api_key, device_id, temperature_unit, wind_speed_unit,
@@ -74,6 +71,30 @@ def configure_settings():
         else:
             print("Invalid choice. Please enter a valid number.")
 
+# Function to run a fetch without starting a second Python interpreter
+def run_fetch(username=None, password=None):
+    """Fetches weather history in-process with the settings saved to .env so far.
+
+    username and password are this session's (possibly unsaved) credentials.
+    """
+    previous_credentials = (os.getenv('WXM_USERNAME'), os.getenv('WXM_PASSWORD'))
+    # Pick up values written by save_to_env during this session, as a fresh process would
+    load_dotenv(override=True)
+    if username:
+        os.environ['WXM_USERNAME'] = username
+    if password:
+        os.environ['WXM_PASSWORD'] = password
+    if (os.getenv('WXM_USERNAME'), os.getenv('WXM_PASSWORD')) != previous_credentials:
+        # The cached token and the saved API key belong to the previous login
+        from api_manager import token_cache
+        token_cache.clear()
+        os.environ.pop('WXM_API_KEY', None)
+    from fetch_weather_data import fetch_weather_data
+    try:
+        fetch_weather_data(int(os.getenv('HOURS_OF_HISTORY', '24')))
+    except Exception as e:
+        print(f"Fetch failed: {e}")
+
 def configure_file_save_location():
     # Get the current file save location from the .env file, if it exists
     current_location = os.getenv('FILE_SAVE_LOCATION', os.getcwd())  # Default to current working directory
@@ -240,5 +261,9 @@ def update_env_file(username, password, api_key, device_id, temp_unit, wind_unit
         for key, value in env_vars.items():
             file.write(f"{key}={value}\n")
 
-if __name__ == "__main__":
+def main(argv=None):
+    argparse.ArgumentParser(description="Interactively configure the WeatherXM Python Playground (.env).").parse_args(argv)
     configure_settings()
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,143 @@
+# sqlite_storage.py
+import os
+import sqlite3
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+from weather_schema import MEASUREMENT_COLUMNS, widen_measurements
+from unit_conversion import convert_frame, convert_arrays
+
+# Load environment variables
+load_dotenv()
+
+SQLITE_PATH = os.getenv('SQLITE_PATH', os.path.join(os.getcwd(), "data", "weather.sqlite3"))
+UPSERT_BATCH_SIZE = 5000
+STORED_COLUMNS = MEASUREMENT_COLUMNS + ['icon']
+
+
+def connect(path=SQLITE_PATH):
+    """Opens the store in WAL mode and makes sure the hourly table has every schema column."""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    # Timestamps are stored as UTC epoch seconds; the primary key doubles as the range-scan index
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS hourly ("
+        "device_id TEXT NOT NULL, "
+        "ts INTEGER NOT NULL, "
+        + "".join(f"{column} REAL, " for column in MEASUREMENT_COLUMNS)
+        + "icon TEXT, "
+        "PRIMARY KEY (device_id, ts)) WITHOUT ROWID"
+    )
+    existing = {row[1] for row in conn.execute("PRAGMA table_info(hourly)")}
+    for column in STORED_COLUMNS:
+        if column not in existing:
+            conn.execute(f"ALTER TABLE hourly ADD COLUMN {column} {'TEXT' if column == 'icon' else 'REAL'}")
+    conn.commit()
+    return conn
+
+
+@contextmanager
+def _connection(conn, path=SQLITE_PATH):
+    if conn is not None:
+        yield conn
+        return
+    conn = connect(path)
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
+def _to_epoch(timestamp):
+    if isinstance(timestamp, str):
+        timestamp = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+    elif isinstance(timestamp, pd.Timestamp):
+        timestamp = timestamp.to_pydatetime()
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return int(timestamp.timestamp())
+
+
+def upsert_records(data, device_id, conn=None, path=SQLITE_PATH):
+    """Inserts or updates flattened rows (dicts or a DataFrame) keyed by (device_id, timestamp) in batches."""
+    columns = ['device_id', 'ts'] + STORED_COLUMNS
+    sql = (
+        f"INSERT INTO hourly ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)}) "
+        f"ON CONFLICT(device_id, ts) DO UPDATE SET "
+        + ", ".join(f"{column}=excluded.{column}" for column in STORED_COLUMNS)
+    )
+    if isinstance(data, pd.DataFrame):
+        # Vectorized path for flatten_to_frame output; NaN is bound as NULL
+        frame = data.dropna(subset=['timestamp'])
+        epochs = (frame['timestamp'] - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(seconds=1)
+        values = widen_measurements(frame.reindex(columns=STORED_COLUMNS)).astype(object)
+        values = values.where(values.notna(), None)
+        rows = list(zip([device_id] * len(frame), epochs.tolist(), *(values[c].tolist() for c in STORED_COLUMNS)))
+    else:
+        rows = [
+            (device_id, _to_epoch(record['timestamp']), *(record.get(column) for column in STORED_COLUMNS))
+            for record in data if record.get('timestamp')
+        ]
+    with _connection(conn, path) as conn:
+        with conn:
+            for i in range(0, len(rows), UPSERT_BATCH_SIZE):
+                conn.executemany(sql, rows[i:i + UPSERT_BATCH_SIZE])
+    return len(rows)
+
+
+def _range_query(device_id, start, end, columns):
+    columns = columns or STORED_COLUMNS
+    unknown = set(columns) - set(STORED_COLUMNS)
+    if unknown:
+        raise ValueError(f"Unknown columns: {', '.join(sorted(unknown))}")
+    sql = f"SELECT ts, {', '.join(columns)} FROM hourly WHERE device_id = ?"
+    params = [device_id]
+    if start is not None:
+        sql += " AND ts >= ?"
+        params.append(_to_epoch(start))
+    if end is not None:
+        sql += " AND ts < ?"
+        params.append(_to_epoch(end))
+    return sql + " ORDER BY ts", params, columns
+
+
+def query_range(device_id, start=None, end=None, columns=None, conn=None, path=SQLITE_PATH, units=None):
+    """Returns rows for one device in [start, end) as a DataFrame, via a range scan on the primary key.
+
+    Values are stored in metric units; pass units ({quantity: unit}) to convert on the way out.
+    """
+    sql, params, columns = _range_query(device_id, start, end, columns)
+    with _connection(conn, path) as conn:
+        df = pd.read_sql_query(sql, conn, params=params)
+    df.insert(0, 'timestamp', pd.to_datetime(df.pop('ts'), unit='s', utc=True))
+    return convert_frame(df, units) if units else df
+
+
+def query_arrays(device_id, start=None, end=None, columns=None, conn=None, path=SQLITE_PATH, units=None):
+    """Returns the same range as query_range as a dict of NumPy arrays ('timestamp' is datetime64[s])."""
+    sql, params, columns = _range_query(device_id, start, end, columns)
+    with _connection(conn, path) as conn:
+        rows = conn.execute(sql, params).fetchall()
+    values = list(zip(*rows)) if rows else [()] * (len(columns) + 1)
+    arrays = {'timestamp': np.array(values[0], dtype='int64').astype('datetime64[s]')}
+    for column, column_values in zip(columns, values[1:]):
+        if column == 'icon':
+            arrays[column] = np.array(column_values, dtype=object)
+        else:
+            arrays[column] = np.array([np.nan if v is None else v for v in column_values], dtype='float64')
+    return convert_arrays(arrays, units) if units else arrays
+
+
+def get_last_timestamp(device_id, conn=None, path=SQLITE_PATH):
+    """Returns the newest stored timestamp for a device, or None."""
+    if conn is None and not os.path.exists(path):
+        return None
+    with _connection(conn, path) as conn:
+        (last_ts,) = conn.execute("SELECT MAX(ts) FROM hourly WHERE device_id = ?", (device_id,)).fetchone()
+    return None if last_ts is None else pd.Timestamp(last_ts, unit='s', tz='UTC')
@@ -7,11 +7,15 @@ from datetime import datetime, timedelta, timezone
 
 load_dotenv()
 
-# Get the WeatherXM API key and device ID from the environment variables
-API_KEY = os.getenv('WXM_API_KEY').strip("'")
-DEVICE_ID = os.getenv('DEVICE_ID').strip("'")
+# API root (WXM_API_BASE_URL can point at benchmarks/mock_server.py)
+API_BASE_URL = os.getenv('WXM_API_BASE_URL', "https://api.weatherxm.com/api/v1").rstrip('/')
+
+
 def test_api_date_limits():
-    base_url = f"https://api.weatherxm.com/api/v1/me/devices/{DEVICE_ID}/history"
+    # Read the API key and device ID when called, so importing this module has no side effects
+    API_KEY = (os.getenv('WXM_API_KEY') or '').strip("'")
+    DEVICE_ID = (os.getenv('DEVICE_ID') or '').strip("'")
+    base_url = f"{API_BASE_URL}/me/devices/{DEVICE_ID}/history"
     start_date = (datetime.utcnow() - timedelta(days=30)).isoformat()  # 30 days ago
     end_date = datetime.utcnow().isoformat()  # Now
 
@@ -36,4 +40,5 @@ def test_api_date_limits():
         print(f"An error occurred: {e}")
 
 # Call the function to check date limits
-test_api_date_limits()
+if __name__ == "__main__":
+    test_api_date_limits()
@@ -0,0 +1,111 @@
+# token_cache.py
+import os
+import json
+import base64
+import threading
+import time
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+TOKEN_CACHE_FILE = os.getenv('TOKEN_CACHE_FILE', os.path.join(os.getcwd(), '.wxm_token.json'))
+# Refresh the token this many seconds before its JWT 'exp' is reached
+TOKEN_REFRESH_MARGIN_SECONDS = int(os.getenv('TOKEN_REFRESH_MARGIN_SECONDS', '300'))
+
+
+def get_token_expiry_timestamp(token):
+    """Returns the JWT 'exp' claim as a Unix timestamp, or None if it can't be decoded."""
+    try:
+        payload_encoded = token.split('.')[1]
+        payload_encoded += '=' * (-len(payload_encoded) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(payload_encoded).decode('utf-8'))
+        exp_timestamp = payload.get('exp')
+        return float(exp_timestamp) if exp_timestamp else None
+    except (AttributeError, IndexError, TypeError, ValueError):
+        return None
+
+
+class TokenCache:
+    """Keeps the API token in memory and on disk and refreshes it ahead of expiry.
+
+    Refreshes are single-flight: concurrent callers that find the token stale
+    wait on one login instead of each logging in themselves.
+    """
+
+    def __init__(self, login, path=TOKEN_CACHE_FILE, refresh_margin=TOKEN_REFRESH_MARGIN_SECONDS):
+        self.login = login
+        self.path = path
+        self.refresh_margin = refresh_margin
+        self.token = None
+        self.expires_at = None
+        self.rejected = set()
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def _is_fresh(self, token, expires_at):
+        # Tokens without a readable 'exp' are trusted until the API rejects them
+        if not token or token in self.rejected:
+            return False
+        return expires_at is None or expires_at - self.refresh_margin > time.time()
+
+    def _load(self):
+        self.loaded = True
+        try:
+            with open(self.path, 'r') as f:
+                cached = json.load(f)
+            self.token, self.expires_at = cached.get('token'), cached.get('expires_at')
+        except (OSError, ValueError):
+            pass
+
+    def _store(self, token):
+        self.token = token
+        self.expires_at = get_token_expiry_timestamp(token)
+        temp_path = f"{self.path}.tmp"
+        try:
+            with open(temp_path, 'w') as f:
+                json.dump({'token': self.token, 'expires_at': self.expires_at}, f)
+            os.chmod(temp_path, 0o600)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            print(f"Could not write token cache {self.path}: {e}")
+
+    def _refresh_locked(self):
+        token = self.login()
+        if token:
+            self._store(token)
+        return token
+
+    def get(self, seed_token=None):
+        """Returns a valid token, logging in only if neither the cache nor seed_token is fresh."""
+        if self._is_fresh(self.token, self.expires_at):
+            return self.token
+        with self.lock:
+            if not self.loaded:
+                self._load()
+            if self._is_fresh(self.token, self.expires_at):
+                return self.token
+            if seed_token and self._is_fresh(seed_token, get_token_expiry_timestamp(seed_token)):
+                self._store(seed_token)
+                return self.token
+            return self._refresh_locked()
+
+    def clear(self):
+        """Forgets the token in memory and on disk, e.g. after the login credentials changed."""
+        with self.lock:
+            self.token = self.expires_at = None
+            self.loaded = True
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"Could not remove token cache {self.path}: {e}")
+
+    def refresh(self, stale_token):
+        """Replaces a token the API rejected, reusing a newer one if another caller already refreshed."""
+        with self.lock:
+            self.rejected.add(stale_token)
+            if self.token != stale_token and self._is_fresh(self.token, self.expires_at):
+                return self.token
+            return self._refresh_locked()
@@ -0,0 +1,122 @@
+# unit_conversion.py
+from itertools import product
+import numpy as np
+import pandas as pd
+
+# Units the API returns and every store keeps; conversion only happens when data is read or exported
+CANONICAL_UNITS = {'temperature': 'C', 'wind': 'm/s', 'precipitation': 'mm', 'pressure': 'hPa'}
+# Units of previous_weather_data.csv and other exports made before the API data was kept canonical
+LEGACY_UNITS = {'temperature': 'F', 'wind': 'mph', 'precipitation': 'in', 'pressure': 'hPa'}
+
+# value_in_canonical = value * scale + offset, per (quantity, unit)
+_TO_CANONICAL = {
+    'temperature': {'C': (1.0, 0.0), 'F': (5 / 9, -32 * 5 / 9), 'K': (1.0, -273.15)},
+    'wind': {'m/s': (1.0, 0.0), 'mph': (0.44704, 0.0), 'km/h': (1 / 3.6, 0.0), 'kn': (1852 / 3600, 0.0)},
+    'precipitation': {'mm': (1.0, 0.0), 'in': (25.4, 0.0), 'cm': (10.0, 0.0)},
+    'pressure': {'hPa': (1.0, 0.0), 'kPa': (10.0, 0.0), 'inHg': (33.8638866667, 0.0), 'mmHg': (1.33322387415, 0.0)},
+}
+_ALIASES = {
+    'c': 'C', '°c': 'C', 'celsius': 'C', 'f': 'F', '°f': 'F', 'fahrenheit': 'F', 'k': 'K', 'kelvin': 'K',
+    'm/s': 'm/s', 'ms': 'm/s', 'mph': 'mph', 'km/h': 'km/h', 'kmh': 'km/h', 'kph': 'km/h',
+    'kn': 'kn', 'kt': 'kn', 'knots': 'kn',
+    'mm': 'mm', 'in': 'in', 'inch': 'in', 'inches': 'in', 'cm': 'cm',
+    'hpa': 'hPa', 'mb': 'hPa', 'mbar': 'hPa', 'kpa': 'kPa', 'inhg': 'inHg', 'mmhg': 'mmHg',
+}
+# (scale, offset) for every (quantity, from, to), composed once at import
+AFFINE_FACTORS = {}
+for _quantity, _units in _TO_CANONICAL.items():
+    for (_from, (_scale_in, _offset_in)), (_to, (_scale_out, _offset_out)) in product(_units.items(), repeat=2):
+        # from -> canonical: v * s_in + o_in; canonical -> to: (c - o_out) / s_out
+        AFFINE_FACTORS[(_quantity, _from, _to)] = (_scale_in / _scale_out, (_offset_in - _offset_out) / _scale_out)
+
+# Which quantity each measurement column holds (API fields and the legacy export's headers)
+COLUMN_QUANTITIES = {
+    'temperature': 'temperature', 'dew_point': 'temperature', 'feels_like': 'temperature',
+    'wind_speed': 'wind', 'wind_gust': 'wind',
+    'precipitation': 'precipitation', 'precipitation_accumulated': 'precipitation',
+    'pressure': 'pressure',
+    'Temperature': 'temperature', 'Wind Speed': 'wind', 'Precipitation': 'precipitation', 'Pressure': 'pressure',
+}
+
+
+def normalize_unit(unit):
+    """Maps a unit as typed in settings ('f', 'MPH', 'mb', ...) to its canonical spelling."""
+    key = str(unit).strip().strip("'\"").lower()
+    if key not in _ALIASES:
+        raise ValueError(f"Unknown unit: {unit!r}")
+    return _ALIASES[key]
+
+
+def get_factors(quantity, from_unit, to_unit):
+    """Returns (scale, offset) such that to_value = from_value * scale + offset."""
+    key = (quantity, normalize_unit(from_unit), normalize_unit(to_unit))
+    if key not in AFFINE_FACTORS:
+        raise ValueError(f"Cannot convert {quantity} from {from_unit} to {to_unit}")
+    return AFFINE_FACTORS[key]
+
+
+def units_from_settings():
+    """Returns the preferred units saved by settings.py as a {quantity: unit} dict."""
+    from settings import get_units
+    units = dict(zip(['temperature', 'wind', 'precipitation', 'pressure'], get_units()))
+    for quantity, unit in units.items():
+        try:
+            get_factors(quantity, unit, CANONICAL_UNITS[quantity])
+        except ValueError:
+            print(f"Unsupported {quantity} unit {unit!r} in settings; using {CANONICAL_UNITS[quantity]}.")
+            units[quantity] = CANONICAL_UNITS[quantity]
+    return units
+
+
+def convert_array(values, quantity, from_unit, to_unit):
+    """Converts a whole NumPy array (or Series) at once; float dtypes are preserved."""
+    scale, offset = get_factors(quantity, from_unit, to_unit)
+    if scale == 1.0 and offset == 0.0:
+        return values
+    if isinstance(values, pd.Series):
+        return values.astype('float64').mul(scale).add(offset).astype(
+            values.dtype if values.dtype.kind == 'f' else 'float64')
+    array = np.asarray(values)
+    dtype = array.dtype if array.dtype.kind == 'f' else np.float64
+    return (array.astype(np.float64) * scale + offset).astype(dtype)
+
+
+def _plan(columns, to_units, from_units):
+    """Lists (column, quantity, from, to) for the columns that actually need converting."""
+    from_units = {**CANONICAL_UNITS, **(from_units or {})}
+    to_units = {**from_units, **(to_units or {})}
+    plan = []
+    for column in columns:
+        quantity = COLUMN_QUANTITIES.get(column)
+        if quantity is None:
+            continue
+        if get_factors(quantity, from_units[quantity], to_units[quantity]) != (1.0, 0.0):
+            plan.append((column, quantity, from_units[quantity], to_units[quantity]))
+    return plan
+
+
+def convert_frame(frame, to_units=None, from_units=None):
+    """Returns a copy of frame with every known measurement column converted column-wise.
+
+    Units are {quantity: unit} dicts; from_units defaults to the canonical API units and
+    to_units to the settings.py preferences. Unknown columns are passed through.
+    """
+    if to_units is None:
+        to_units = units_from_settings()
+    plan = _plan(frame.columns, to_units, from_units)
+    if not plan:
+        return frame
+    return frame.assign(**{
+        column: convert_array(frame[column], quantity, from_unit, to_unit)
+        for column, quantity, from_unit, to_unit in plan
+    })
+
+
+def convert_arrays(arrays, to_units=None, from_units=None):
+    """Same as convert_frame for a {column: ndarray} dict such as sqlite_storage.query_arrays returns."""
+    if to_units is None:
+        to_units = units_from_settings()
+    converted = dict(arrays)
+    for column, quantity, from_unit, to_unit in _plan(arrays.keys(), to_units, from_units):
+        converted[column] = convert_array(arrays[column], quantity, from_unit, to_unit)
+    return converted
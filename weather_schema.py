@@ -0,0 +1,40 @@
+# weather_schema.py
+"""Canonical column layout for flattened hourly records, shared by the storage backends."""
+
+# Numeric measurements taken from each hourly entry
+MEASUREMENT_COLUMNS = [
+    'temperature',
+    'precipitation_accumulated',
+    'wind_speed',
+    'humidity',
+    'pressure',
+    'wind_direction',
+    'wind_gust',
+    'uv_index',
+    'illuminance',
+    'solar_irradiance',
+    'dew_point',
+    'feels_like',
+    'precipitation',
+]
+
+# Column order of a flattened record
+FLAT_COLUMNS = ['timestamp'] + MEASUREMENT_COLUMNS + ['icon']
+
+# Explicit dtypes of a flattened DataFrame (timestamp is tz-aware datetime64)
+MEASUREMENT_DTYPE = 'float32'
+ICON_DTYPE = 'category'
+
+
+def widen_measurements(frame):
+    """Returns frame with float32 measurements as float64, keeping their shortest decimal form.
+
+    A plain astype('float64') would turn 4.59 into 4.590000152587891 in CSV, Excel or SQLite output.
+    """
+    columns = [column for column in MEASUREMENT_COLUMNS
+               if column in frame.columns and frame[column].dtype == MEASUREMENT_DTYPE]
+    if not columns:
+        return frame
+    # One NumPy round trip through float32's shortest repr for the whole block
+    widened = frame[columns].to_numpy(dtype=MEASUREMENT_DTYPE).astype(str).astype('float64')
+    return frame.assign(**{column: widened[:, i] for i, column in enumerate(columns)})
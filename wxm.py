@@ -0,0 +1,46 @@
+# wxm.py
+"""Single command-line entry point for the WeatherXM Python Playground.
+
+    python wxm.py fetch [--hours N] [--workers N]
+    python wxm.py config
+    python wxm.py plot [--device ID] [--hours N] [--output chart.png]
+    python wxm.py export --start YYYY-MM-DD [--devices a,b] [--sheet-per-month]
+    python wxm.py migrate previous_weather_data.csv [--device ID] [--tz Zone]
+
+Only argparse is imported up front; a subcommand imports its own module when it runs
+(so `wxm config` never loads pandas) and everything runs in this one interpreter.
+`python wxm.py <command> --help` shows each command's options.
+"""
+import sys
+import argparse
+import importlib
+
+# Subcommand -> (module whose main(argv) runs it, help text)
+COMMANDS = {
+    'fetch': ('fetch_weather_data', "fetch new weather history for the configured station"),
+    'config': ('settings', "change credentials, device, units and history range"),
+    'plot': ('data_visualization', "chart a station's stored history"),
+    'export': ('excel_export', "export stored history to an Excel workbook"),
+    'migrate': ('csv_migration', "import legacy and exported CSV history into the history store"),
+    'backfill': ('backfill', "resumable multi-day history backfill"),
+    'fleet': ('fleet_fetch', "fetch many stations at once"),
+    'schedule': ('scheduler', "poll stations for new hourly data on a schedule"),
+    'rollups': ('rollups', "rebuild or show daily/weekly/monthly rollups"),
+}
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+    parser = argparse.ArgumentParser(
+        prog='wxm', description="WeatherXM Python Playground.",
+        epilog="commands:\n" + "\n".join(f"  {name:<10}{help_text}" for name, (_, help_text) in COMMANDS.items()),
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=COMMANDS, metavar='command', help="one of the commands below")
+    # Everything after the command is parsed by the command's own module
+    args = parser.parse_args(argv[:1])
+    module = importlib.import_module(COMMANDS[args.command][0])
+    return module.main(argv[1:])
+
+
+if __name__ == "__main__":
+    sys.exit(main())